@@ -6,12 +6,16 @@
 
 """
 
+import contextlib
 import logging
+import os
+import time
 import numpy as np
 import gan as GAN
 import vae as VAE
 import pot as POT
 from utils import ArraySaver
+from utils import SampleStore
 from metrics import Metrics
 import utils
 
@@ -35,10 +39,22 @@ class AdaGan(object):
         self.steps_made = 0
         num = data.num_points
         self._data_num = num
+        self._data_shape = data.data_shape
         self._data_weights = np.ones(num) / (num + 0.)
         self._mixture_weights = np.zeros(0)
         self._beta_heur = opts['beta_heur']
         self._saver = ArraySaver('disk', workdir=opts['work_dir'])
+        # Samples of the trained components are read many times per step,
+        # so we keep them memory-mapped instead of reloading every time.
+        self._samples = SampleStore(
+            opts['work_dir'], max_open=opts.get('samples_max_open', 10))
+        # With opts['keep_generators'] every trained generator is exported
+        # and the mixture is sampled from them rather than stored samples.
+        self._work_dir = opts['work_dir']
+        self._generators = None
+        if opts.get('keep_generators', False):
+            self._generators = utils.GeneratorPool(
+                opts, max_open=opts.get('generators_max_open', 2))
         # Which GAN architecture should we use?
         pic_datasets = ['mnist',
                         'dsprites',
@@ -83,12 +99,15 @@ class AdaGan(object):
         else:
             assert False, "We don't have any other GAN implementations yet..."
         self._gan_class = gan_class
+        # With opts['reuse_graph'] one trainer is kept for all the steps
+        self._gan = None
+        self._random = utils.random_state(opts, 'mixture')
         if opts["inverse_metric"]:
             inv_num = opts['inverse_num']
             assert inv_num < data.num_points, \
                 'Number of points to invert larger than a training set'
             inv_num = min(inv_num, data.num_points)
-            self._invert_point_ids = np.random.choice(
+            self._invert_point_ids = self._random.choice(
                 data.num_points, inv_num, replace=False)
             self._invert_losses = np.zeros((self.steps_total, inv_num))
 
@@ -107,7 +126,7 @@ class AdaGan(object):
                 the relevant info about it.
         """
 
-        with self._gan_class(opts, data, self._data_weights) as gan:
+        with self._new_component(opts, data) as gan:
 
             beta = self._next_mixture_weight(opts)
             if self.steps_made > 0 and not opts['is_bagging']:
@@ -116,14 +135,17 @@ class AdaGan(object):
                 # (a) We are running the very first GAN instance
                 # (b) We are bagging, in which case the weughts are always uniform
                 self._update_data_weights(opts, gan, beta, data)
-                gan._data_weights = np.copy(self._data_weights)
+                gan.set_data_weights(self._data_weights)
 
             # Train GAN
             gan.train(opts)
             # Save a sample
             logging.debug('Saving a sample from the trained component...')
             sample = gan.sample(opts, opts['samples_per_component'])
-            self._saver.save('samples{:02d}.npy'.format(self.steps_made), sample)
+            self._samples.save('samples{:02d}.npy'.format(self.steps_made), sample)
+            if self._generators is not None:
+                gan.export_generator(
+                    opts, self._generator_file(self.steps_made))
             metrics = Metrics()
             metrics.make_plots(opts, self.steps_made, data.data,
                                sample[:min(len(sample), 320)],
@@ -158,46 +180,92 @@ class AdaGan(object):
             self._mixture_weights = np.array(scaled_old_weights + [beta])
         self.steps_made += 1
 
+    @contextlib.contextmanager
+    def _new_component(self, opts, data):
+        """Yields the trainer of the next component.
+
+        Normally a new trainer is constructed for every step and its graph
+        is discarded afterwards. With opts['reuse_graph'] the trainer of the
+        first step is kept and only re-initialized for the following steps,
+        which saves building the graph (tens of seconds for big POT models).
+        """
+        setup_start = time.time()
+        if not opts.get('reuse_graph', False):
+            with self._gan_class(opts, data, self._data_weights) as gan:
+                logging.debug('Setting up the trainer took %.2f sec' % (
+                    time.time() - setup_start))
+                yield gan
+            return
+        if self._gan is None:
+            self._gan = self._gan_class(opts, data, self._data_weights)
+        else:
+            self._gan.reset(opts)
+            self._gan.set_data_weights(self._data_weights)
+        logging.debug('Setting up the trainer took %.2f sec' % (
+            time.time() - setup_start))
+        yield self._gan
+
+    def close(self):
+        """Close the trainer kept for all the steps with opts['reuse_graph']
+        and the generators loaded with opts['keep_generators'].
+
+        """
+        if self._gan is not None:
+            self._gan.__exit__(None, None, None)
+            self._gan = None
+        if self._generators is not None:
+            self._generators.close()
+
     def sample_mixture(self, num=100):
         """Sample num elements from the current AdaGAN mixture of generators.
 
-        In this code we are not storing individual TensorFlow graphs
+        By default we are not storing individual TensorFlow graphs
         corresponding to every one of the already trained component generators.
         Instead, we sample enough of points once per every trained
         generator and store these samples. Later, in order to sample from the
         mixture, we first define which component to sample from and then
         pick points uniformly from the corresponding stored sample.
 
+        With opts['keep_generators'] the trained generators are exported as
+        frozen graphs instead and fresh points are generated by the
+        components, with at most opts['generators_max_open'] of them loaded
+        at a time.
+
         """
 
-        #First we define how many points do we need
-        #from each of the components
-        component_ids = []
-        for _ in xrange(num):
-            new_id = np.random.choice(self.steps_made, 1,
-                                      p=self._mixture_weights)[0]
-            component_ids.append(new_id)
-        points_per_component = [component_ids.count(i)
-                                for i in xrange(self.steps_made)]
+        if num == 0:
+            return np.zeros((0,) + tuple(self._data_shape))
+
+        # First we define how many points do we need
+        # from each of the components
+        points_per_component = self._random.multinomial(
+            num, self._mixture_weights)
 
         # Next we sample required number of points per component
         sample = []
-        for comp_id  in xrange(self.steps_made):
+        for comp_id in xrange(self.steps_made):
             _num = points_per_component[comp_id]
             if _num == 0:
                 continue
-            comp_samples = self._saver.load('samples{:02d}.npy'.format(comp_id))
-            for _ in xrange(_num):
-                sample.append(
-                    comp_samples[np.random.randint(len(comp_samples))])
+            if self._generators is not None:
+                sample.append(self._generators.sample(
+                    self._generator_file(comp_id), _num, self._random))
+                continue
+            comp_samples = self._samples.load('samples{:02d}.npy'.format(comp_id))
+            # Sorted ids make reads from the memory map sequential
+            ids = np.sort(self._random.randint(len(comp_samples), size=_num))
+            sample.append(comp_samples[ids])
 
         # Finally we shuffle
-        res = np.array(sample)
-        np.random.shuffle(res)
+        res = np.concatenate(sample, axis=0)
+        self._random.shuffle(res)
 
         return res
 
 
+    def _generator_file(self, comp_id):
+        return os.path.join(self._work_dir, 'generator{:02d}'.format(comp_id))
+
     def _next_mixture_weight(self, opts):
         """Returns a weight, corresponding to the next mixture component.
 
@@ -282,23 +350,20 @@ class AdaGan(object):
         num = self._data_num
         ratios_sorted = np.sort(ratios)
         cumsum_ratios = np.cumsum(ratios_sorted)
-        is_found = False
         # We first find the optimal lambda* which is guaranteed to exits.
         # While Lemma 5 guarantees that lambda* <= 1, in practice this may
         # not be the case, as we replace dPmodel/dPdata by (1-D)/D.
-        for i in xrange(num):
-            # Computing lambda from equation (18) of the arxiv paper
-            _lambda = beta * num * (1. + (1.-beta) / beta \
-                    / num * cumsum_ratios[i]) / (i + 1.)
-            if i == num - 1:
-                if _lambda >= (1. - beta) * ratios_sorted[-1]:
-                    is_found = True
-                    break
-            else:
-                if _lambda <= (1 - beta) * ratios_sorted[i + 1] \
-                        and _lambda >= (1 - beta) * ratios_sorted[i]:
-                    is_found = True
-                    break
+        # Computing all candidate lambdas from equation (18) of the arxiv
+        # paper at once. lambda_i is feasible if it falls between the i-th
+        # and (i+1)-th smallest scaled ratios.
+        lambdas = beta * num * (1. + (1.-beta) / beta \
+                / num * cumsum_ratios) / (np.arange(num) + 1.)
+        lower = (1. - beta) * ratios_sorted
+        upper = np.append((1. - beta) * ratios_sorted[1:], np.inf)
+        feasible = (lambdas >= lower) & (lambdas <= upper)
+        is_found = np.any(feasible)
+        if is_found:
+            _lambda = lambdas[np.argmax(feasible)]
         # Next we compute the actual weights using equation (17)
         data_weights = np.zeros(num)
         if is_found:
@@ -309,7 +374,7 @@ class AdaGan(object):
                 'Lambda={}, sum={}, deleted points={}'.format(
                     _lambda,
                     np.sum(data_weights),
-                    1.0 * (num - sum(_lambdamask)) / num))
+                    1.0 * (num - np.sum(_lambdamask)) / num))
             # This is a delicate moment. Ratios are supposed to be
             # dPmodel/dPdata. However, we are using a heuristic
             # esplained around (16) in the arXiv paper. So the
@@ -331,24 +396,22 @@ class AdaGan(object):
         num = self._data_num
         ratios_sorted = np.sort(ratios)
         cumsum_ratios = np.cumsum(ratios_sorted)
-        is_found = False
         # We first find the optimal lambda* which is guaranteed to exits.
-        for i in range(int(np.floor(num * beta - 1)), num):
-            # Computing lambda
-            if (i + 1.) / num < beta:
-                continue
-            _lambda = ((i + 1.) / num - beta) / (1. - beta) * num \
-                / (cumsum_ratios[i] + 1e-7)
-            if i == num - 1:
-                if _lambda < 1. / (1. - beta) / (ratios_sorted[i] + 1e-7):
-                    is_found = True
-                    break
-            else:
-                if _lambda < 1. / (1. - beta) / (ratios_sorted[i] + 1e-7) \
-                        and _lambda >= 1. / (1. - beta) / \
-                            (ratios_sorted[i + 1] + 1e-7):
-                    is_found = True
-                    break
+        # All the candidate lambdas are computed at once and lambda_i is
+        # feasible if 1 / (1 - beta) / lambda_i falls between the i-th and
+        # (i+1)-th smallest ratios.
+        ids = np.arange(num)
+        valid = (ids >= int(np.floor(num * beta - 1))) & \
+                ((ids + 1.) / num >= beta)
+        lambdas = ((ids + 1.) / num - beta) / (1. - beta) * num \
+            / (cumsum_ratios + 1e-7)
+        upper = 1. / (1. - beta) / (ratios_sorted + 1e-7)
+        lower = np.append(1. / (1. - beta) / (ratios_sorted[1:] + 1e-7),
+                          -np.inf)
+        feasible = valid & (lambdas < upper) & (lambdas >= lower)
+        is_found = np.any(feasible)
+        if is_found:
+            _lambda = lambdas[np.argmax(feasible)]
         # Next we compute the actual weights using equation (17)
         data_weights = np.zeros(num)
         if is_found:
@@ -359,7 +422,7 @@ class AdaGan(object):
                 'Lambda={}, sum={}, deleted points={}'.format(
                     _lambda,
                     np.sum(data_weights),
-                    1.0 * (num - sum(_lambdamask)) / num))
+                    1.0 * (num - np.sum(_lambdamask)) / num))
             # This is a delicate moment. Ratios are supposed to be
             # dPmodel/dPdata. However, we are using a heuristic
             # esplained around (16) in the arXiv paper. So the
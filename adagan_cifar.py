@@ -40,6 +40,7 @@ def main():
     opts = {}
     # Utility
     opts['random_seed'] = 66
+    opts['pipeline_seed'] = None # Seed of the data pipeline, None = not reproducible
     opts['dataset'] = 'cifar10' # gmm, circle_gmm,  mnist, mnist3 ...
     opts['data_dir'] = 'cifar10'
     opts['trained_model_path'] = None #'models'
@@ -59,6 +60,9 @@ def main():
     opts['mnist3_dataset_size'] = 2 * 64 # 64 * 2500
     opts['mnist3_to_channels'] = False # Hide 3 digits of MNIST to channels
     opts['input_normalize_sym'] = False # Normalize data to [-1, 1]
+    opts['data_dtype'] = 'float32' # float64, float32 or uint8
+    opts['dataset_cache_dir'] = None # Directory of parsed datasets for faster startup, None = no cache
+    opts['dataset_shared'] = False # Attach to the dataset in shared memory, see publish_dataset.py
     opts['gmm_modes_num'] = 5
 
     # AdaGAN parameters
@@ -74,12 +78,20 @@ def main():
     opts['digit_classification_threshold'] = 0.999
     opts['inverse_metric'] = False # Use metric from the Unrolled GAN paper?
     opts['inverse_num'] = 100 # Number of real points to inverse.
+    opts['inverse_restarts'] = 5 # Random restarts of the inversion
+    opts['inverse_batched'] = False # Optimize the restarts at once? Slower on CPU
     opts['objective'] = None
 
     # Generative model parameters
     opts["init_std"] = FLAGS.init_std
     opts["init_bias"] = 0.0
     opts['latent_space_distr'] = 'normal' # uniform, normal
+    opts['reuse_graph'] = False # Build the graph once and re-initialize it for every AdaGAN step
+    opts['keep_generators'] = False # Sample the mixture from the exported component generators instead of stored samples
+    opts['generators_max_open'] = 2
+    opts['device_noise'] = False # Sample the training noise in the graph instead of feeding it
+    opts['prefetch_batches'] = 0 # Minibatches prepared ahead in a background thread, 0 = in the training thread
+    opts['graph_input'] = False # Keep the dataset on the device and sample minibatches in the graph
     opts['latent_space_dim'] = FLAGS.zdim
     opts["gan_epoch_num"] = 200
     opts['convolutions'] = True
@@ -126,6 +138,7 @@ def main():
     opts["d_steps"] = 1
     opts['d_new_minibatch'] = False
     opts["g_steps"] = 2
+    opts["fused_steps"] = 1 # Training steps per session.run of ToyGan/ImageGan, > 1 needs fed noise and data
     opts['batch_norm'] = True
     opts['dropout'] = True
     opts['dropout_keep_prob'] = 0.5
@@ -194,6 +207,7 @@ def main():
             res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
+    adagan.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
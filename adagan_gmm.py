@@ -36,6 +36,7 @@ FLAGS = flags.FLAGS
 def main():
     opts = {}
     opts['random_seed'] = 821
+    opts['pipeline_seed'] = None # Seed of the data pipeline, None = not reproducible
     opts['dataset'] = 'gmm' # gmm, circle_gmm,  mnist, mnist3, cifar ...
     opts['unrolled'] = FLAGS.unrolled # Use Unrolled GAN? (only for images)
     opts['unrolling_steps'] = 5 # Used only if unrolled = True
@@ -59,10 +60,16 @@ def main():
     opts["init_std"] = FLAGS.init_std
     opts["init_bias"] = 0.0
     opts['latent_space_distr'] = 'normal' # uniform, normal
+    opts['reuse_graph'] = False # Build the graph once and re-initialize it for every AdaGAN step
+    opts['keep_generators'] = False # Sample the mixture from the exported component generators instead of stored samples
+    opts['generators_max_open'] = 2
+    opts['device_noise'] = False # Sample the training noise in the graph instead of feeding it
+    opts['prefetch_batches'] = 0 # Minibatches prepared ahead in a background thread, 0 = in the training thread
     opts['optimizer'] = 'sgd' # sgd, adam
     opts["batch_size"] = 64
     opts["d_steps"] = 1
     opts["g_steps"] = 1
+    opts["fused_steps"] = 1 # Training steps per session.run of ToyGan/ImageGan, > 1 needs fed noise and data
     opts["verbose"] = True
     opts['tf_run_batch_size'] = 100
     opts['objective'] = 'JS'
@@ -86,6 +93,8 @@ def main():
     opts['digit_classification_threshold'] = 0.999
     opts['inverse_metric'] = False # Use metric from the Unrolled GAN paper?
     opts['inverse_num'] = 1 # Number of real points to inverse.
+    opts['inverse_restarts'] = 5 # Random restarts of the inversion
+    opts['inverse_batched'] = False # Optimize the restarts at once? Slower on CPU
 
     if opts['verbose']:
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(message)s')
@@ -117,6 +126,7 @@ def main():
         (likelihood, C) = metrics.evaluate(
             opts, step, data.data[:500],
             fake_points, more_fake_points, prefix='')
+    adagan.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
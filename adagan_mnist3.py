@@ -36,6 +36,7 @@ FLAGS = flags.FLAGS
 def main():
     opts = {}
     opts['random_seed'] = 66
+    opts['pipeline_seed'] = None # Seed of the data pipeline, None = not reproducible
     opts['dataset'] = 'mnist3' # gmm, circle_gmm,  mnist, mnist3 ...
     opts['unrolled'] = FLAGS.unrolled # Use Unrolled GAN? (only for images)
     opts['unrolling_steps'] = 5 # Used only if unrolled = True
@@ -48,6 +49,7 @@ def main():
     opts['mnist3_dataset_size'] = 64 * 2500
     opts['mnist3_to_channels'] = False # Hide 3 digits of MNIST to channels
     opts['input_normalize_sym'] = True # Normalize data to [-1, 1]
+    opts['data_dtype'] = 'float32' # float64, float32 or uint8
     opts['adagan_steps_total'] = 10
     opts['samples_per_component'] = 50000
     opts['work_dir'] = FLAGS.workdir
@@ -59,10 +61,17 @@ def main():
     opts["init_std"] = FLAGS.init_std
     opts["init_bias"] = 0.0
     opts['latent_space_distr'] = 'normal' # uniform, normal
+    opts['reuse_graph'] = False # Build the graph once and re-initialize it for every AdaGAN step
+    opts['keep_generators'] = False # Sample the mixture from the exported component generators instead of stored samples
+    opts['generators_max_open'] = 2
+    opts['device_noise'] = False # Sample the training noise in the graph instead of feeding it
+    opts['prefetch_batches'] = 0 # Minibatches prepared ahead in a background thread, 0 = in the training thread
+    opts['graph_input'] = False # Keep the dataset on the device and sample minibatches in the graph
     opts['optimizer'] = 'adam' # sgd, adam
     opts["batch_size"] = 128
     opts["d_steps"] = 1
     opts["g_steps"] = 1
+    opts["fused_steps"] = 1 # Training steps per session.run of ToyGan/ImageGan, > 1 needs fed noise and data
     opts["verbose"] = True
     opts['tf_run_batch_size'] = 100
 
@@ -85,6 +94,8 @@ def main():
     opts['digit_classification_threshold'] = 0.999
     opts['inverse_metric'] = True # Use metric from the Unrolled GAN paper?
     opts['inverse_num'] = 100 # Number of real points to inverse.
+    opts['inverse_restarts'] = 5 # Random restarts of the inversion
+    opts['inverse_batched'] = False # Optimize the restarts at once? Slower on CPU
 
     if opts['verbose']:
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(message)s')
@@ -126,6 +137,7 @@ def main():
             res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
+    adagan.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
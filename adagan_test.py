@@ -0,0 +1,75 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Tests of the AdaGAN meta-algorithm.
+
+"""
+
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from adagan import AdaGan
+import testutils
+
+
+class DataWeightsTest(tf.test.TestCase):
+
+    def _compare(self, method, lambda_loop, weights_from_lambda):
+        """Checks method against the loop version on random ratio vectors.
+
+        """
+        adagan = AdaGan.__new__(AdaGan)
+        random = np.random.RandomState(0)
+        for _ in xrange(500):
+            num = random.randint(1, 200)
+            beta = random.choice([random.uniform(), 0.5, 1. / num])
+            scale = 10. ** random.uniform(-3, 3)
+            ratios = scale * random.exponential(size=num)
+            if random.rand() < 0.2:
+                # Also check ties
+                ratios = np.round(ratios)
+            adagan._data_num = num
+            expected = weights_from_lambda(
+                beta, ratios, lambda_loop(beta, ratios))
+            self.assertAllEqual(method(adagan, beta, ratios), expected)
+
+    def testTheoryStar(self):
+        self._compare(AdaGan._compute_data_weights_theory_star,
+                      testutils.lambda_star_loop,
+                      testutils.weights_from_lambda_star)
+
+    def testTheoryDagger(self):
+        self._compare(AdaGan._compute_data_weights_theory_dagger,
+                      testutils.lambda_dagger_loop,
+                      testutils.weights_from_lambda_dagger)
+
+
+class ReuseGraphTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def testClose(self):
+        opts = testutils.trainer_opts(
+            dataset='gmm', unrolled=False, adagan_steps_total=2,
+            beta_heur='uniform', work_dir=self._work_dir, reuse_graph=True)
+        data = testutils.Points(
+            opts, np.random.RandomState(0).randn(64, 2, 1, 1))
+        adagan = AdaGan(opts, data)
+        for _ in xrange(2):
+            with adagan._new_component(opts, data) as gan:
+                pass
+        # The trainer is kept between the steps until AdaGan is closed
+        self.assertFalse(gan._session._closed)
+        adagan.close()
+        self.assertTrue(gan._session._closed)
+        adagan.close()
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,627 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Micro-benchmarks for the host-side parts of the training pipeline.
+
+Usage:
+    python benchmarks.py sampler
+    python benchmarks.py mixture
+    python benchmarks.py weights
+    python benchmarks.py decode
+    python benchmarks.py guitars
+    python benchmarks.py dtype
+    python benchmarks.py gmm
+    python benchmarks.py mnist
+    python benchmarks.py noise
+    python benchmarks.py input
+    python benchmarks.py fused
+    python benchmarks.py invert
+    python benchmarks.py reuse
+    python benchmarks.py all
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+import ops
+import utils
+import datahandler
+import gan as GAN
+from adagan import AdaGan
+from testutils import Points, trainer_opts
+import testutils
+
+
+def _timeit(func, repeats):
+    """Returns the average wall-clock time of func() in seconds.
+
+    """
+    if repeats > 1:
+        # Warm up caches, unless the function is too slow to run twice.
+        func()
+    start = time.time()
+    for _ in xrange(repeats):
+        func()
+    return (time.time() - start) / repeats
+
+
+def bench_sampler(batch_size=64, repeats=50):
+    """Cost of sampling one minibatch of weighted training points.
+
+    """
+    print 'Weighted minibatch sampling, batch_size=%d' % batch_size
+    print '%10s %16s %16s %10s' % ('N', 'np.choice, ms', 'sampler, ms', 'speedup')
+    for num in [10000, 60000, 200000, 1000000]:
+        weights = np.random.exponential(size=num)
+        weights = weights / np.sum(weights)
+        sampler = utils.WeightedSampler(weights)
+        t_old = _timeit(lambda: np.random.choice(
+            num, batch_size, replace=False, p=weights), repeats)
+        t_new = _timeit(lambda: sampler.sample(batch_size), repeats)
+        print '%10d %16.3f %16.3f %10.1f' % (
+            num, 1000 * t_old, 1000 * t_new, t_old / t_new)
+
+
+def _sample_mixture_loop(adagan, num):
+    """Per-point implementation of AdaGan.sample_mixture used before.
+
+    """
+    component_ids = []
+    for _ in xrange(num):
+        new_id = np.random.choice(adagan.steps_made, 1,
+                                  p=adagan._mixture_weights)[0]
+        component_ids.append(new_id)
+    points_per_component = [component_ids.count(i)
+                            for i in xrange(adagan.steps_made)]
+    sample = []
+    for comp_id in xrange(adagan.steps_made):
+        _num = points_per_component[comp_id]
+        comp_samples = np.array(
+            adagan._samples.load('samples{:02d}.npy'.format(comp_id)))
+        for _ in xrange(_num):
+            sample.append(
+                comp_samples[np.random.randint(len(comp_samples))])
+    res = np.array(sample)
+    np.random.shuffle(res)
+    return res
+
+def bench_mixture(steps=10, samples_per_component=1000,
+                  point_shape=(2, 1, 1)):
+    """Cost of sampling from the AdaGAN mixture.
+
+    Points are small by default, so that 1M samples fit in memory and we
+    measure the Python overhead rather than copying of the pictures.
+    """
+    adagan = AdaGan.__new__(AdaGan)
+    adagan._samples = utils.SampleStore(tempfile.mkdtemp())
+    adagan.steps_made = steps
+    adagan._mixture_weights = np.ones(steps) / (steps + 0.)
+    adagan._random = np.random.RandomState()
+    adagan._generators = None
+    adagan._data_shape = point_shape
+    for comp_id in xrange(steps):
+        adagan._samples.save(
+            'samples{:02d}.npy'.format(comp_id),
+            np.random.rand(samples_per_component, *point_shape))
+    print 'AdaGan.sample_mixture with %d components' % steps
+    print '%10s %16s %16s %10s' % ('num', 'loop, s', 'vectorized, s', 'speedup')
+    for num in [10000, 100000, 1000000]:
+        t_old = _timeit(lambda: _sample_mixture_loop(adagan, num), 1)
+        t_new = _timeit(lambda: adagan.sample_mixture(num), 1)
+        print '%10d %16.3f %16.3f %10.1f' % (
+            num, t_old, t_new, t_old / t_new)
+
+
+def bench_weights(repeats=3):
+    """Times the vectorized lambda search of AdaGAN weights.
+
+    The loop version is the one of testutils, which adagan_test.py checks
+    against AdaGan on random ratio vectors.
+    """
+    adagan = AdaGan.__new__(AdaGan)
+    methods = [
+        ('theory_star', adagan._compute_data_weights_theory_star,
+         testutils.lambda_star_loop, testutils.weights_from_lambda_star),
+        ('theory_dagger', adagan._compute_data_weights_theory_dagger,
+         testutils.lambda_dagger_loop, testutils.weights_from_lambda_dagger)]
+    print '%10s %14s %16s %16s %10s' % (
+        'N', 'heuristic', 'loop, s', 'vectorized, s', 'speedup')
+    for num in [10000, 60000, 200000]:
+        ratios = np.random.exponential(size=num)
+        adagan._data_num = num
+        for name, method, loop, weights_from_lambda in methods:
+            t_old = _timeit(lambda: weights_from_lambda(
+                0.5, ratios, loop(0.5, ratios)), repeats)
+            t_new = _timeit(lambda: method(0.5, ratios), repeats)
+            print '%10d %14s %16.3f %16.3f %10.1f' % (
+                num, name, t_old, t_new, t_old / t_new)
+
+
+def bench_decode(num_pictures=2000, workers=(1, 2, 4, 8)):
+    """Throughput of decoding CelebA-sized JPEGs with DecodePool.
+
+    Random 178x218 pictures are written to a temporary directory first.
+    """
+    data_dir = tempfile.mkdtemp()
+    filenames = ['%.6d.jpg' % (idx + 1) for idx in xrange(num_pictures)]
+    for filename in filenames:
+        picture = np.random.randint(256, size=(218, 178, 3)).astype(np.uint8)
+        Image.fromarray(picture).save(os.path.join(data_dir, filename))
+    expected = np.array([datahandler.read_celeba_image(
+        data_dir, filename, 'closecrop') for filename in filenames])
+    print 'Decoding %d JPEGs, closecrop' % num_pictures
+    print '%10s %16s %10s' % ('workers', 'images/sec', 'speedup')
+    t_serial = _timeit(lambda: [datahandler.read_celeba_image(
+        data_dir, filename, 'closecrop') for filename in filenames], 1)
+    print '%10s %16.1f %10.1f' % ('serial', num_pictures / t_serial, 1.)
+    for num_workers in workers:
+        pool = datahandler.DecodePool(num_workers)
+        assert np.array_equal(
+            pool.read(data_dir, filenames, 'closecrop'), expected), \
+            'DecodePool returned wrong pictures'
+        t_pool = _timeit(
+            lambda: pool.read(data_dir, filenames, 'closecrop'), 3)
+        pool.close()
+        print '%10d %16.1f %10.1f' % (
+            num_workers, num_pictures / t_pool, t_serial / t_pool)
+
+
+def bench_guitars(num_pictures=1000, workers=(1, 2, 4, 8)):
+    """Loading of the Thomann pictures: getdata() vs buffer conversion.
+
+    Random 128x128 pictures are written to a temporary directory first.
+    """
+    data_dir = tempfile.mkdtemp()
+    filenames = ['%.6d.jpg' % idx for idx in xrange(num_pictures)]
+    for filename in filenames:
+        picture = np.random.randint(256, size=(128, 128, 3)).astype(np.uint8)
+        Image.fromarray(picture).save(os.path.join(data_dir, filename))
+    def getdata():
+        return np.array([np.array(Image.open(
+            os.path.join(data_dir, filename)).getdata()).reshape(128, 128, 3)
+                         for filename in filenames])
+    def serial():
+        return np.array([datahandler.read_guitars_image(data_dir, filename)
+                         for filename in filenames])
+    args_list = [(data_dir, filename) for filename in filenames]
+    assert np.array_equal(getdata(), serial()), \
+        'Buffer conversion returned wrong pictures'
+    print 'Decoding %d 128x128 JPEGs' % num_pictures
+    print '%10s %16s %10s' % ('method', 'images/sec', 'speedup')
+    t_getdata = _timeit(getdata, 1)
+    print '%10s %16.1f %10.1f' % ('getdata', num_pictures / t_getdata, 1.)
+    t_serial = _timeit(serial, 3)
+    print '%10s %16.1f %10.1f' % (
+        'buffer', num_pictures / t_serial, t_getdata / t_serial)
+    for num_workers in workers:
+        pool = datahandler.DecodePool(num_workers)
+        read = lambda: pool.map(
+            datahandler.read_guitars_image, args_list, (128, 128, 3))
+        assert np.array_equal(read(), serial()), \
+            'DecodePool returned wrong pictures'
+        t_pool = _timeit(read, 3)
+        pool.close()
+        print '%10s %16.1f %10.1f' % (
+            '%d procs' % num_workers, num_pictures / t_pool,
+            t_getdata / t_pool)
+
+
+def bench_dtype(batch_size=64, repeats=200, mnist3_size=64 * 2500):
+    """Memory and per-step cost of the data_dtype options of Data.
+
+    Random 8-bit pictures of the shapes of MNIST, CIFAR10 and mnist3
+    (training parts) are used. Per-step time covers sampling a minibatch and
+    converting it to the float32 fed to the placeholders.
+    """
+    datasets = [('mnist', (60000, 28, 28, 1)),
+                ('cifar10', (59000, 32, 32, 3)),
+                ('mnist3', (mnist3_size, 28, 84, 1))]
+    print 'Data storage dtype, batch_size=%d' % batch_size
+    print '%10s %10s %12s %16s' % ('dataset', 'dtype', 'memory, MB', 'ms/step')
+    for name, shape in datasets:
+        pictures = np.random.randint(256, size=shape, dtype=np.uint8)
+        sampler = utils.WeightedSampler(np.ones(shape[0]))
+        for dtype in ['float64', 'float32', 'uint8']:
+            opts = {'data_dir': '', 'input_normalize_sym': True,
+                    'data_dtype': dtype}
+            data = datahandler.Data(opts, pictures)
+            data.normalize_sym()
+            if dtype == 'float64':
+                # What the trainers did before data_dtype was introduced
+                step = lambda: np.asarray(
+                    data[sampler.sample(batch_size)].astype(np.float),
+                    dtype=np.float32)
+            else:
+                step = lambda: np.asarray(
+                    data[sampler.sample(batch_size)], dtype=np.float32)
+            print '%10s %10s %12.1f %16.3f' % (
+                name, dtype, data.nbytes / 2. ** 20,
+                1000 * _timeit(step, repeats))
+            # Free the memory before building the next one
+            data = None
+
+
+def bench_gmm(dims=(2, 10), max_loop_num=100000):
+    """Times datahandler.sample_gmm used by the toy datasets.
+
+    The loop version is the one of testutils, which datahandler_test.py
+    checks sample_gmm against. It is only timed up to max_loop_num points.
+    """
+    print '%10s %6s %16s %16s %10s' % (
+        'num', 'dim', 'loop, s', 'vectorized, s', 'speedup')
+    for dim in dims:
+        means = np.random.uniform(-15, 15, size=(10, dim))
+        for num in [10000, 100000, 1000000, 10000000]:
+            t_new = _timeit(
+                lambda: datahandler.sample_gmm(means, 1., num), 1)
+            if num <= max_loop_num:
+                t_old = _timeit(
+                    lambda: testutils.sample_gmm_loop(means, 1., num), 1)
+                print '%10d %6d %16.3f %16.3f %10.1f' % (
+                    num, dim, t_old, t_new, t_old / t_new)
+            else:
+                print '%10d %6d %16s %16.3f %10s' % (
+                    num, dim, '-', t_new, '-')
+
+
+def bench_mnist(num=64 * 2500):
+    """Times the construction of mnist3 and mnist_mod.
+
+    Random pictures of MNIST shape are used. The loop versions are the ones
+    of testutils, which datahandler_test.py checks stack_mnist3 and
+    transform_mnist_batch against.
+    """
+    X = np.random.randint(256, size=(70000, 28, 28, 1)).astype(np.uint8)
+    y = np.random.randint(10, size=70000)
+    print 'Construction of %d points' % num
+    print '%20s %16s %16s %10s' % (
+        'dataset', 'loop, s', 'vectorized, s', 'speedup')
+    ids = np.random.choice(len(X), (num, 3), replace=True)
+    for to_channels in [False, True]:
+        t_old = _timeit(lambda: testutils.stack_mnist3_loop(
+            X, y, ids, to_channels), 1)
+        t_new = _timeit(
+            lambda: datahandler.stack_mnist3(X, y, ids, to_channels), 1)
+        name = 'mnist3 channels' if to_channels else 'mnist3 width'
+        print '%20s %16.3f %16.3f %10.1f' % (name, t_old, t_new, t_old / t_new)
+
+    X = X / 255.
+    ids = np.random.randint(len(X), size=num)
+    modes = np.array(datahandler.MNIST_MODES)[
+        np.random.randint(len(datahandler.MNIST_MODES), size=num)]
+    t_old = _timeit(lambda: testutils.transform_mnist_loop(X, ids, modes), 1)
+    t_new = _timeit(
+        lambda: datahandler.transform_mnist_batch(X[ids], modes), 1)
+    print '%20s %16.3f %16.3f %10.1f' % (
+        'mnist_mod', t_old, t_new, t_old / t_new)
+
+
+def _multivariate_noise(opts, num, random_state):
+    """generate_noise for the normal prior before the isotropic fast path.
+
+    """
+    mean = np.zeros(opts['latent_space_dim'])
+    cov = np.identity(opts['latent_space_dim'])
+    return random_state.multivariate_normal(mean, cov, num).astype(np.float32)
+
+def bench_noise(zdims=(8, 64, 100), batch_size=64, steps=5000,
+                bulk_steps=(16, 100)):
+    """Per-step cost of generating the latent noise of a minibatch.
+
+    """
+    print 'Normal noise for %d points, usec per step' % batch_size
+    header = '%6s %14s %10s %10s' % ('zdim', 'multivariate', 'fast', 'out=')
+    for bulk in bulk_steps:
+        header += ' %10s' % ('bulk %d' % bulk)
+    print header
+    for zdim in zdims:
+        opts = {'latent_space_distr': 'normal', 'latent_space_dim': zdim}
+        assert np.array_equal(
+            _multivariate_noise(opts, batch_size, np.random.RandomState(0)),
+            utils.generate_noise(opts, batch_size, np.random.RandomState(0))), \
+            'Fast path returned different noise'
+        random_state = np.random.RandomState(0)
+        out = np.empty((batch_size, zdim), dtype=np.float32)
+        times = [
+            _timeit(lambda: [_multivariate_noise(
+                opts, batch_size, random_state) for _ in xrange(steps)], 1),
+            _timeit(lambda: [utils.generate_noise(
+                opts, batch_size, random_state) for _ in xrange(steps)], 1),
+            _timeit(lambda: [utils.generate_noise(
+                opts, batch_size, random_state, out) for _ in xrange(steps)], 1)]
+        for bulk in bulk_steps:
+            noise = utils.NoiseGenerator(opts, batch_size, random_state, bulk)
+            times.append(
+                _timeit(lambda: [noise.next() for _ in xrange(steps)], 1))
+        print '%6d %14.1f %10.1f %10.1f' % tuple(
+            [zdim] + [1e6 * t / steps for t in times[:3]]) + ''.join(
+                ' %10.1f' % (1e6 * t / steps) for t in times[3:])
+
+
+def _input_steps(opts, data, weights, steps):
+    """Steps/sec of a small training step fed in one of the two ways.
+
+    The step is a single linear layer, so that the input path dominates.
+    """
+    with tf.Graph().as_default(), tf.Session() as session:
+        real_points_ph, init_ops, init_feed_dict = ops.data_placeholder(
+            opts, data, weights, 'real_points_ph')
+        points = tf.reshape(real_points_ph, [-1, int(np.prod(data.shape[1:]))])
+        w = tf.get_variable('w', [points.get_shape()[1], 1])
+        loss = tf.reduce_mean(tf.square(tf.matmul(points, w)))
+        optim = tf.train.GradientDescentOptimizer(1e-6).minimize(loss)
+        session.run(tf.global_variables_initializer())
+        session.run(init_ops, init_feed_dict)
+        if opts['graph_input']:
+            step = lambda: session.run(optim)
+        else:
+            sampler = utils.WeightedSampler(weights)
+            step = lambda: session.run(optim, feed_dict={
+                real_points_ph: data[sampler.sample(opts['batch_size'])]})
+        return steps / _timeit(lambda: [step() for _ in xrange(steps)], 1)
+
+def bench_input(batch_size=64, steps=1000):
+    """Steps/sec of training steps fed with feed_dict or sampled in-graph.
+
+    Random 8-bit pictures of the shapes of MNIST and CIFAR10 with random
+    data weights are used.
+    """
+    datasets = [('mnist', (60000, 28, 28, 1)),
+                ('cifar10', (59000, 32, 32, 3))]
+    print 'Minibatch input path, batch_size=%d, steps/sec' % batch_size
+    print '%10s %10s %12s %12s %10s' % (
+        'dataset', 'dtype', 'feed_dict', 'graph', 'speedup')
+    for name, shape in datasets:
+        pictures = np.random.randint(256, size=shape, dtype=np.uint8)
+        weights = np.random.exponential(size=shape[0])
+        weights = weights / np.sum(weights)
+        for dtype in ['float32', 'uint8']:
+            opts = {'data_dir': '', 'input_normalize_sym': True,
+                    'data_dtype': dtype, 'batch_size': batch_size}
+            data = datahandler.Data(opts, pictures)
+            data.normalize_sym()
+            feed = _input_steps(
+                dict(opts, graph_input=False), data, weights, steps)
+            graph = _input_steps(
+                dict(opts, graph_input=True), data, weights, steps)
+            print '%10s %10s %12.1f %12.1f %10.1f' % (
+                name, dtype, feed, graph, graph / feed)
+            data = None
+
+
+def _train_steps(gan_class, opts, points, steps):
+    """Training steps/sec of gan_class with opts['fused_steps'].
+
+    """
+    fused_steps = opts['fused_steps']
+    data = Points(opts, points)
+    with gan_class(opts, data, np.ones(data.num_points)) as gan:
+        feed = {}
+        if hasattr(gan, '_is_training_ph'):
+            feed[gan._is_training_ph] = True
+        sampler = utils.WeightedSampler(np.ones(data.num_points))
+        minibatches = [
+            (data.data[sampler.sample(opts['batch_size'])],
+             utils.generate_noise(opts, opts['batch_size']))
+            for _ in xrange(fused_steps)]
+
+        def single():
+            for images, noise in minibatches:
+                feed_dict = dict(feed)
+                feed_dict[gan._noise_ph] = noise
+                feed_dict[gan._real_points_ph] = images
+                gan._session.run(gan._d_optim, feed_dict=feed_dict)
+                del feed_dict[gan._real_points_ph]
+                gan._session.run(gan._g_optim, feed_dict=feed_dict)
+
+        if fused_steps > 1:
+            step = lambda: gan._run_fused_steps(minibatches, feed)
+        else:
+            step = single
+        calls = max(1, steps / fused_steps)
+        return calls * fused_steps / _timeit(
+            lambda: [step() for _ in xrange(calls)], 1)
+
+def bench_fused(fused=(1, 4, 16), steps=2000):
+    """Training steps/sec with opts['fused_steps'] on gmm and MNIST.
+
+    The gmm setting is the ToyGan of adagan_gmm.py on 2d points, MNIST the
+    ImageGan with small filters on random pictures of MNIST shape.
+    """
+    settings = [
+        ('gmm', GAN.ToyGan,
+         trainer_opts(batch_size=64, dataset='gmm', d_num_filters=16,
+                      g_num_filters=16),
+         np.random.randn(64 * 1000, 2, 1, 1)),
+        ('mnist', GAN.ImageGan,
+         trainer_opts(batch_size=64, d_num_filters=64, g_num_filters=64),
+         np.random.rand(60000, 28, 28, 1))]
+    print 'Fused training steps, batch_size=64, steps/sec'
+    print '%10s' % 'dataset' + ''.join(
+        ' %10s' % ('fused %d' % num) for num in fused)
+    for name, gan_class, opts, points in settings:
+        rates = [_train_steps(gan_class, dict(opts, fused_steps=num),
+                              points, steps if name == 'gmm' else steps / 10)
+                 for num in fused]
+        print '%10s' % name + ''.join(' %10.1f' % rate for rate in rates)
+
+
+def _add_inversion_loop_ops(gan, opts):
+    """Inversion ops of one restart, as Gan._add_inversion_ops built before."""
+    with gan._session.graph.as_default():
+        with tf.variable_scope('inversion_loop'):
+            target_ph = tf.placeholder(
+                tf.float32, [None] + list(gan._data.data_shape))
+            z = tf.get_variable(
+                'inverted', [opts['inverse_num'], opts['latent_space_dim']],
+                tf.float32, tf.random_normal_initializer(stddev=1.))
+        reconstructed_images = gan.generator(
+            opts, z, is_training=False, reuse=True)
+        with tf.variable_scope('inversion_loop'):
+            loss_per_point = tf.reduce_mean(
+                tf.square(reconstructed_images - target_ph), axis=[1, 2, 3])
+            optim = tf.train.AdamOptimizer(0.01, 0.9).minimize(
+                tf.reduce_mean(loss_per_point), var_list=[z])
+        init = tf.variables_initializer(tf.get_collection(
+            tf.GraphKeys.GLOBAL_VARIABLES, scope='inversion_loop'))
+    return target_ph, loss_per_point, optim, init
+
+def _invert_points_loop(gan, opts, images, restarts):
+    """The restarts of Gan.invert_points run one after another, as before.
+
+    Every restart stops once the mean mse stops improving and the restart
+    with the smallest mean mse is returned.
+    """
+    target_ph, loss_per_point, optim, init = \
+        _add_inversion_loop_ops(gan, opts)
+    session = gan._session
+    feed_dict = {target_ph: images}
+    results = []
+    for _ in xrange(restarts):
+        session.run(init)
+        prev_val = 100.
+        steps = 1
+        while True:
+            session.run(optim, feed_dict=feed_dict)
+            if steps % 100 == 0:
+                err_per_point = session.run(
+                    loss_per_point, feed_dict=feed_dict)
+                err = np.mean(err_per_point)
+                if np.abs(prev_val - err) / prev_val < 1e-3 or steps > 10000:
+                    results.append((err, err_per_point))
+                    break
+                prev_val = err
+            steps += 1
+    return min(results, key=lambda result: result[0])[1]
+
+def _weights(gan):
+    """Values of gan's variables, without the inversion ones."""
+    with gan._session.graph.as_default():
+        return gan._session.run(dict(
+            (v.op.name, v) for v in tf.global_variables()
+            if not v.op.name.startswith('inversion')))
+
+def _load_weights(gan, weights):
+    with gan._session.graph.as_default():
+        gan._session.run([var.assign(weights[var.op.name])
+                          for var in tf.global_variables()
+                          if var.op.name in weights])
+
+def bench_invert(inverse_num=100, restarts=5):
+    """Wall-clock time of Gan.invert_points with sequential and batched restarts.
+
+    The ImageGan with small filters is left untrained, the images to invert
+    are random pictures of MNIST shape. 'before' runs the restarts as
+    invert_points did before it picked the best restart for every point.
+    """
+    opts = trainer_opts(batch_size=64, d_num_filters=64, g_num_filters=64,
+                        inverse_metric=True, inverse_num=inverse_num,
+                        inverse_restarts=restarts)
+    batched_opts = dict(opts, inverse_batched=True)
+    points = np.random.rand(1000, 28, 28, 1)
+    images = points[:inverse_num]
+    data = Points(opts, points)
+    print 'Inversion of %d points with %d restarts' % (inverse_num, restarts)
+    print '%12s %10s %10s' % ('restarts', 'sec', 'mean mse')
+    with GAN.ImageGan(opts, data, np.ones(data.num_points)) as gan:
+        gan._trained = True
+        start = time.time()
+        err = _invert_points_loop(gan, opts, images, restarts)
+        print '%12s %10.2f %10.5f' % (
+            'before', time.time() - start, np.mean(err))
+        start = time.time()
+        _, _, err, _ = gan.invert_points(opts, images)
+        print '%12s %10.2f %10.5f' % (
+            'sequential', time.time() - start, np.mean(err))
+        weights = _weights(gan)
+    # The same untrained generator with the batched inversion ops
+    with GAN.ImageGan(batched_opts, data, np.ones(data.num_points)) as gan:
+        _load_weights(gan, weights)
+        gan._trained = True
+        start = time.time()
+        _, _, err, _ = gan.invert_points(batched_opts, images)
+        print '%12s %10.2f %10.5f' % (
+            'batched', time.time() - start, np.mean(err))
+
+
+def _setup_time(gan_class, opts, points, steps):
+    """Seconds per AdaGAN step spent setting up the trainer.
+
+    Without opts['reuse_graph'] a trainer is built and closed for every step,
+    with it the first one is kept and only reset, as in AdaGan._new_component.
+    """
+    data = Points(opts, points)
+    weights = np.ones(data.num_points) / data.num_points
+    if not opts['reuse_graph']:
+        def step():
+            with gan_class(opts, data, weights):
+                pass
+        return _timeit(step, steps)
+    with gan_class(opts, data, weights) as gan:
+        def step():
+            gan.reset(opts)
+            gan.set_data_weights(weights)
+        return _timeit(step, steps)
+
+def bench_reuse(steps=5):
+    """Trainer setup time per AdaGAN step with and without opts['reuse_graph'].
+
+    The gmm setting is the ToyGan of adagan_gmm.py, MNIST the ImageGan with
+    the filters of adagan_mnist.py on random pictures of MNIST shape, once
+    more with the dataset kept in the graph (opts['graph_input']).
+    """
+    settings = [
+        ('gmm', GAN.ToyGan,
+         trainer_opts(batch_size=64, dataset='gmm', d_num_filters=16,
+                      g_num_filters=16),
+         np.random.randn(64 * 1000, 2, 1, 1)),
+        ('mnist', GAN.ImageGan,
+         trainer_opts(batch_size=64, d_num_filters=512,
+                      g_num_filters=1024),
+         np.random.rand(60000, 28, 28, 1)),
+        ('mnist graph', GAN.ImageGan,
+         trainer_opts(batch_size=64, d_num_filters=512,
+                      g_num_filters=1024, graph_input=True),
+         np.random.rand(60000, 28, 28, 1))]
+    print 'Trainer setup per AdaGAN step, sec'
+    print '%12s %10s %10s %10s' % ('dataset', 'rebuild', 'reuse', 'speedup')
+    for name, gan_class, opts, points in settings:
+        rebuild = _setup_time(
+            gan_class, dict(opts, reuse_graph=False), points, steps)
+        reuse = _setup_time(
+            gan_class, dict(opts, reuse_graph=True), points, steps)
+        print '%12s %10.4f %10.4f %10.1f' % (
+            name, rebuild, reuse, rebuild / reuse)
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'dtype': bench_dtype,
+    'fused': bench_fused,
+    'gmm': bench_gmm,
+    'guitars': bench_guitars,
+    'input': bench_input,
+    'invert': bench_invert,
+    'mnist': bench_mnist,
+    'noise': bench_noise,
+    'mixture': bench_mixture,
+    'reuse': bench_reuse,
+    'sampler': bench_sampler,
+    'weights': bench_weights,
+}
+
+def main():
+    names = sys.argv[1:] or ['all']
+    if names == ['all']:
+        names = sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
+        print
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,12 @@
 
 import os
 import random
+import shutil
+import collections
+import ctypes
+import hashlib
+import multiprocessing
+import threading
 import logging
 import tensorflow as tf
 import numpy as np
@@ -25,6 +31,44 @@ def _data_dir(opts):
     else:
         return os.path.join('./', opts['data_dir'])
 
+# Version of the dataset cache format. Increase it whenever loaders change
+# the points they produce, so that old cache files are not used anymore.
+DATASET_CACHE_VERSION = 1
+# Seed used to shuffle the datasets
+SHUFFLE_SEED = 123
+# Datasets which are always the same after loading and so can be cached
+CACHEABLE_DATASETS = ['mnist', 'zalando', 'cifar10', 'dsprites', 'guitars']
+# Datasets published with opts['dataset_shared'] are stored in this tmpfs
+# directory. Processes on the same host memory-map the same pages, so N
+# concurrent runs need only one copy of the dataset in memory.
+SHARED_MEMORY_DIR = '/dev/shm/adagan_datasets'
+# Storage dtypes of Data if opts['data_dtype'] is not specified
+DEFAULT_DATA_DTYPES = {'dsprites': 'uint8', 'guitars': 'uint8'}
+
+def _data_dtype(opts):
+    return opts.get('data_dtype',
+                    DEFAULT_DATA_DTYPES.get(opts['dataset'], 'float64'))
+
+def dataset_cache_dir(opts):
+    """Directory of the cached dataset or None if it can not be cached.
+
+    The name of the directory contains everything that affects the cached
+    arrays: the dataset, a hash of the absolute data_dir it is read from,
+    storage dtype, normalization, seed and version.
+    With opts['dataset_shared'] the cache is kept in POSIX shared memory.
+    """
+    cache_root = opts.get('dataset_cache_dir', None)
+    if opts.get('dataset_shared', False):
+        cache_root = SHARED_MEMORY_DIR
+    if cache_root is None or opts['dataset'] not in CACHEABLE_DATASETS:
+        return None
+    data_dir = hashlib.md5(os.path.abspath(_data_dir(opts))).hexdigest()
+    name = '%s_%s_%s_%s_seed%d_v%d' % (
+        opts['dataset'], data_dir[:8], _data_dtype(opts),
+        'sym' if opts['input_normalize_sym'] else 'nosym',
+        SHUFFLE_SEED, DATASET_CACHE_VERSION)
+    return os.path.join(cache_root, name)
+
 def load_cifar_batch(fpath, label_key='labels'):
     """Internal utility for parsing CIFAR data.
 
@@ -81,40 +125,386 @@ def transform_mnist(pic, mode='n'):
         pic[-pixels:, :] = 0.
     return pic
 
+MNIST_MODES = ['n', 'i', 'sl', 'sr', 'su', 'sd']
+
+def transform_mnist_batch(pics, modes, random_state=None):
+    """Batched version of transform_mnist.
+
+    pics is a (num, 28, 28, 1) array of MNIST pictures normalized into [0, 1]
+    and modes is a (num,) array of modes from MNIST_MODES, one per picture.
+    Returns the transformed copy of pics. The noise and shifts are drawn from
+    random_state, np.random by default.
+    """
+    if random_state is None:
+        random_state = np.random
+    pics = np.array(pics, dtype=np.float)
+    modes = np.asarray(modes)
+    noised = modes == 'n'
+    pics[noised] = np.clip(
+        pics[noised] + 0.25 * random_state.randn(np.sum(noised), 28, 28, 1), 0, 1)
+    inverted = modes == 'i'
+    pics[inverted] = 1. - pics[inverted]
+    all_pixels = 3 + random_state.randint(5, size=len(pics))
+    for pixels in xrange(3, 8):
+        shifted = all_pixels == pixels
+        ids = np.where(shifted & (modes == 'sl'))[0]
+        pics[ids, :, :-pixels] = pics[ids, :, pixels:]
+        pics[ids, :, -pixels:] = 0.
+        ids = np.where(shifted & (modes == 'sr'))[0]
+        pics[ids, :, pixels:] = pics[ids, :, :-pixels]
+        pics[ids, :, :pixels] = 0.
+        ids = np.where(shifted & (modes == 'sd'))[0]
+        pics[ids, pixels:, :] = pics[ids, :-pixels, :]
+        pics[ids, :pixels, :] = 0.
+        ids = np.where(shifted & (modes == 'su'))[0]
+        pics[ids, :-pixels, :] = pics[ids, pixels:, :]
+        pics[ids, -pixels:, :] = 0.
+    return pics
+
+def stack_mnist3(X, y, ids, to_channels):
+    """Build the 3-digit MNIST pictures and labels.
+
+    ids is a (num, 3) array of ids of the digits in X. The 3 digits are
+    concatenated either into 3 channels or in width.
+    """
+    if to_channels:
+        X3 = np.concatenate([X[ids[:, k]] for k in xrange(3)], axis=3)
+    else:
+        X3 = np.concatenate([X[ids[:, k]] for k in xrange(3)], axis=2)
+    y3 = y[ids[:, 0]] * 100 + y[ids[:, 1]] * 10 + y[ids[:, 2]]
+    return X3, y3
+
+
+def sample_gmm(means, variance, num, random_state=None):
+    """Sample num points from the uniform mixture of isotropic Gaussians.
+
+    means is a (modes_num, dim) array and all the components have covariance
+    variance * I. Returns a (num, dim, 1, 1) array. All the component ids are
+    drawn before the Gaussian noise, so the result is the same as drawing the
+    ids first and then calling np.random.multivariate_normal point by point.
+    The points are drawn from random_state, np.random by default.
+    """
+    if random_state is None:
+        random_state = np.random
+    comp_ids = random_state.randint(len(means), size=num)
+    noise = random_state.standard_normal((num, means.shape[1]))
+    X = means[comp_ids] + noise * np.sqrt(variance)
+    return X[:, :, None, None]
+
+
+CELEBA_NUM_SAMPLES = 202599
+
+def read_celeba_image(data_dir, filename, crop_style):
+    """Read a CelebA picture, crop and resize it to a (64, 64, 3) uint8 array.
+
+    """
+    width = 178
+    height = 218
+    new_width = 140
+    new_height = 140
+    im = Image.open(utils.o_gfile((data_dir, filename), 'rb'))
+    if crop_style == 'closecrop':
+        # This method was used in DCGAN, pytorch-gan-collection, AVB, ...
+        left = (width - new_width) / 2
+        top = (height - new_height) / 2
+        right = (width + new_width) / 2
+        bottom = (height + new_height)/2
+        im = im.crop((left, top, right, bottom))
+        im = im.resize((64, 64), PIL.Image.ANTIALIAS)
+    elif crop_style == 'resizecrop':
+        # This method was used in ALI, AGE, ...
+        im = im.resize((64, 78), PIL.Image.ANTIALIAS)
+        im = im.crop((0, 7, 64, 64 + 7))
+    else:
+        raise Exception('Unknown crop style specified')
+    return np.array(im).reshape(64, 64, 3)
+
+def celeba_preprocessed_file(data_dir, crop_style):
+    """Path to the file with all the preprocessed CelebA pictures.
+
+    """
+    return os.path.join(data_dir, 'celeba_%s_64x64.npy' % crop_style)
+
+def preprocess_celeba(data_dir, crop_style, num_samples=CELEBA_NUM_SAMPLES):
+    """Crop all CelebA pictures once and store them in a single uint8 file.
+
+    Row i of the resulting (num_samples, 64, 64, 3) array contains the
+    picture '%.6d.jpg' % (i + 1). The file is written under a temporary
+    name and renamed in the end, so that Data never picks up a partially
+    written file.
+    """
+    filename = celeba_preprocessed_file(data_dir, crop_style)
+    tmp_filename = filename + '.tmp'
+    out = np.lib.format.open_memmap(
+        tmp_filename, mode='w+', dtype=np.uint8,
+        shape=(num_samples, 64, 64, 3))
+    for idx in xrange(num_samples):
+        out[idx] = read_celeba_image(
+            data_dir, '%.6d.jpg' % (idx + 1), crop_style)
+        if (idx + 1) % 10000 == 0:
+            logging.debug('Preprocessed %d/%d pictures' % (idx + 1, num_samples))
+    out.flush()
+    del out
+    os.rename(tmp_filename, filename)
+    return filename
+
+def read_guitars_image(data_dir, filename):
+    """Read a Thomann guitar picture as a (128, 128, 3) uint8 array.
+
+    """
+    im = Image.open(utils.o_gfile((data_dir, filename), 'rb'))
+    return np.array(im, dtype=np.uint8).reshape(128, 128, 3)
+
+# Decoded pictures buffer shared with the workers of DecodePool
+_shared_pictures = None
+
+def _init_decode_worker(shared):
+    global _shared_pictures
+    _shared_pictures = np.frombuffer(shared, dtype=np.uint8)
+
+def _decode_to_shared(task):
+    slot, reader, args = task
+    picture = reader(*args).ravel()
+    _shared_pictures[slot * picture.size:(slot + 1) * picture.size] = picture
+    return slot
+
+class DecodePool(object):
+    """Decodes pictures in a pool of worker processes.
+
+    Workers write the decoded uint8 pictures directly into a shared memory
+    buffer of buffer_bytes bytes, so that only the file names are pickled.
+    Longer lists of files are decoded in several rounds.
+
+    The pool is forked when created, so better create it before starting
+    any tensorflow sessions.
+    """
+
+    def __init__(self, num_workers, buffer_bytes=1024 * 64 * 64 * 3):
+        self.num_workers = num_workers
+        self._shared = multiprocessing.RawArray(ctypes.c_uint8, buffer_bytes)
+        self._buffer = np.frombuffer(self._shared, dtype=np.uint8)
+        self._pool = multiprocessing.Pool(
+            num_workers, _init_decode_worker, (self._shared,))
+        # The shared buffer can serve only one read at a time
+        self._lock = threading.Lock()
+
+    def map(self, reader, args_list, shape):
+        """Returns a uint8 array of the pictures reader(*args).
+
+        reader is a module level function returning uint8 pictures of the
+        given shape, so that it can be sent to the workers.
+        """
+        shape = tuple(shape)
+        picture_size = int(np.prod(shape))
+        capacity = len(self._buffer) / picture_size
+        assert capacity > 0, 'Pictures do not fit into the shared buffer'
+        pictures = self._buffer[:capacity * picture_size].reshape(
+            (capacity,) + shape)
+        res = np.empty((len(args_list),) + shape, dtype=np.uint8)
+        with self._lock:
+            for start in xrange(0, len(args_list), capacity):
+                chunk = args_list[start:start + capacity]
+                tasks = [(slot, reader, args)
+                         for slot, args in enumerate(chunk)]
+                chunksize = max(1, len(tasks) / (4 * self.num_workers))
+                self._pool.map(_decode_to_shared, tasks, chunksize)
+                res[start:start + len(chunk)] = pictures[:len(chunk)]
+        return res
+
+    def read(self, data_dir, filenames, crop_style):
+        """Returns a (len(filenames), 64, 64, 3) uint8 array of CelebA pictures.
+
+        """
+        return self.map(
+            read_celeba_image,
+            [(data_dir, filename, crop_style) for filename in filenames],
+            (64, 64, 3))
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+_decode_pools = {}
+
+def decode_pool(num_workers):
+    """Returns a DecodePool with num_workers processes, shared by all Data.
+
+    """
+    if num_workers not in _decode_pools:
+        _decode_pools[num_workers] = DecodePool(num_workers)
+    return _decode_pools[num_workers]
+
+class ImageCache(object):
+    """LRU cache of decoded pictures with a bound on the used memory.
+
+    Pictures are stored in one of the following formats:
+        float64     exactly what Data returns
+        float32     half of the memory, tiny loss of precision
+        uint8       1/8 of the memory, lossless for pictures decoded from
+                    8-bit files (e.g. JPEG), since they are just rescaled
+    If max_bytes is None the cache grows without bounds. Hits and misses
+    are counted and reported with logging every report_every lookups.
+    """
+
+    def __init__(self, normalize, max_bytes=None, dtype='float64',
+                 report_every=100000):
+        assert dtype in ('float64', 'float32', 'uint8'), \
+            'Unknown cache dtype %s' % dtype
+        self._normalize = normalize
+        self._max_bytes = max_bytes
+        self._dtype = dtype
+        self._report_every = report_every
+        self._points = collections.OrderedDict()
+        # Points may be read by a BatchPrefetcher thread and the main thread
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _to_storage(self, point):
+        if self._dtype == 'uint8':
+            if self._normalize:
+                point = point / 2. + 0.5
+            return np.round(point * 255.).astype(np.uint8)
+        return point.astype(self._dtype)
+
+    def _from_storage(self, stored):
+        if self._dtype == 'uint8':
+            point = stored / 255.
+            if self._normalize:
+                point = (point - 0.5) * 2.
+            return point
+        return stored.astype(np.float64)
+
+    def get(self, key):
+        """Returns the cached point or None, counting hits and misses.
+
+        """
+        if (self.hits + self.misses + 1) % self._report_every == 0:
+            self.log_stats()
+        with self._lock:
+            stored = self._points.pop(key, None)
+            if stored is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark as the most recently used
+            self._points[key] = stored
+        return self._from_storage(stored)
+
+    def put(self, key, point):
+        stored = self._to_storage(point)
+        if self._max_bytes is not None and stored.nbytes > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._points:
+                return
+            self._points[key] = stored
+            self.nbytes += stored.nbytes
+            while self._max_bytes is not None and \
+                    self.nbytes > self._max_bytes:
+                _, evicted = self._points.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def log_stats(self):
+        total = max(self.hits + self.misses, 1)
+        logging.debug(
+            'Image cache: %d points, %.1f MB, hits=%d (%.1f%%), misses=%d, '
+            'evictions=%d' % (len(self._points), self.nbytes / 2. ** 20,
+                              self.hits, 100. * self.hits / total,
+                              self.misses, self.evictions))
+
 
 class Data(object):
     """
     If the dataset can be quickly loaded to memory self.X will contain np.ndarray
-    Otherwise we will be reading files as we train. In this case self.X is a structure:
-        self.X.paths        list of paths to the files containing pictures
-        self.X.dict_loaded  dictionary of (key, val), where key is the index of the
-                            already loaded datapoint and val is the corresponding index
-                            in self.X.loaded
-        self.X.loaded       list containing already loaded pictures
+    stored in opts['data_dtype'] format:
+        float64             (default) exactly the points returned
+        float32             half of the memory
+        uint8               8-bit pictures, 1/8 of the memory of float64.
+                            Points are rescaled (and normalized if
+                            self.sym_normalized) on the fly when read
+    Points are returned as self.dtype, which is float32 unless
+    opts['data_dtype'] is float64. self.shape is the shape of all the points.
+    Otherwise we will be reading files as we train. In this case self.X is None and:
+        self.paths          list of paths to the files containing pictures
+        self.cache          ImageCache with the already loaded pictures. Its
+                            size in bytes is limited by opts['data_cache_bytes']
+                            (unlimited if None) and the storage format is
+                            given by opts['data_cache_dtype']. Every Data has
+                            its own cache, i.e. the training and test Data
+                            may use data_cache_bytes each
+        self.decode_pool    DecodePool decoding the cache misses of a minibatch
+                            in opts['data_decode_workers'] processes (None if
+                            the pictures are decoded in the calling thread)
+        self.preprocessed   memory-mapped uint8 array of all CelebA pictures
+                            written by preprocess_celeba.py (None if there is
+                            no such file). If present, self.cache is not used
     """
-    def __init__(self, opts, X, paths=None, dict_loaded=None, loaded=None):
+    def __init__(self, opts, X, paths=None, sym_normalized=None):
         """
-        X is either np.ndarray or paths
+        X is either np.ndarray or paths. uint8 arrays X contain 8-bit
+        pictures, which correspond to the points X / 255. If sym_normalized
+        is not None, X is already in the storage format (e.g. memory-mapped
+        from the dataset cache) and is used as it is.
         """
         data_dir = _data_dir(opts)
         self.X = None
         self.normalize = opts['input_normalize_sym']
         self.paths = None
-        self.dict_loaded = None
-        self.loaded = None
-        if isinstance(X, np.ndarray):
+        self.cache = None
+        self.preprocessed = None
+        self.decode_pool = None
+        self.storage_dtype = opts.get('data_dtype', 'float64')
+        assert self.storage_dtype in ('float64', 'float32', 'uint8'), \
+            'Unknown data dtype %s' % self.storage_dtype
+        self.dtype = np.float64 if self.storage_dtype == 'float64' \
+            else np.float32
+        self.sym_normalized = False
+        if isinstance(X, np.ndarray) and sym_normalized is not None:
+            assert X.dtype == np.dtype(self.storage_dtype), \
+                'Stored points have a wrong dtype'
             self.X = X
             self.shape = X.shape
+            self.sym_normalized = sym_normalized
+        elif isinstance(X, np.ndarray):
+            self.X = self._to_storage(X)
+            self.shape = X.shape
         else:
             assert isinstance(data_dir, str), 'Data directory not provided'
             assert paths is not None and len(paths) > 0, 'No paths provided for the data'
             self.data_dir = data_dir
             self.paths = paths[:]
-            self.dict_loaded = {} if dict_loaded is None else dict_loaded
-            self.loaded = [] if loaded is None else loaded
+            self.cache = ImageCache(
+                self.normalize,
+                max_bytes=opts.get('data_cache_bytes', None),
+                dtype=opts.get('data_cache_dtype', 'float64'))
             self.crop_style = opts['celebA_crop']
             self.dataset_name = opts['dataset']
-            self.shape = (len(self.paths), None, None, None)
+            # Only CelebA pictures are read from disk
+            self.shape = (len(self.paths), 64, 64, 3)
+            # Pictures preprocessed with preprocess_celeba.py are read from
+            # a memory-mapped file, which needs neither decoding nor cache.
+            preprocessed_file = celeba_preprocessed_file(
+                data_dir, self.crop_style)
+            if self.dataset_name == 'celebA' and \
+                    os.path.exists(preprocessed_file):
+                logging.debug('Using preprocessed %s' % preprocessed_file)
+                self.preprocessed = np.load(preprocessed_file, mmap_mode='r')
+                self.rows = np.array(
+                    [int(os.path.splitext(path)[0]) - 1 for path in self.paths])
+                self.cache = None
+            elif self.dataset_name == 'celebA' and \
+                    opts.get('data_decode_workers', 0) > 0:
+                self.decode_pool = decode_pool(opts['data_decode_workers'])
 
     def __len__(self):
         if isinstance(self.X, np.ndarray):
@@ -124,76 +514,145 @@ class Data(object):
             return len(self.paths)
     def __getitem__(self, key):
         if isinstance(self.X, np.ndarray):
-            return self.X[key]
+            return self._from_storage(self.X[key])
+        # Our dataset was too large to fit in the memory, so we support the
+        # numpy indexing along the first axis, optionally followed by
+        # indices of the other axes.
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        ids = self._point_ids(key)
+        # Every point is read only once, even if requested several times
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        if len(unique_ids) == 0:
+            points = np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        elif self.preprocessed is not None:
+            points = self._read_preprocessed(unique_ids)
         else:
-            # Our dataset was too large to fit in the memory
-            if isinstance(key, int):
-                keys = [key]
-            elif isinstance(key, list):
-                keys = key
-            elif isinstance(key, np.ndarray):
-                keys = list(key)
-            elif isinstance(key, slice):
-                start = key.start
-                stop = key.stop
-                step = key.step
-                start = start if start is not None else 0
-                if start < 0:
-                    start += len(self.paths)
-                stop = stop if stop is not None else len(self.paths) - 1
-                if stop < 0:
-                    stop += len(self.paths)
-                step = step if step is not None else 1
-                keys = range(start, stop, step)
+            points = self._read_points(unique_ids)
+        points = points[inverse].reshape(ids.shape + points.shape[1:])
+        if rest:
+            points = points[(slice(None),) * ids.ndim + rest]
+        return points
+
+    def _point_ids(self, key):
+        """Converts a numpy index of the points into an array of their ids.
+
+        """
+        num = len(self.paths)
+        if isinstance(key, slice):
+            return np.arange(*key.indices(num))
+        key = np.asarray(key)
+        if key.dtype == np.bool_:
+            if key.shape != (num,):
+                raise IndexError(
+                    'Boolean index of shape %s for %d points' % (
+                        key.shape, num))
+            return np.nonzero(key)[0]
+        if key.size == 0:
+            return np.zeros(key.shape, dtype=np.int64)
+        if key.dtype.kind not in 'iu':
+            raise IndexError('Only integers, slices and integer or boolean '
+                             'arrays are valid indices')
+        if np.any(key >= num) or np.any(key < -num):
+            raise IndexError('Index out of bounds for %d points' % num)
+        return np.where(key < 0, key + num, key)
+
+    def iter_batches(self, batch_size):
+        """Iterate over the dataset in consecutive chunks of batch_size points.
+
+        Points read from disk are not added to the cache, so that at most
+        one chunk of decoded pictures is kept in memory at a time.
+        """
+        num = len(self)
+        for start in xrange(0, num, batch_size):
+            stop = min(start + batch_size, num)
+            if isinstance(self.X, np.ndarray):
+                yield self._from_storage(self.X[start:stop])
+            elif self.preprocessed is not None:
+                yield self._read_preprocessed(xrange(start, stop))
             else:
-                print type(key)
-                raise Exception('This type of indexing yet not supported for the dataset')
-            res = []
-            new_keys = []
-            new_points = []
-            for key in keys:
-                if key in self.dict_loaded:
-                    idx = self.dict_loaded[key]
-                    res.append(self.loaded[idx])
-                else:
-                    if self.dataset_name == 'celebA':
-                        point = self._read_celeba_image(self.data_dir, self.paths[key])
-                    else:
-                        raise Exception('Disc read for this dataset not implemented yet...')
-                    if self.normalize:
-                        point = (point - 0.5) * 2.
-                    res.append(point)
-                    new_points.append(point)
-                    new_keys.append(key)
-            n = len(self.loaded)
-            cnt = 0
-            for key in new_keys:
-                self.dict_loaded[key] = n + cnt
-                cnt += 1
-            self.loaded.extend(new_points)
-            return np.array(res)
+                yield self._read_points(range(start, stop), fill_cache=False)
+
+    def _to_storage(self, X):
+        if X.dtype == np.uint8:
+            if self.storage_dtype == 'uint8':
+                return X
+            X = X.astype(self.dtype)
+            X /= 255.
+            return X
+        if self.storage_dtype == 'uint8':
+            raise ValueError('Only 8-bit pictures can be stored as uint8')
+        return X.astype(self.dtype)
+
+    def _from_storage(self, X):
+        if self.storage_dtype != 'uint8':
+            return X
+        X = X.astype(np.float32) / np.float32(255.)
+        if self.sym_normalized:
+            X = (X - np.float32(0.5)) * np.float32(2.)
+        return X
+
+    def normalize_sym(self):
+        """Normalize the in-memory points from [0, 1] to [-1, 1].
 
-    def _read_celeba_image(self, data_dir, filename):
-        width = 178
-        height = 218
-        new_width = 140
-        new_height = 140
-        im = Image.open(utils.o_gfile((data_dir, filename), 'rb'))
-        if self.crop_style == 'closecrop':
-            # This method was used in DCGAN, pytorch-gan-collection, AVB, ...
-            left = (width - new_width) / 2
-            top = (height - new_height) / 2
-            right = (width + new_width) / 2
-            bottom = (height + new_height)/2
-            im = im.crop((left, top, right, bottom))
-            im = im.resize((64, 64), PIL.Image.ANTIALIAS)
-        elif self.crop_style == 'resizecrop':
-            # This method was used in ALI, AGE, ...
-            im = im.resize((64, 78), PIL.Image.ANTIALIAS)
-            im = im.crop((0, 7, 64, 64 + 7))
+        """
+        if self.storage_dtype != 'uint8':
+            # self.X is our own copy, so we can avoid the temporary arrays
+            self.X -= 0.5
+            self.X *= 2.
+        self.sym_normalized = True
+
+    @property
+    def nbytes(self):
+        """Memory taken by the in-memory points (0 if read from disk).
+
+        """
+        if isinstance(self.X, np.ndarray):
+            return self.X.nbytes
+        return 0
+
+    def _read_points(self, keys, fill_cache=True):
+        """Reads points through the cache, decoding all misses at once.
+
+        """
+        res = [self.cache.get(key) for key in keys]
+        missing = [idx for idx, point in enumerate(res) if point is None]
+        if self.decode_pool is not None and len(missing) > 1:
+            pictures = self.decode_pool.read(
+                self.data_dir, [self.paths[keys[idx]] for idx in missing],
+                self.crop_style)
+            points = [self._from_uint8(picture) for picture in pictures]
         else:
-            raise Exception('Unknown crop style specified')
-        return np.array(im).reshape(64, 64, 3) / 255.
+            points = [self._read_point(keys[idx]) for idx in missing]
+        for idx, point in zip(missing, points):
+            if fill_cache:
+                self.cache.put(keys[idx], point)
+            res[idx] = point
+        return np.array(res, dtype=self.dtype)
+
+    def _read_preprocessed(self, keys):
+        rows = self.rows[np.asarray(keys, dtype=np.int64)]
+        return self._from_uint8(self.preprocessed[rows]).astype(
+            self.dtype, copy=False)
+
+    def _from_uint8(self, pictures):
+        points = pictures / 255.
+        if self.normalize:
+            points = (points - 0.5) * 2.
+        return points
+
+    def _read_point(self, key):
+        if self.dataset_name == 'celebA':
+            point = self._read_celeba_image(self.data_dir, self.paths[key])
+        else:
+            raise Exception('Disc read for this dataset not implemented yet...')
+        if self.normalize:
+            point = (point - 0.5) * 2.
+        return point
+
+    def _read_celeba_image(self, data_dir, filename):
+        return read_celeba_image(data_dir, filename, self.crop_style) / 255.
 
 class DataHandler(object):
     """A class storing and manipulating the dataset.
@@ -212,12 +671,29 @@ class DataHandler(object):
         self.test_data = None
         self.labels = None
         self.test_labels = None
+        # Stream for the randomly generated datasets
+        self._random = utils.random_state(opts, 'data')
         self._load_data(opts)
 
     def _load_data(self, opts):
         """Load a dataset and fill all the necessary variables.
 
         """
+        sym_applicable = ['mnist',
+                          'dsprites',
+                          'mnist3',
+                          'guitars',
+                          'cifar10',
+                          'celebA']
+
+        if opts['input_normalize_sym'] and opts['dataset'] not in sym_applicable:
+            raise Exception('Can not normalyze this dataset')
+
+        cache_dir = dataset_cache_dir(opts)
+        if cache_dir is not None and os.path.isdir(cache_dir):
+            self._load_cached(opts, cache_dir)
+            return
+
         if opts['dataset'] == 'mnist':
             self._load_mnist(opts)
         elif opts['dataset'] == 'dsprites':
@@ -241,22 +717,65 @@ class DataHandler(object):
         else:
             raise ValueError('Unknown %s' % opts['dataset'])
 
-        sym_applicable = ['mnist',
-                          'dsprites',
-                          'mnist3',
-                          'guitars',
-                          'cifar10',
-                          'celebA']
-
-        if opts['input_normalize_sym'] and opts['dataset'] not in sym_applicable:
-            raise Exception('Can not normalyze this dataset')
-
         if opts['input_normalize_sym'] and opts['dataset'] in sym_applicable:
             # Normalize data to [-1, 1]
             if isinstance(self.data.X, np.ndarray):
-                self.data.X = (self.data.X - 0.5) * 2.
+                self.data.normalize_sym()
             # Else we will normalyze while reading from disk
 
+        data_bytes = self.data.nbytes
+        if self.test_data is not None:
+            data_bytes += self.test_data.nbytes
+        logging.debug('Dataset stored as %s takes %.1f MB in memory' % (
+            self.data.storage_dtype, data_bytes / 2. ** 20))
+
+        if cache_dir is not None:
+            self._save_cached(cache_dir)
+
+    def _save_cached(self, cache_dir):
+        """Write the loaded dataset to the dataset cache.
+
+        Files are written to a temporary directory, which is then renamed, so
+        that concurrently started processes never see a partial cache.
+        """
+        tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+        utils.create_dir(tmp_dir)
+        arrays = {'data': self.data.X, 'labels': self.labels}
+        if self.test_data is not None:
+            arrays['test_data'] = self.test_data.X
+            arrays['test_labels'] = self.test_labels
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        try:
+            os.rename(tmp_dir, cache_dir)
+            logging.debug('Saved the dataset cache to %s' % cache_dir)
+        except OSError:
+            # Another process has already written the cache
+            shutil.rmtree(tmp_dir)
+
+    def _load_cached(self, opts, cache_dir):
+        """Memory-map the dataset written by _save_cached.
+
+        """
+        logging.debug('Loading the dataset cache from %s' % cache_dir)
+        opts = dict(opts, data_dtype=_data_dtype(opts))
+        def load(name):
+            path = os.path.join(cache_dir, name + '.npy')
+            if not os.path.exists(path):
+                return None
+            return np.load(path, mmap_mode='r')
+        self.data = Data(opts, load('data'),
+                         sym_normalized=opts['input_normalize_sym'])
+        self.labels = load('labels')
+        if load('test_data') is not None:
+            # As in _load_data, only the training points are normalized
+            self.test_data = Data(opts, load('test_data'),
+                                  sym_normalized=False)
+            self.test_labels = load('test_labels')
+        self.data_shape = self.data.shape[1:]
+        self.num_points = len(self.data)
+        logging.debug('Loading Done.')
 
     def _load_mog(self, opts):
         """Sample data from the mixture of Gaussians on circle.
@@ -269,21 +788,14 @@ class DataHandler(object):
         # First we choose parameters of gmm and thus seed
         radius = opts['gmm_max_val']
         modes_num = opts["gmm_modes_num"]
-        np.random.seed(opts["random_seed"])
 
         thetas = np.linspace(0, 2 * np.pi, modes_num)
         mixture_means = np.stack((radius * np.sin(thetas), radius * np.cos(thetas)), axis=1)
         mixture_variance = 0.01
 
-        # Now we sample points, for that we unseed
-        np.random.seed()
+        # Now we sample points from the unseeded data stream
         num = opts['toy_dataset_size']
-        X = np.zeros((num, opts['toy_dataset_dim'], 1, 1))
-        for idx in xrange(num):
-            comp_id = np.random.randint(modes_num)
-            mean = mixture_means[comp_id]
-            cov = mixture_variance * np.identity(opts["toy_dataset_dim"])
-            X[idx, :, 0, 0] = np.random.multivariate_normal(mean, cov, 1)
+        X = sample_gmm(mixture_means, mixture_variance, num, self._random)
 
         self.data_shape = (opts['toy_dataset_dim'], 1, 1)
         self.data = Data(opts, X)
@@ -297,9 +809,8 @@ class DataHandler(object):
         logging.debug('Loading GMM dataset...')
         # First we choose parameters of gmm and thus seed
         modes_num = opts["gmm_modes_num"]
-        np.random.seed(opts["random_seed"])
         max_val = opts['gmm_max_val']
-        mixture_means = np.random.uniform(
+        mixture_means = np.random.RandomState(opts["random_seed"]).uniform(
             low=-max_val, high=max_val,
             size=(modes_num, opts['toy_dataset_dim']))
 
@@ -314,15 +825,9 @@ class DataHandler(object):
         mixture_variance = \
                 max_val / variance_factor(modes_num, opts['toy_dataset_dim'])
 
-        # Now we sample points, for that we unseed
-        np.random.seed()
+        # Now we sample points from the unseeded data stream
         num = opts['toy_dataset_size']
-        X = np.zeros((num, opts['toy_dataset_dim'], 1, 1))
-        for idx in xrange(num):
-            comp_id = np.random.randint(modes_num)
-            mean = mixture_means[comp_id]
-            cov = mixture_variance * np.identity(opts["toy_dataset_dim"])
-            X[idx, :, 0, 0] = np.random.multivariate_normal(mean, cov, 1)
+        X = sample_gmm(mixture_means, mixture_variance, num, self._random)
 
         self.data_shape = (opts['toy_dataset_dim'], 1, 1)
         self.data = Data(opts, X)
@@ -336,23 +841,26 @@ class DataHandler(object):
         """
         logging.debug('Loading Guitars dataset')
         data_dir = os.path.join('./', 'thomann')
-        X = None
         files = utils.listdir(data_dir)
-        pics = []
-        for f in sorted(files):
-            if '.jpg' in f and f[0] != '.':
-                im = Image.open(utils.o_gfile((data_dir, f), 'rb'))
-                res = np.array(im.getdata()).reshape(128, 128, 3)
-                pics.append(res)
-        X = np.array(pics)
-
-        seed = 123
-        np.random.seed(seed)
-        np.random.shuffle(X)
-        np.random.seed()
+        filenames = [f for f in sorted(files) if '.jpg' in f and f[0] != '.']
+        num_workers = opts.get('data_decode_workers', 0)
+        if num_workers > 0:
+            pool = DecodePool(num_workers)
+            X = pool.map(read_guitars_image,
+                         [(data_dir, f) for f in filenames], (128, 128, 3))
+            pool.close()
+        else:
+            X = np.empty((len(filenames), 128, 128, 3), dtype=np.uint8)
+            for idx, f in enumerate(filenames):
+                X[idx] = read_guitars_image(data_dir, f)
+
+        seed = SHUFFLE_SEED
+        np.random.RandomState(seed).shuffle(X)
 
         self.data_shape = (128, 128, 3)
-        self.data = Data(opts, X/255.)
+        # Unless asked otherwise keep the 8-bit pictures in uint8
+        opts = dict(opts, data_dtype=_data_dtype(opts))
+        self.data = Data(opts, X)
         self.num_points = len(X)
 
         logging.debug('Loading Done.')
@@ -372,16 +880,18 @@ class DataHandler(object):
 
         data_file = os.path.join(data_dir, 'dsprites.npz')
         X = np.load(data_file)['imgs']
-        X = X[:, :, :, None]
+        # Pixels are 0 or 1, turn them into 8-bit pictures for Data
+        X = X[:, :, :, None] * np.uint8(255)
 
-        seed = 123
-        np.random.seed(seed)
-        np.random.shuffle(X)
-        np.random.seed()
+        seed = SHUFFLE_SEED
+        np.random.RandomState(seed).shuffle(X)
 
         self.data_shape = (64, 64, 1)
         test_size = 10000
 
+        # The dataset is huge, so unless asked otherwise keep it in uint8
+        # as it used to be before data_dtype was introduced
+        opts = dict(opts, data_dtype=_data_dtype(opts))
         self.data = Data(opts, X[:-test_size])
         self.test_data = Data(opts, X[-test_size:])
         self.num_points = len(self.data)
@@ -408,7 +918,7 @@ class DataHandler(object):
 
         with utils.o_gfile((data_dir, 'train-images-idx3-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
-            tr_X = loaded[16:].reshape((60000, 28, 28, 1)).astype(np.float)
+            tr_X = loaded[16:].reshape((60000, 28, 28, 1))
 
         with utils.o_gfile((data_dir, 'train-labels-idx1-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
@@ -416,7 +926,7 @@ class DataHandler(object):
 
         with utils.o_gfile((data_dir, 't10k-images-idx3-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
-            te_X = loaded[16:].reshape((10000, 28, 28, 1)).astype(np.float)
+            te_X = loaded[16:].reshape((10000, 28, 28, 1))
 
         with utils.o_gfile((data_dir, 't10k-labels-idx1-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
@@ -427,34 +937,24 @@ class DataHandler(object):
 
         X = np.concatenate((tr_X, te_X), axis=0)
         y = np.concatenate((tr_Y, te_Y), axis=0)
-        X = X / 255.
 
-        seed = 123
-        np.random.seed(seed)
-        np.random.shuffle(X)
-        np.random.seed(seed)
-        np.random.shuffle(y)
-        np.random.seed()
+        seed = SHUFFLE_SEED
+        np.random.RandomState(seed).shuffle(X)
+        np.random.RandomState(seed).shuffle(y)
 
         self.data_shape = (28, 28, 1)
         test_size = 10000
 
         if modified:
+            X = X / 255.
             self.original_mnist = X
             n = opts['toy_dataset_size']
             n += test_size
-            points = []
-            labels = []
-            for _ in xrange(n):
-                idx = np.random.randint(len(X))
-                point = X[idx]
-                modes = ['n', 'i', 'sl', 'sr', 'su', 'sd']
-                mode = modes[np.random.randint(len(modes))]
-                point = transform_mnist(point, mode)
-                points.append(point)
-                labels.append(y[idx])
-            X = np.array(points)
-            y = np.array(y)
+            ids = self._random.randint(len(X), size=n)
+            modes = np.array(MNIST_MODES)[
+                self._random.randint(len(MNIST_MODES), size=n)]
+            X = transform_mnist_batch(X[ids], modes, self._random)
+            y = y[ids]
         self.data = Data(opts, X[:-test_size])
         self.test_data = Data(opts, X[-test_size:])
         self.labels = y[:-test_size]
@@ -478,7 +978,7 @@ class DataHandler(object):
 
         with utils.o_gfile((data_dir, 'train-images-idx3-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
-            tr_X = loaded[16:].reshape((60000, 28, 28, 1)).astype(np.float)
+            tr_X = loaded[16:].reshape((60000, 28, 28, 1))
 
         with utils.o_gfile((data_dir, 'train-labels-idx1-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
@@ -486,7 +986,7 @@ class DataHandler(object):
 
         with utils.o_gfile((data_dir, 't10k-images-idx3-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
-            te_X = loaded[16:].reshape((10000, 28, 28, 1)).astype(np.float)
+            te_X = loaded[16:].reshape((10000, 28, 28, 1))
 
         with utils.o_gfile((data_dir, 't10k-labels-idx1-ubyte'), 'rb') as fd:
             loaded = np.frombuffer(fd.read(), dtype=np.uint8)
@@ -499,29 +999,16 @@ class DataHandler(object):
         y = np.concatenate((tr_Y, te_Y), axis=0)
 
         num = opts['mnist3_dataset_size']
-        ids = np.random.choice(len(X), (num, 3), replace=True)
+        ids = self._random.choice(len(X), (num, 3), replace=True)
+        X3, y3 = stack_mnist3(X, y, ids, opts['mnist3_to_channels'])
         if opts['mnist3_to_channels']:
-            # Concatenate 3 digits ito 3 channels
-            X3 = np.zeros((num, 28, 28, 3))
-            y3 = np.zeros(num)
-            for idx, _id in enumerate(ids):
-                X3[idx, :, :, 0] = np.squeeze(X[_id[0]], axis=2)
-                X3[idx, :, :, 1] = np.squeeze(X[_id[1]], axis=2)
-                X3[idx, :, :, 2] = np.squeeze(X[_id[2]], axis=2)
-                y3[idx] = y[_id[0]] * 100 + y[_id[1]] * 10 + y[_id[2]]
+            # 3 digits are concatenated into 3 channels
             self.data_shape = (28, 28, 3)
         else:
-            # Concatenate 3 digits in width
-            X3 = np.zeros((num, 28, 3 * 28, 1))
-            y3 = np.zeros(num)
-            for idx, _id in enumerate(ids):
-                X3[idx, :, 0:28, 0] = np.squeeze(X[_id[0]], axis=2)
-                X3[idx, :, 28:56, 0] = np.squeeze(X[_id[1]], axis=2)
-                X3[idx, :, 56:84, 0] = np.squeeze(X[_id[2]], axis=2)
-                y3[idx] = y[_id[0]] * 100 + y[_id[1]] * 10 + y[_id[2]]
+            # 3 digits are concatenated in width
             self.data_shape = (28, 28 * 3, 1)
 
-        self.data = Data(opts, X3/255.)
+        self.data = Data(opts, X3)
         y3 = y3.astype(int)
         self.labels = y3
         self.num_points = num
@@ -555,15 +1042,11 @@ class DataHandler(object):
         x_test = x_test.transpose(0, 2, 3, 1)
 
         X = np.vstack([x_train, x_test])
-        X = X/255.
         y = np.vstack([y_train, y_test])
 
-        seed = 123
-        np.random.seed(seed)
-        np.random.shuffle(X)
-        np.random.seed(seed)
-        np.random.shuffle(y)
-        np.random.seed()
+        seed = SHUFFLE_SEED
+        np.random.RandomState(seed).shuffle(X)
+        np.random.RandomState(seed).shuffle(y)
 
         self.data_shape = (32, 32, 3)
 
@@ -580,15 +1063,14 @@ class DataHandler(object):
         """
         logging.debug('Loading CelebA dataset')
 
-        num_samples = 202599
+        num_samples = CELEBA_NUM_SAMPLES
 
         datapoint_ids = range(1, num_samples + 1)
         paths = ['%.6d.jpg' % i for i in xrange(1, num_samples + 1)]
-        seed = 123
-        random.seed(seed)
-        random.shuffle(paths)
-        random.shuffle(datapoint_ids)
-        random.seed()
+        seed = SHUFFLE_SEED
+        shuffler = random.Random(seed)
+        shuffler.shuffle(paths)
+        shuffler.shuffle(datapoint_ids)
 
         saver = ArraySaver('disk', workdir=opts['work_dir'])
         saver.save('shuffled_training_ids', datapoint_ids)
@@ -0,0 +1,286 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Tests of the datasets and of the lazily loaded Data.
+
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+import datahandler
+import testutils
+
+
+class SampleGmmTest(tf.test.TestCase):
+
+    def testSameAsLoop(self):
+        # With the same seed sample_gmm returns the points of the loop
+        random = np.random.RandomState(0)
+        for dim in [2, 10]:
+            for modes_num in [1, 3, 10]:
+                means = random.uniform(-15, 15, size=(modes_num, dim))
+                variance = random.uniform(0.01, 5.)
+                expected = testutils.sample_gmm_loop(
+                    means, variance, 1000, np.random.RandomState(821))
+                result = datahandler.sample_gmm(
+                    means, variance, 1000, np.random.RandomState(821))
+                self.assertAllClose(result, expected, rtol=0, atol=1e-12)
+
+
+class MnistTest(tf.test.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self._X = random.randint(256, size=(1000, 28, 28, 1)).astype(np.uint8)
+        self._y = random.randint(10, size=1000)
+        self._random = random
+
+    def testStackMnist3(self):
+        ids = self._random.choice(len(self._X), (500, 3), replace=True)
+        for to_channels in [False, True]:
+            expected = testutils.stack_mnist3_loop(
+                self._X, self._y, ids, to_channels)
+            result = datahandler.stack_mnist3(
+                self._X, self._y, ids, to_channels)
+            self.assertAllEqual(result[0], expected[0])
+            self.assertAllEqual(result[1], expected[1])
+
+    def testTransformMnistShifts(self):
+        # Every shifted picture is one of the shifts by 3 to 7 pixels
+        # transform_mnist makes, and every shift is drawn
+        X = self._X[:100] / 255.
+        # Seeds making transform_mnist shift by 3, ..., 7 pixels
+        seeds = {}
+        seed = 0
+        while len(seeds) < 5:
+            seeds.setdefault(np.random.RandomState(seed).randint(5), seed)
+            seed += 1
+        state = np.random.get_state()
+        for mode in ['i', 'sl', 'sr', 'su', 'sd']:
+            result = datahandler.transform_mnist_batch(
+                X, np.array([mode] * len(X)), self._random)
+            matches = np.zeros((len(X), 5), dtype=bool)
+            for shift, seed in seeds.items():
+                for idx in xrange(len(X)):
+                    np.random.seed(seed)
+                    matches[idx, shift] = np.array_equal(
+                        result[idx], datahandler.transform_mnist(X[idx], mode))
+            self.assertTrue(np.all(np.any(matches, axis=1)), mode)
+            if mode != 'i':
+                self.assertTrue(np.all(np.any(matches, axis=0)), mode)
+        np.random.set_state(state)
+
+    def testTransformMnistNoise(self):
+        X = self._X[self._random.randint(len(self._X), size=2000)] / 255.
+        ids = np.arange(len(X))
+        modes = np.array(['n'] * len(X))
+        expected = testutils.transform_mnist_loop(X, ids, modes)
+        result = datahandler.transform_mnist_batch(X, modes, self._random)
+        self.assertNear(np.mean(result), np.mean(expected), 0.01)
+        self.assertNear(np.std(result), np.std(expected), 0.01)
+
+
+class DatasetCacheTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._cache_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_root)
+
+    def _opts(self, **kwargs):
+        opts = {'dataset': 'zalando', 'data_dir': self._cache_root,
+                'input_normalize_sym': False, 'data_dtype': 'float32',
+                'dataset_cache_dir': self._cache_root}
+        opts.update(kwargs)
+        return opts
+
+    def testCacheHit(self):
+        opts = self._opts()
+        cache_dir = datahandler.dataset_cache_dir(opts)
+        os.makedirs(cache_dir)
+        points = np.random.RandomState(0).rand(10, 28, 28, 1)
+        np.save(os.path.join(cache_dir, 'data.npy'), points.astype('float32'))
+        data = datahandler.DataHandler(opts)
+        self.assertEqual(data.num_points, 10)
+        self.assertAllClose(data.data[:], points)
+
+    def testCacheHitChecksOptions(self):
+        # zalando can not be normalized, with or without a cache
+        opts = self._opts(input_normalize_sym=True)
+        cache_dir = datahandler.dataset_cache_dir(opts)
+        os.makedirs(cache_dir)
+        np.save(os.path.join(cache_dir, 'data.npy'),
+                np.zeros((10, 28, 28, 1), dtype='float32'))
+        with self.assertRaisesRegexp(Exception, 'Can not normalyze'):
+            datahandler.DataHandler(opts)
+
+
+def _write_pictures(data_dir, filenames, size, seed=0):
+    """Writes random RGB JPEGs of the given (width, height)."""
+    random = np.random.RandomState(seed)
+    for filename in filenames:
+        picture = random.randint(256, size=(size[1], size[0], 3))
+        Image.fromarray(picture.astype(np.uint8)).save(
+            os.path.join(data_dir, filename))
+
+
+class LazyDataTest(tf.test.TestCase):
+    """Data reading CelebA pictures from disk against the eager array."""
+
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        # The last test point is not in a full minibatch of iter_batches
+        self._paths = ['%.6d.jpg' % idx for idx in xrange(1, 12)]
+        _write_pictures(self._data_dir, self._paths, (178, 218))
+        self._eager = np.array(
+            [datahandler.read_celeba_image(
+                self._data_dir, path, 'closecrop') / 255.
+             for path in self._paths])
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def _data(self, **kwargs):
+        opts = {'dataset': 'celebA', 'data_dir': self._data_dir,
+                'input_normalize_sym': False, 'celebA_crop': 'closecrop'}
+        opts.update(kwargs)
+        return datahandler.Data(opts, None, self._paths)
+
+    def testIndexing(self):
+        data = self._data()
+        num = len(self._paths)
+        mask = np.arange(num) % 3 == 0
+        keys = [3, -1, np.int64(-num), slice(2, 7), slice(None, None, -2),
+                slice(-3, None), [1, 1, 4], np.array([-2, 0]),
+                np.array([[0, 5], [5, 10]]), mask, [], np.array([], int),
+                (slice(0, 4), 10, 20), (np.array([1, 2]), slice(None), 3),
+                (-1, 0, 0, 1)]
+        for key in keys:
+            expected = self._eager[key]
+            result = data[key]
+            self.assertEqual(result.shape, expected.shape, msg=str(key))
+            self.assertAllClose(result, expected, msg=str(key))
+
+    def testIndexErrors(self):
+        data = self._data()
+        num = len(self._paths)
+        for key in [num, -num - 1, [0, num], np.array([0.5]),
+                    np.ones(num - 1, dtype=bool)]:
+            with self.assertRaises(IndexError, msg=str(key)):
+                data[key]
+
+    def testIterBatches(self):
+        data = self._data()
+        batches = list(data.iter_batches(4))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 3])
+        self.assertAllClose(np.concatenate(batches), self._eager)
+        # The pictures read in chunks are not cached
+        self.assertEqual(len(data.cache), 0)
+
+    def testCache(self):
+        # Every picture takes 64 * 64 * 3 bytes as uint8
+        data = self._data(data_cache_bytes=3 * 64 * 64 * 3,
+                          data_cache_dtype='uint8')
+        self.assertAllClose(data[[0, 1, 2, 3]], self._eager[:4])
+        self.assertEqual(len(data.cache), 3)
+        self.assertLessEqual(data.cache.nbytes, 3 * 64 * 64 * 3)
+        # 8-bit pictures are stored losslessly
+        self.assertAllClose(data[[1, 2, 3]], self._eager[1:4])
+        self.assertEqual(data.cache.hits, 3)
+
+    def testDecodeWorkers(self):
+        data = self._data(data_decode_workers=2)
+        self.assertIsNotNone(data.decode_pool)
+        self.assertAllClose(data[::-1], self._eager[::-1])
+        self.assertAllClose(np.concatenate(list(data.iter_batches(4))),
+                            self._eager)
+
+    def testPreprocessed(self):
+        datahandler.preprocess_celeba(
+            self._data_dir, 'closecrop', len(self._paths))
+        data = self._data()
+        self.assertIsNotNone(data.preprocessed)
+        self.assertAllClose(data[[5, -1, 5]], self._eager[[5, -1, 5]])
+        self.assertAllClose(np.concatenate(list(data.iter_batches(4))),
+                            self._eager)
+
+
+class ImageCacheTest(tf.test.TestCase):
+
+    def _point(self, value):
+        return value * np.ones((4, 4, 3)) / 255.
+
+    def testLruEviction(self):
+        point_bytes = self._point(0).nbytes
+        cache = datahandler.ImageCache(False, max_bytes=2 * point_bytes)
+        cache.put(0, self._point(0))
+        cache.put(1, self._point(1))
+        # Reading 0 makes 1 the least recently used point
+        self.assertAllEqual(cache.get(0), self._point(0))
+        cache.put(2, self._point(2))
+        self.assertEqual(sorted(cache._points.keys()), [0, 2])
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.nbytes, 2 * point_bytes)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (1, 1, 1))
+
+    def testByteBudget(self):
+        # A point larger than the whole budget is not stored at all
+        cache = datahandler.ImageCache(False, max_bytes=100)
+        cache.put(0, self._point(0))
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+        # Unbounded cache
+        cache = datahandler.ImageCache(False)
+        for key in xrange(10):
+            cache.put(key, self._point(key))
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.nbytes, 10 * self._point(0).nbytes)
+
+    def testStorageDtypes(self):
+        for dtype, point_bytes in [('float64', 384), ('float32', 192),
+                                   ('uint8', 48)]:
+            for normalize in [False, True]:
+                cache = datahandler.ImageCache(normalize, dtype=dtype)
+                point = self._point(77)
+                if normalize:
+                    point = (point - 0.5) * 2.
+                cache.put(0, point)
+                self.assertEqual(cache.nbytes, point_bytes)
+                self.assertAllClose(cache.get(0), point, atol=1e-6)
+
+
+class DecodePoolTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        self._filenames = ['%d.jpg' % idx for idx in xrange(7)]
+        _write_pictures(self._data_dir, self._filenames, (128, 128))
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def testSameAsSerial(self):
+        expected = np.array(
+            [datahandler.read_guitars_image(self._data_dir, filename)
+             for filename in self._filenames])
+        # The buffer holds 3 pictures, so they are decoded in 3 rounds
+        pool = datahandler.DecodePool(2, buffer_bytes=3 * 128 * 128 * 3)
+        try:
+            result = pool.map(
+                datahandler.read_guitars_image,
+                [(self._data_dir, filename) for filename in self._filenames],
+                (128, 128, 3))
+        finally:
+            pool.close()
+        self.assertEqual(result.dtype, np.uint8)
+        self.assertAllEqual(result, expected)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -207,8 +207,8 @@ def main():
                 train_ids = shuffled_ids[:-exp.test_size]
                 train_images = data.data
             else:
-                test_images = data.test_data.X
-                train_images = data.data.X
+                test_images = data.test_data
+                train_images = data.data
                 train_ids = range(len(train_images))
                 test_ids = range(len(test_images))
             if SAVE_PNG:
@@ -15,6 +15,21 @@ import numpy as np
 import ops
 from metrics import Metrics
 
+def _gan_losses(d_logits_real, d_logits_fake):
+    """Returns the discriminator and generator losses of a vanilla GAN.
+
+    """
+    d_loss_real = tf.reduce_mean(
+        tf.nn.sigmoid_cross_entropy_with_logits(
+            logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
+    d_loss_fake = tf.reduce_mean(
+        tf.nn.sigmoid_cross_entropy_with_logits(
+            logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
+    g_loss = tf.reduce_mean(
+        tf.nn.sigmoid_cross_entropy_with_logits(
+            logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
+    return d_loss_real + d_loss_fake, g_loss
+
 class Gan(object):
     """A base class for running individual GANs.
 
@@ -32,15 +47,27 @@ class Gan(object):
         self._data = data
         self._data_weights = np.copy(weights)
         # Latent noise sampled ones to apply G while training
-        self._noise_for_plots = utils.generate_noise(opts, 500)
+        self._noise_for_plots = utils.generate_noise(
+            opts, 500, utils.random_state(opts, 'plots'))
         # Placeholders
         self._real_points_ph = None
         self._fake_points_ph = None
         self._noise_ph = None
         self._inv_target_ph = None
+        self._inv_active_ph = None
+        self._real_points_stack_ph = None
+        self._noise_stack_ph = None
+        # Init ops
+        self._additional_init_ops = []
+        self._init_feed_dict = {}
+        self._inv_init = None
+        # Ops loading the dataset into the graph, see ops.data_placeholder
+        self._data_init_ops = []
+        self._data_init_feed_dict = {}
 
         # Main operations
         self._G = None # Generator function
+        self._export_G = None # Its inference copy, see export_generator
         self._d_loss = None # Loss of discriminator
         self._g_loss = None # Loss of generator
         self._c_loss = None # Loss of mixture discriminator
@@ -56,10 +83,15 @@ class Gan(object):
         self._d_optim = None
         self._c_optim = None
         self._inv_optim = None
+        self._fused_optim = None
 
         with self._session.as_default(), self._session.graph.as_default():
             logging.debug('Building the graph...')
-            self._build_model_internal(opts)
+            # The fused training steps read the variables in a while loop,
+            # which sees their updates only for resource variables
+            with tf.variable_scope(tf.get_variable_scope(),
+                                   use_resource=opts.get('fused_steps', 1) > 1):
+                self._build_model_internal(opts)
             if opts['inverse_metric']:
                 assert opts['dataset'] in ('mnist', 'mnist3', 'guitars'),\
                     'Invertion currently supported only for mnist, mnist3, guitars'
@@ -68,8 +100,10 @@ class Gan(object):
 
         # Make sure AdamOptimizer, if used in the Graph, is defined before
         # calling global_variables_initializer().
-        init = tf.global_variables_initializer()
-        self._session.run(init)
+        self._init = tf.global_variables_initializer()
+        self._session.run(self._init)
+        self._session.run(self._additional_init_ops, self._init_feed_dict)
+        self._session.run(self._data_init_ops, self._data_init_feed_dict)
 
     def __enter__(self):
         return self
@@ -82,10 +116,32 @@ class Gan(object):
         # Finishing the session
         self._session.close()
 
+    def reset(self, opts):
+        """Re-initialize the GAN for training a new component.
+
+        All the variables get their initial values, as if the GAN was
+        constructed anew, but the graph (and the dataset loaded into it)
+        is reused, which saves rebuilding it for every AdaGAN step.
+        """
+        self._trained = False
+        self._session.run(self._init)
+        self._session.run(self._additional_init_ops, self._init_feed_dict)
+
+    def set_data_weights(self, weights):
+        """Set the weights of the training points used to sample minibatches.
+
+        """
+        self._data_weights = np.copy(weights)
+        ops.load_data_weights(self._session, self._data_weights)
+
     def train(self, opts):
         """Train a GAN model.
 
         """
+        # Weights of the training points are fixed during the whole
+        # training, so we can precompute the minibatch sampler.
+        self._sampler = utils.WeightedSampler(
+            self._data_weights, utils.random_state(opts, 'sampler'))
         with self._session.as_default(), self._session.graph.as_default():
             self._train_internal(opts)
             self._trained = True
@@ -98,6 +154,33 @@ class Gan(object):
         with self._session.as_default(), self._session.graph.as_default():
             return self._sample_internal(opts, num)
 
+    def export_generator(self, opts, filename):
+        """Save the trained generator as a frozen graph.
+
+        The generator can be then sampled from after this GAN is gone,
+        see utils.GeneratorPool.
+        """
+        assert self._trained, 'Can not export the un-trained GAN'
+        if self._export_G is None:
+            with self._session.graph.as_default():
+                self._add_export_ops(opts)
+        utils.freeze_generator(
+            self._session, filename, self._export_G, self._export_noise_ph)
+
+    def _add_export_ops(self, opts):
+        # The generator in the inference mode, fed only with the noise. The
+        # batch norm of self._G updates its moving averages even if the
+        # is_training placeholder is False, which can not be frozen.
+        noise_ph = tf.placeholder(
+            tf.float32, [None, opts['latent_space_dim']],
+            name='export_noise_ph')
+        if getattr(self, '_is_training_ph', None) is not None:
+            G = self.generator(opts, noise_ph, is_training=False, reuse=True)
+        else:
+            G = self.generator(opts, noise_ph, reuse=True)
+        self._export_noise_ph = noise_ph
+        self._export_G = G
+
     def train_mixture_discriminator(self, opts, fake_images):
         """Train classifier separating true data from points in fake_images.
 
@@ -116,6 +199,12 @@ class Gan(object):
     def invert_points(self, opts, images):
         """Invert the learned generator function for every image in images.
 
+        opts['inverse_restarts'] (5 by default) random restarts are run and
+        for every image the restart with the smallest mse is returned. The
+        restarts run one after another, each stopping once the relative
+        improvement of the mean mse gets small. With opts['inverse_batched']
+        they are optimized at once instead, see _invert_batched.
+
         Args:
             images: numpy array of shape [num_points] + data_shape
 
@@ -124,135 +213,237 @@ class Gan(object):
         assert len(images) == opts['inverse_num'],\
             'Currently inversion works only for fixed number of images'
         with self._session.as_default(), self._session.graph.as_default():
-            target_ph = self._inv_target_ph
-            z = self._inv_z
-            loss_per_point = self._inv_loss_per_point
-            optim = self._inv_optim
-            norms = self._inv_norms
-
-            val_list = []
-            err_per_point_list = []
-            z_list = []
-            norms_list = []
-            for _start in xrange(5):
-                inv_vars = tf.get_collection(
-                    tf.GraphKeys.GLOBAL_VARIABLES, scope="inversion")
-                # Initialize z and optimizer's variables randomly
-                self._session.run(tf.variables_initializer(inv_vars))
-                prev_val = 100.
-                check_every = 100
-                steps = 1
-                while True:
-                    # Stopping criterion: relative improvement of the maximal
-                    # per point mse gets smaller than a threshold
-                    self._session.run(
-                        optim, feed_dict={target_ph:images})
-                    if steps % check_every == 0:
-                        err_per_point = loss_per_point.eval(
-                            feed_dict={target_ph:images})
-                        err_max = np.max(err_per_point)
-                        err = np.mean(err_per_point)
-                        logging.debug('Init %02d, steps %d, loss %f, max mse %f' %\
-                                      (_start, steps, err, err_max))
-                        relative_improvement = np.abs(prev_val - err) / prev_val
-                        if relative_improvement < 1e-3 or steps > 10000:
-                            val_list.append(err)
-                            err_per_point_list.append(err_per_point)
-                            z_list.append(self._session.run(z))
-                            norms_list.append(self._session.run(norms))
-                            break
-                        prev_val = err
-                    steps += 1
-            # Choose the run where we got the best (i.e. minimal) maximal
-            # per point mse
-            best_id = sorted(zip(val_list, range(len(val_list))))[0][1]
-            best_err_per_point = err_per_point_list[best_id]
-            best_z = z_list[best_id]
-            best_norms = norms_list[best_id]
+            num = len(images)
+            restarts = opts.get('inverse_restarts', 5)
+            # Row i of the results belongs to the image i % num
+            if opts.get('inverse_batched', False):
+                err_per_point, z_per_point, norms_per_point = \
+                    self._invert_batched(opts, images)
+            else:
+                err_per_point, z_per_point, norms_per_point = \
+                    self._invert_sequential(opts, images)
+            # Choose for every point the restart where we got the minimal mse
+            err_per_point = err_per_point.reshape(restarts, num)
+            best_ids = np.argmin(err_per_point, axis=0)
+            point_ids = np.arange(num)
+            best_err_per_point = err_per_point[best_ids, point_ids]
+            best_z = z_per_point.reshape(
+                restarts, num, -1)[best_ids, point_ids]
+            best_norms = norms_per_point.reshape(
+                restarts, num)[best_ids, point_ids]
             best_reconstructions = self._G.eval(
                 feed_dict={self._noise_ph:best_z,
                            self._is_training_ph:False})
 
             return best_reconstructions, best_z, best_err_per_point, best_norms
 
+    def _invert_sequential(self, opts, images):
+        restarts = opts.get('inverse_restarts', 5)
+        feed_dict = {self._inv_target_ph: images}
+        fetches = [self._inv_loss_per_point, self._inv_z, self._inv_norms]
+        err_list = []
+        z_list = []
+        norms_list = []
+        for _start in xrange(restarts):
+            # Initialize z and optimizer's variables randomly
+            self._session.run(self._inv_init)
+            prev_val = 100.
+            check_every = 100
+            steps = 1
+            while True:
+                # Stopping criterion: relative improvement of the mean
+                # per point mse gets smaller than a threshold
+                self._session.run(self._inv_optim, feed_dict=feed_dict)
+                if steps % check_every == 0:
+                    err_per_point, z_val, norms_val = self._session.run(
+                        fetches, feed_dict=feed_dict)
+                    err = np.mean(err_per_point)
+                    logging.debug('Init %02d, steps %d, loss %f, max mse %f' %\
+                                  (_start, steps, err, np.max(err_per_point)))
+                    relative_improvement = np.abs(prev_val - err) / prev_val
+                    if relative_improvement < 1e-3 or steps > 10000:
+                        err_list.append(err_per_point)
+                        z_list.append(z_val)
+                        norms_list.append(norms_val)
+                        break
+                    prev_val = err
+                steps += 1
+        return (np.concatenate(err_list), np.concatenate(z_list),
+                np.concatenate(norms_list))
+
+    def _invert_batched(self, opts, images):
+        """All restarts optimized at once, as rows of one latent variable.
+
+        Every row stops on its own once the relative improvement of its mse
+        gets small and is not computed nor updated anymore. On a single CPU
+        core this is slower than the sequential restarts, the gather and the
+        sparse updates cost more than the rows dropped after they stop.
+        """
+        num = len(images)
+        restarts = opts.get('inverse_restarts', 5)
+        active = np.arange(restarts * num)
+        err_per_point = np.zeros(restarts * num)
+        z_per_point = np.zeros((restarts * num, opts['latent_space_dim']))
+        norms_per_point = np.zeros(restarts * num)
+        fetches = [self._inv_loss_per_point, self._inv_z, self._inv_norms]
+        # Initialize z and optimizer's variables randomly
+        self._session.run(self._inv_init)
+        prev_err = 100. * np.ones(restarts * num)
+        check_every = 100
+        steps = 1
+        while len(active) > 0:
+            # Stopping criterion: relative improvement of the per point
+            # mse gets smaller than a threshold
+            feed_dict = {self._inv_target_ph: images,
+                         self._inv_active_ph: active}
+            self._session.run(self._inv_optim, feed_dict=feed_dict)
+            if steps % check_every == 0:
+                err, z_val, norms_val = self._session.run(
+                    fetches, feed_dict=feed_dict)
+                relative_improvement = \
+                    np.abs(prev_err[active] - err) / prev_err[active]
+                stop = (relative_improvement < 1e-3) | (steps > 10000)
+                stopped = active[stop]
+                err_per_point[stopped] = err[stop]
+                z_per_point[stopped] = z_val[stop]
+                norms_per_point[stopped] = norms_val[stop]
+                prev_err[active] = err
+                active = active[~stop]
+                logging.debug(
+                    'Steps %d, loss %f, max mse %f, %d/%d still running' %\
+                    (steps, np.mean(err), np.max(err),
+                     len(active), restarts * num))
+            steps += 1
+        return err_per_point, z_per_point, norms_per_point
+
     def _add_inversion_ops(self, opts):
         data_shape = self._data.data_shape
+        # With opts['inverse_batched'] all the restarts are optimized at once
+        batched = opts.get('inverse_batched', False)
+        rows = opts['inverse_num']
+        if batched:
+            rows *= opts.get('inverse_restarts', 5)
+        active_ph = None
         with tf.variable_scope("inversion"):
             target_ph = tf.placeholder(
                 tf.float32, [None] + list(data_shape),
                 name='target_ph')
             z = tf.get_variable(
-                "inverted", [opts['inverse_num'], opts['latent_space_dim']],
+                "inverted", [rows, opts['latent_space_dim']],
                 tf.float32, tf.random_normal_initializer(stddev=1.))
+            if batched:
+                # Rows of z which are still optimized
+                active_ph = tf.placeholder(tf.int32, [None], name='active_ph')
+                active_z = tf.gather(z, active_ph)
+            else:
+                active_z = z
         reconstructed_images = self.generator(
-            opts, z, is_training=False, reuse=True)
+            opts, active_z, is_training=False, reuse=True)
         with tf.variable_scope("inversion"):
+            targets = target_ph
+            if batched:
+                targets = tf.gather(
+                    target_ph, active_ph % opts['inverse_num'])
             loss_per_point = tf.reduce_mean(
-                tf.square(tf.subtract(reconstructed_images, target_ph)),
+                tf.square(tf.subtract(reconstructed_images, targets)),
                 axis=[1, 2, 3])
-            loss = tf.reduce_mean(loss_per_point)
-            norms = tf.reduce_sum(tf.square(z), axis=[1])
-            optim = tf.train.AdamOptimizer(0.01, 0.9)
+            # Same gradients per restart as the mean over inverse_num points
+            loss = tf.reduce_sum(loss_per_point) / opts['inverse_num']
+            norms = tf.reduce_sum(tf.square(active_z), axis=[1])
+            if batched:
+                # Lazy Adam updates only the gathered rows, i.e. the stopped
+                # restarts do not move anymore. For the rows updated in
+                # every step it is the same as Adam.
+                optim = tf.contrib.opt.LazyAdamOptimizer(0.01, 0.9)
+            else:
+                optim = tf.train.AdamOptimizer(0.01, 0.9)
             optim = optim.minimize(loss, var_list=[z])
+        inv_vars = tf.get_collection(
+            tf.GraphKeys.GLOBAL_VARIABLES, scope="inversion")
 
         self._inv_target_ph = target_ph
-        self._inv_z = z
+        self._inv_active_ph = active_ph
+        self._inv_z = active_z
         self._inv_optim = optim
         self._inv_loss = loss
         self._inv_loss_per_point = loss_per_point
         self._inv_norms = norms
+        self._inv_init = tf.variables_initializer(inv_vars)
 
     def _run_batch(self, opts, operation, placeholder, feed,
                    placeholder2=None, feed2=None):
-        """Wrapper around session.run to process huge data.
-
-        It is asumed that (a) first dimension of placeholder enumerates
-        separate points, and (b) that operation is independently applied
-        to every point, i.e. we can split it point-wisely and then merge
-        the results. The second placeholder is meant either for is_train
-        flag for batch-norm or probabilities of dropout.
+        """Wrapper around utils.run_batched to process huge data.
 
-        TODO: write util function which will be called both from this method
-        and MNIST classification evaluation as well.
+        feed is either a numpy array or a (lazy) datahandler.Data. The
+        second placeholder is meant either for is_train flag for batch-norm
+        or probabilities of dropout. Vector results of shape (n,) are
+        returned as (n, 1) arrays.
 
         """
-        assert len(feed.shape) > 0, 'Empry feed.'
-        num_points = feed.shape[0]
-        batch_size = opts['tf_run_batch_size']
-        batches_num = int(np.ceil((num_points + 0.) / batch_size))
-        result = []
-        for idx in xrange(batches_num):
-            if idx == batches_num - 1:
-                if feed2 is None:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:]})
-                else:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:],
-                                   placeholder2: feed2})
-            else:
-                if feed2 is None:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:
-                                                     (idx + 1) * batch_size]})
-                else:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:
-                                                     (idx + 1) * batch_size],
-                                   placeholder2: feed2})
-
-            if len(res.shape) == 1:
-                # convert (n,) vector to (n,1) array
-                res = np.reshape(res, [-1, 1])
-            result.append(res)
-        result = np.vstack(result)
-        assert len(result) == num_points
+        const_feed = None
+        if feed2 is not None:
+            const_feed = {placeholder2: feed2}
+        result = utils.run_batched(
+            self._session, opts, operation, {placeholder: feed}, const_feed)
+        if len(result.shape) == 1:
+            # convert (n,) vector to (n,1) array
+            result = np.reshape(result, [-1, 1])
         return result
 
+    def _add_fused_steps(self, opts, d_optimizer, g_optimizer, d_vars, g_vars):
+        """Add an op making opts['fused_steps'] training steps per session.run.
+
+        Minibatches of the steps are fed stacked along the first axis into
+        self._real_points_stack_ph and self._noise_stack_ph. Every step makes
+        opts['d_steps'] discriminator updates followed by opts['g_steps']
+        generator updates, just as the training loops do. The steps are the
+        iterations of a tf.while_loop, whose body builds the losses with
+        self._losses once per update. Every update waits for the previous
+        one, and the variables (resource variables, see __init__) are read
+        after it. The optimizers are the ones of self._d_optim and
+        self._g_optim, so the fused and single steps share their slots.
+        """
+        assert not opts.get('device_noise', False) and \
+            not opts.get('graph_input', False), \
+            'Fused steps need fed minibatches'
+        real_points_stack_ph = tf.placeholder(
+            tf.float32, [None, None] + list(self._data.data_shape),
+            name='real_points_stack_ph')
+        noise_stack_ph = tf.placeholder(
+            tf.float32, [None, None, opts['latent_space_dim']],
+            name='noise_stack_ph')
+        updates = [(d_optimizer, d_vars, 0)] * opts['d_steps'] + \
+            [(g_optimizer, g_vars, 1)] * opts['g_steps']
+
+        def train_step(step):
+            update = step
+            for optimizer, var_list, loss_id in updates:
+                with tf.control_dependencies([update]):
+                    loss = self._losses(opts, real_points_stack_ph[step],
+                                        noise_stack_ph[step])[loss_id]
+                    update = optimizer.minimize(loss, var_list=var_list)
+            with tf.control_dependencies([update]):
+                return step + 1
+
+        num_steps = tf.shape(real_points_stack_ph)[0]
+        self._real_points_stack_ph = real_points_stack_ph
+        self._noise_stack_ph = noise_stack_ph
+        self._fused_optim = tf.while_loop(
+            lambda step: step < num_steps, train_step, [tf.constant(0)],
+            parallel_iterations=1)
+
+    def _run_fused_steps(self, minibatches, feed_dict=None):
+        """Make a training step on every (images, noise) in minibatches.
+
+        All the steps are made with a single session.run.
+        """
+        feed_dict = dict(feed_dict or {})
+        feed_dict[self._real_points_stack_ph] = np.stack(
+            [images for images, _ in minibatches])
+        feed_dict[self._noise_stack_ph] = np.stack(
+            [noise for _, noise in minibatches])
+        self._session.run(self._fused_optim, feed_dict=feed_dict)
+
     def _build_model_internal(self, opts):
         """Build a TensorFlow graph with all the necessary ops.
 
@@ -317,6 +508,16 @@ class ToyGan(Gan):
 
         return h2
 
+    def _losses(self, opts, real_points, noise):
+        """Discriminator and generator losses on one minibatch.
+
+        The variables are reused, see Gan._add_fused_steps.
+        """
+        G = self.generator(opts, noise, reuse=True)
+        d_logits_real = self.discriminator(opts, real_points, reuse=True)
+        d_logits_fake = self.discriminator(opts, G, reuse=True)
+        return _gan_losses(d_logits_real, d_logits_fake)
+
     def _build_model_internal(self, opts):
         """Build the Graph corresponding to GAN implementation.
 
@@ -328,8 +529,7 @@ class ToyGan(Gan):
             tf.float32, [None] + list(data_shape), name='real_points_ph')
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        noise_ph = ops.noise_placeholder(opts, 'noise_ph')
 
         # Operations
         G = self.generator(opts, noise_ph)
@@ -344,17 +544,7 @@ class ToyGan(Gan):
         c_training = tf.nn.sigmoid(
             self.discriminator(opts, real_points_ph, prefix='CLASSIFIER', reuse=True))
 
-        d_loss_real = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
-        d_loss_fake = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
-        d_loss = d_loss_real + d_loss_fake
-
-        g_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
+        d_loss, g_loss = _gan_losses(d_logits_real, d_logits_fake)
 
         c_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
@@ -367,8 +557,10 @@ class ToyGan(Gan):
         t_vars = tf.trainable_variables()
         d_vars = [var for var in t_vars if 'DISCRIMINATOR/' in var.name]
         g_vars = [var for var in t_vars if 'GENERATOR/' in var.name]
-        d_optim = ops.optimizer(opts, 'd').minimize(d_loss, var_list=d_vars)
-        g_optim = ops.optimizer(opts, 'g').minimize(g_loss, var_list=g_vars)
+        d_optimizer = ops.optimizer(opts, 'd')
+        g_optimizer = ops.optimizer(opts, 'g')
+        d_optim = d_optimizer.minimize(d_loss, var_list=d_vars)
+        g_optim = g_optimizer.minimize(g_loss, var_list=g_vars)
         c_vars = [var for var in t_vars if 'CLASSIFIER/' in var.name]
         c_optim = ops.optimizer(opts).minimize(c_loss, var_list=c_vars)
 
@@ -385,6 +577,10 @@ class ToyGan(Gan):
         self._d_optim = d_optim
         self._c_optim = c_optim
 
+        if opts.get('fused_steps', 1) > 1:
+            self._add_fused_steps(
+                opts, d_optimizer, g_optimizer, d_vars, g_vars)
+
     def _train_internal(self, opts):
         """Train a GAN model.
 
@@ -393,38 +589,53 @@ class ToyGan(Gan):
         batches_num = self._data.num_points / opts['batch_size']
         train_size = self._data.num_points
 
-        counter = 0
-        logging.debug('Training GAN')
-        for _epoch in xrange(opts["gan_epoch_num"]):
-            for _idx in xrange(batches_num):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim, feed_dict={self._noise_ph: batch_noise})
-                counter += 1
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    metrics = Metrics()
-                    points_to_plot = self._run_batch(
-                        opts, self._G, self._noise_ph,
-                        self._noise_for_plots[0:320])
-                    data_ids = np.random.choice(train_size, 320,
-                                                replace=False,
-                                                p=self._data_weights)
-                    metrics.make_plots(
-                        opts, counter,
-                        self._data.data[data_ids],
-                        points_to_plot,
-                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+        batches = utils.BatchPrefetcher(
+            opts, self._data.data, self._data_weights)
+        try:
+            counter = 0
+            # With opts['fused_steps'] > 1 minibatches are collected and
+            # trained on fused_steps at a time, the remainder of every epoch
+            # one by one.
+            fused_steps = opts.get('fused_steps', 1)
+            fused_batches_num = batches_num - batches_num % fused_steps
+            pending = []
+            logging.debug('Training GAN')
+            for _epoch in xrange(opts["gan_epoch_num"]):
+                for _idx in xrange(batches_num):
+                    batch_images, batch_noise, _ = batches.next()
+                    if fused_steps > 1 and _idx < fused_batches_num:
+                        pending.append((batch_images, batch_noise))
+                        if len(pending) == fused_steps:
+                            self._run_fused_steps(pending)
+                            pending = []
+                    else:
+                        # Update discriminator parameters
+                        for _iter in xrange(opts['d_steps']):
+                            _ = self._session.run(
+                                self._d_optim,
+                                feed_dict=utils.prune_feed(
+                                    {self._real_points_ph: batch_images,
+                                     self._noise_ph: batch_noise}))
+                        # Update generator parameters
+                        for _iter in xrange(opts['g_steps']):
+                            _ = self._session.run(
+                                self._g_optim,
+                                feed_dict=utils.prune_feed(
+                                    {self._noise_ph: batch_noise}))
+                    counter += 1
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        metrics = Metrics()
+                        points_to_plot = self._run_batch(
+                            opts, self._G, self._noise_ph,
+                            self._noise_for_plots[0:320])
+                        data_ids = self._sampler.sample(320)
+                        metrics.make_plots(
+                            opts, counter,
+                            self._data.data[data_ids],
+                            points_to_plot,
+                            prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+        finally:
+            batches.close()
 
 
 
@@ -432,7 +643,8 @@ class ToyGan(Gan):
         """Sample from the trained GAN model.
 
         """
-        noise = utils.generate_noise(opts, num)
+        noise = utils.generate_noise(
+            opts, num, utils.random_state(opts, 'sample'))
         sample = self._run_batch(opts, self._G, self._noise_ph, noise)
         # sample = self._session.run(
         #     self._G, feed_dict={self._noise_ph: noise})
@@ -445,13 +657,14 @@ class ToyGan(Gan):
 
         batches_num = self._data.num_points / opts['batch_size']
         logging.debug('Training a mixture discriminator')
+        random_state = utils.random_state(opts, 'mixture_discriminator')
         for epoch in xrange(opts["mixture_c_epoch_num"]):
             for idx in xrange(batches_num):
-                ids = np.random.choice(len(fake_images), opts['batch_size'],
-                                       replace=False)
+                ids = random_state.choice(len(fake_images), opts['batch_size'],
+                                          replace=False)
                 batch_fake_images = fake_images[ids]
-                ids = np.random.choice(self._data.num_points, opts['batch_size'],
-                                       replace=False)
+                ids = random_state.choice(self._data.num_points,
+                                          opts['batch_size'], replace=False)
                 batch_real_images = self._data.data[ids]
                 _ = self._session.run(
                     self._c_optim,
@@ -529,6 +742,8 @@ class ToyUnrolledGan(ToyGan):
         """Build the Graph corresponding to GAN implementation.
 
         """
+        assert opts.get('fused_steps', 1) == 1, \
+            '%s does not support fused steps' % type(self).__name__
         data_shape = self._data.data_shape
 
         # Placeholders
@@ -536,8 +751,7 @@ class ToyUnrolledGan(ToyGan):
             tf.float32, [None] + list(data_shape), name='real_points_ph')
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        noise_ph = ops.noise_placeholder(opts, 'noise_ph')
 
         # Operations
         G = self.generator(opts, noise_ph)
@@ -641,48 +855,52 @@ class ToyUnrolledGan(ToyGan):
         batches_num = self._data.num_points / opts['batch_size']
         train_size = self._data.num_points
 
-        counter = 0
-        logging.debug('Training GAN')
-        for _epoch in xrange(opts["gan_epoch_num"]):
-            for _idx in TQDM(opts, xrange(batches_num),
-                             desc='Epoch %2d/%2d' %\
-                             (_epoch+1, opts["gan_epoch_num"])):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise})
-                # Roll back discriminator_cp's variables
-                self._session.run(self._roll_back)
-                # Unrolling steps
-                for _iter in xrange(opts['unrolling_steps']):
-                    self._session.run(
-                        self._d_optim_cp,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim, feed_dict={self._noise_ph: batch_noise})
-                counter += 1
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    metrics = Metrics()
-                    points_to_plot = self._run_batch(
-                        opts, self._G, self._noise_ph,
-                        self._noise_for_plots[0:320])
-                    data_ids = np.random.choice(train_size, 320,
-                                                replace=False,
-                                                p=self._data_weights)
-                    metrics.make_plots(
-                        opts, counter,
-                        self._data.data[data_ids],
-                        points_to_plot,
-                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+        batches = utils.BatchPrefetcher(
+            opts, self._data.data, self._data_weights)
+        try:
+            counter = 0
+            logging.debug('Training GAN')
+            for _epoch in xrange(opts["gan_epoch_num"]):
+                for _idx in TQDM(opts, xrange(batches_num),
+                                 desc='Epoch %2d/%2d' %\
+                                 (_epoch+1, opts["gan_epoch_num"])):
+                    batch_images, batch_noise, _ = batches.next()
+                    # Update discriminator parameters
+                    for _iter in xrange(opts['d_steps']):
+                        _ = self._session.run(
+                            self._d_optim,
+                            feed_dict=utils.prune_feed(
+                                {self._real_points_ph: batch_images,
+                                 self._noise_ph: batch_noise}))
+                    # Roll back discriminator_cp's variables
+                    self._session.run(self._roll_back)
+                    # Unrolling steps
+                    for _iter in xrange(opts['unrolling_steps']):
+                        self._session.run(
+                            self._d_optim_cp,
+                            feed_dict=utils.prune_feed(
+                                {self._real_points_ph: batch_images,
+                                 self._noise_ph: batch_noise}))
+                    # Update generator parameters
+                    for _iter in xrange(opts['g_steps']):
+                        _ = self._session.run(
+                            self._g_optim,
+                            feed_dict=utils.prune_feed(
+                                {self._noise_ph: batch_noise}))
+                    counter += 1
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        metrics = Metrics()
+                        points_to_plot = self._run_batch(
+                            opts, self._G, self._noise_ph,
+                            self._noise_for_plots[0:320])
+                        data_ids = self._sampler.sample(320)
+                        metrics.make_plots(
+                            opts, counter,
+                            self._data.data[data_ids],
+                            points_to_plot,
+                            prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+        finally:
+            batches.close()
 
 class ImageGan(Gan):
     """A simple GAN implementation, suitable for pictures.
@@ -768,6 +986,19 @@ class ImageGan(Gan):
 
         return h3
 
+    def _losses(self, opts, real_points, noise):
+        """Discriminator and generator losses on one minibatch.
+
+        The variables are reused, see Gan._add_fused_steps.
+        """
+        G = self.generator(opts, noise, self._is_training_ph, reuse=True)
+        G.set_shape([None] + list(self._data.data_shape))
+        d_logits_real = self.discriminator(
+            opts, real_points, self._is_training_ph, reuse=True)
+        d_logits_fake = self.discriminator(
+            opts, G, self._is_training_ph, reuse=True)
+        return _gan_losses(d_logits_real, d_logits_fake)
+
     def _build_model_internal(self, opts):
         """Build the Graph corresponding to GAN implementation.
 
@@ -775,12 +1006,13 @@ class ImageGan(Gan):
         data_shape = self._data.data_shape
 
         # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
+        real_points_ph, init_ops, init_feed_dict = ops.data_placeholder(
+            opts, self._data.data, self._data_weights, 'real_points_ph')
+        self._data_init_ops += init_ops
+        self._data_init_feed_dict.update(init_feed_dict)
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        noise_ph = ops.noise_placeholder(opts, 'noise_ph')
         is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
 
 
@@ -803,17 +1035,7 @@ class ImageGan(Gan):
             self.discriminator(opts, real_points_ph, is_training_ph,
                                prefix='CLASSIFIER', reuse=True))
 
-        d_loss_real = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
-        d_loss_fake = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
-        d_loss = d_loss_real + d_loss_fake
-
-        g_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
+        d_loss, g_loss = _gan_losses(d_logits_real, d_logits_fake)
 
         c_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
@@ -827,8 +1049,10 @@ class ImageGan(Gan):
         d_vars = [var for var in t_vars if 'DISCRIMINATOR/' in var.name]
         g_vars = [var for var in t_vars if 'GENERATOR/' in var.name]
 
-        d_optim = ops.optimizer(opts, 'd').minimize(d_loss, var_list=d_vars)
-        g_optim = ops.optimizer(opts, 'g').minimize(g_loss, var_list=g_vars)
+        d_optimizer = ops.optimizer(opts, 'd')
+        g_optimizer = ops.optimizer(opts, 'g')
+        d_optim = d_optimizer.minimize(d_loss, var_list=d_vars)
+        g_optim = g_optimizer.minimize(g_loss, var_list=g_vars)
 
         # d_optim_op = ops.optimizer(opts, 'd')
         # g_optim_op = ops.optimizer(opts, 'g')
@@ -863,6 +1087,10 @@ class ImageGan(Gan):
         self._d_optim = d_optim
         self._c_optim = c_optim
 
+        if opts.get('fused_steps', 1) > 1:
+            self._add_fused_steps(
+                opts, d_optimizer, g_optimizer, d_vars, g_vars)
+
         logging.debug("Building Graph Done.")
 
 
@@ -874,53 +1102,80 @@ class ImageGan(Gan):
         batches_num = self._data.num_points / opts['batch_size']
         train_size = self._data.num_points
 
-        counter = 0
-        logging.debug('Training GAN')
-        for _epoch in xrange(opts["gan_epoch_num"]):
-            for _idx in xrange(batches_num):
-                # logging.debug('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim,
-                        feed_dict={self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                counter += 1
-
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    logging.debug(
-                        'Epoch: %d/%d, batch:%d/%d' % \
-                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num))
-                    metrics = Metrics()
-                    points_to_plot = self._run_batch(
-                        opts, self._G, self._noise_ph,
-                        self._noise_for_plots[0:320],
-                        self._is_training_ph, False)
-                    metrics.make_plots(
-                        opts,
-                        counter,
-                        None,
-                        points_to_plot,
-                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
-                if opts['early_stop'] > 0 and counter > opts['early_stop']:
-                    break
+        # With opts['graph_input'] the graph samples the real points itself
+        batches = utils.BatchPrefetcher(
+            opts, None if opts.get('graph_input', False) else self._data.data,
+            self._data_weights)
+        try:
+            counter = 0
+            # With opts['fused_steps'] > 1 minibatches are collected and
+            # trained on fused_steps at a time, the remainder of every epoch
+            # one by one.
+            fused_steps = opts.get('fused_steps', 1)
+            fused_batches_num = batches_num - batches_num % fused_steps
+            pending = []
+            logging.debug('Training GAN')
+            for _epoch in xrange(opts["gan_epoch_num"]):
+                for _idx in xrange(batches_num):
+                    # logging.debug('Step %d of %d' % (_idx, batches_num ) )
+                    batch_images, batch_noise, _ = batches.next()
+                    if fused_steps > 1 and _idx < fused_batches_num:
+                        pending.append((batch_images, batch_noise))
+                        if len(pending) == fused_steps:
+                            self._run_fused_steps(
+                                pending, {self._is_training_ph: True})
+                            pending = []
+                    else:
+                        # Update discriminator parameters
+                        for _iter in xrange(opts['d_steps']):
+                            _ = self._session.run(
+                                self._d_optim,
+                                feed_dict=utils.prune_feed(
+                                    {self._real_points_ph: batch_images,
+                                     self._noise_ph: batch_noise,
+                                     self._is_training_ph: True}))
+                        # Update generator parameters
+                        for _iter in xrange(opts['g_steps']):
+                            _ = self._session.run(
+                                self._g_optim,
+                                feed_dict=utils.prune_feed(
+                                    {self._noise_ph: batch_noise,
+                                     self._is_training_ph: True}))
+                    counter += 1
+
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        logging.debug(
+                            'Epoch: %d/%d, batch:%d/%d' % \
+                            (_epoch+1, opts['gan_epoch_num'],
+                             _idx+1, batches_num))
+                        metrics = Metrics()
+                        points_to_plot = self._run_batch(
+                            opts, self._G, self._noise_ph,
+                            self._noise_for_plots[0:320],
+                            self._is_training_ph, False)
+                        metrics.make_plots(
+                            opts,
+                            counter,
+                            None,
+                            points_to_plot,
+                            prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+                    if opts['early_stop'] > 0 and counter > opts['early_stop']:
+                        # Counted minibatches still waiting for a fused
+                        # call are trained on before stopping
+                        if pending:
+                            self._run_fused_steps(
+                                pending, {self._is_training_ph: True})
+                            pending = []
+                        break
+        finally:
+            batches.close()
 
     def _sample_internal(self, opts, num):
         """Sample from the trained GAN model.
 
         """
-        noise = utils.generate_noise(opts, num)
+        noise = utils.generate_noise(
+            opts, num, utils.random_state(opts, 'sample'))
         sample = self._run_batch(
             opts, self._G, self._noise_ph, noise,
             self._is_training_ph, False)
@@ -935,15 +1190,16 @@ class ImageGan(Gan):
 
         batches_num = self._data.num_points / opts['batch_size']
         logging.debug('Training a mixture discriminator')
+        random_state = utils.random_state(opts, 'mixture_discriminator')
         logging.debug('Using %d real points and %d fake ones' %\
                       (self._data.num_points, len(fake_images)))
         for epoch in xrange(opts["mixture_c_epoch_num"]):
             for idx in xrange(batches_num):
-                ids = np.random.choice(len(fake_images), opts['batch_size'],
-                                       replace=False)
+                ids = random_state.choice(len(fake_images), opts['batch_size'],
+                                          replace=False)
                 batch_fake_images = fake_images[ids]
-                ids = np.random.choice(self._data.num_points, opts['batch_size'],
-                                       replace=False)
+                ids = random_state.choice(self._data.num_points,
+                                          opts['batch_size'], replace=False)
                 batch_real_images = self._data.data[ids]
                 _ = self._session.run(
                     self._c_optim,
@@ -1024,6 +1280,8 @@ class MNISTLabelGan(ImageGan):
         """Build the Graph corresponding to GAN implementation.
 
         """
+        assert opts.get('fused_steps', 1) == 1, \
+            '%s does not support fused steps' % type(self).__name__
         data_shape = self._data.data_shape
 
         # Placeholders
@@ -1033,8 +1291,7 @@ class MNISTLabelGan(ImageGan):
             tf.float32, [None] + list(data_shape), name='real_points_ph')
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        noise_ph = ops.noise_placeholder(opts, 'noise_ph')
         is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
         dropout_rate_ph = tf.placeholder(tf.float32)
         # labels_ph = tf.placeholder(tf.int8, [None, 10])
@@ -1185,8 +1442,10 @@ class MNISTLabelGan(ImageGan):
 
         train_data = self._data.data[:60000]
         train_labels = self._data.labels[:60000]
-        train_weights = self._data_weights[:60000]
-        train_weights = train_weights / np.sum(train_weights)
+        random_state = utils.random_state(opts, 'batches')
+        # WeightedSampler renormalizes the weights itself
+        sampler = utils.WeightedSampler(
+            self._data_weights[:60000], random_state)
         test_data = self._data.data[60000:]
         test_labels = self._data.labels[60000:]
         batches_num = len(train_data) / opts['batch_size']
@@ -1200,13 +1459,14 @@ class MNISTLabelGan(ImageGan):
         for _epoch in xrange(opts["gan_epoch_num"]):
             for _idx in xrange(batches_num):
                 # logging.debug('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=train_weights)
-                data_ids_unl = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=train_weights)
-                batch_images = train_data[data_ids].astype(np.float)
-                batch_images_unl = train_data[data_ids_unl].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
+                data_ids = sampler.sample(opts['batch_size'])
+                data_ids_unl = sampler.sample(opts['batch_size'])
+                batch_images = train_data[data_ids]
+                batch_images_unl = train_data[data_ids_unl]
+                batch_noise = None
+                if not opts.get('device_noise', False):
+                    batch_noise = utils.generate_noise(
+                        opts, opts['batch_size'], random_state)
                 # Update discriminator parameters
                 # labels_oh = utils.one_hot(self._data.labels[data_ids])
                 labels_oh = train_labels[data_ids]
@@ -1214,21 +1474,23 @@ class MNISTLabelGan(ImageGan):
                 for _iter in xrange(opts['d_steps']):
                     _ = self._session.run(
                         self._d_optim,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._real_points_unl_ph: batch_images_unl,
-                                   self._is_training_ph: True,
-                                   self._lr_ph: lr,
-                                   self._noise_ph: batch_noise,
-                                   self._labels_ph: labels_oh})
+                        feed_dict=utils.prune_feed(
+                            {self._real_points_ph: batch_images,
+                             self._real_points_unl_ph: batch_images_unl,
+                             self._is_training_ph: True,
+                             self._lr_ph: lr,
+                             self._noise_ph: batch_noise,
+                             self._labels_ph: labels_oh}))
                 # Update generator parameters
                 lr = lr_g * min(1., 1. - ((0. + _epoch) / opts['gan_epoch_num']))
                 for _iter in xrange(opts['g_steps']):
                     _ = self._session.run(
                         self._g_optim,
-                        feed_dict={self._noise_ph: batch_noise,
-                                   self._is_training_ph: True,
-                                   self._lr_ph: lr,
-                                   self._real_points_unl_ph: batch_images_unl})
+                        feed_dict=utils.prune_feed(
+                            {self._noise_ph: batch_noise,
+                             self._is_training_ph: True,
+                             self._lr_ph: lr,
+                             self._real_points_unl_ph: batch_images_unl}))
                 counter += 1
 
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
@@ -1238,9 +1500,10 @@ class MNISTLabelGan(ImageGan):
                                    # self._labels_ph: utils.one_hot(self._data.labels[:1000])})
                                    self._labels_ph: test_labels})
                     g_loss = self._g_loss.eval(
-                        feed_dict={self._noise_ph: batch_noise,
-                                   self._is_training_ph: False,
-                                   self._real_points_unl_ph: batch_images_unl})
+                        feed_dict=utils.prune_feed(
+                            {self._noise_ph: batch_noise,
+                             self._is_training_ph: False,
+                             self._real_points_unl_ph: batch_images_unl}))
                     logging.debug(
                         'Epoch:%3d/%d, batch:%4d/%d, lr_g=%.4f, D accuracy in telling digits:%f, G feature matching loss:%f' % \
                         (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num, lr, accuracy, g_loss))
@@ -1265,15 +1528,16 @@ class MNISTLabelGan(ImageGan):
 
         batches_num = self._data.num_points / opts['batch_size']
         logging.debug('Training a mixture discriminator')
+        random_state = utils.random_state(opts, 'mixture_discriminator')
         logging.debug('Using %d real points and %d fake ones' %\
                       (self._data.num_points, len(fake_images)))
         for epoch in xrange(opts["mixture_c_epoch_num"]):
             for idx in xrange(batches_num):
-                ids = np.random.choice(len(fake_images), opts['batch_size'],
-                                       replace=False)
+                ids = random_state.choice(len(fake_images), opts['batch_size'],
+                                          replace=False)
                 batch_fake_images = fake_images[ids]
-                ids = np.random.choice(self._data.num_points, opts['batch_size'],
-                                       replace=False)
+                ids = random_state.choice(self._data.num_points,
+                                          opts['batch_size'], replace=False)
                 batch_real_images = self._data.data[ids]
                 _ = self._session.run(
                     self._c_optim,
@@ -1379,6 +1643,8 @@ class ImageUnrolledGan(ImageGan):
         """Build the Graph corresponding to GAN implementation.
 
         """
+        assert opts.get('fused_steps', 1) == 1, \
+            '%s does not support fused steps' % type(self).__name__
         data_shape = self._data.data_shape
 
         # Placeholders
@@ -1386,8 +1652,7 @@ class ImageUnrolledGan(ImageGan):
             tf.float32, [None] + list(data_shape), name='real_points_ph')
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        noise_ph = ops.noise_placeholder(opts, 'noise_ph')
         is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
 
         # Operations
@@ -1518,55 +1783,61 @@ class ImageUnrolledGan(ImageGan):
         batches_num = self._data.num_points / opts['batch_size']
         train_size = self._data.num_points
 
-        counter = 0
-        logging.debug('Training GAN')
-        for _epoch in xrange(opts["gan_epoch_num"]):
-            for _idx in TQDM(opts, xrange(batches_num),
-                             desc='Epoch %2d/%2d' %\
-                             (_epoch + 1, opts["gan_epoch_num"])):
-                # logging.debug('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                # Roll back discriminator_cp's variables
-                self._session.run(self._roll_back)
-                # Unrolling steps
-                for _iter in xrange(opts['unrolling_steps']):
-                    self._session.run(
-                        self._d_optim_cp,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim,
-                        feed_dict={self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                counter += 1
-
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    logging.debug(
-                        'Epoch: %d/%d, batch:%d/%d' % \
-                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num))
-                    metrics = Metrics()
-                    points_to_plot = self._run_batch(
-                        opts, self._G, self._noise_ph,
-                        self._noise_for_plots[0:320],
-                        self._is_training_ph, False)
-                    metrics.make_plots(
-                        opts,
-                        counter,
-                        None,
-                        points_to_plot,
-                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
-                if opts['early_stop'] > 0 and counter > opts['early_stop']:
-                    break
+        batches = utils.BatchPrefetcher(
+            opts, self._data.data, self._data_weights)
+        try:
+            counter = 0
+            logging.debug('Training GAN')
+            for _epoch in xrange(opts["gan_epoch_num"]):
+                for _idx in TQDM(opts, xrange(batches_num),
+                                 desc='Epoch %2d/%2d' %\
+                                 (_epoch + 1, opts["gan_epoch_num"])):
+                    # logging.debug('Step %d of %d' % (_idx, batches_num ) )
+                    batch_images, batch_noise, _ = batches.next()
+                    # Update discriminator parameters
+                    for _iter in xrange(opts['d_steps']):
+                        _ = self._session.run(
+                            self._d_optim,
+                            feed_dict=utils.prune_feed(
+                                {self._real_points_ph: batch_images,
+                                 self._noise_ph: batch_noise,
+                                 self._is_training_ph: True}))
+                    # Roll back discriminator_cp's variables
+                    self._session.run(self._roll_back)
+                    # Unrolling steps
+                    for _iter in xrange(opts['unrolling_steps']):
+                        self._session.run(
+                            self._d_optim_cp,
+                            feed_dict=utils.prune_feed(
+                                {self._real_points_ph: batch_images,
+                                 self._noise_ph: batch_noise,
+                                 self._is_training_ph: True}))
+                    # Update generator parameters
+                    for _iter in xrange(opts['g_steps']):
+                        _ = self._session.run(
+                            self._g_optim,
+                            feed_dict=utils.prune_feed(
+                                {self._noise_ph: batch_noise,
+                                 self._is_training_ph: True}))
+                    counter += 1
+
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        logging.debug(
+                            'Epoch: %d/%d, batch:%d/%d' % \
+                            (_epoch+1, opts['gan_epoch_num'],
+                             _idx+1, batches_num))
+                        metrics = Metrics()
+                        points_to_plot = self._run_batch(
+                            opts, self._G, self._noise_ph,
+                            self._noise_for_plots[0:320],
+                            self._is_training_ph, False)
+                        metrics.make_plots(
+                            opts,
+                            counter,
+                            None,
+                            points_to_plot,
+                            prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+                    if opts['early_stop'] > 0 and counter > opts['early_stop']:
+                        break
+        finally:
+            batches.close()
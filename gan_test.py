@@ -0,0 +1,171 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Tests of the GAN trainers: exported generators and fused training steps.
+
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+import utils
+import gan as GAN
+import vae as VAE
+from testutils import Points, trainer_opts
+
+
+class ExportGeneratorTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _export_and_sample(self, gan_class, opts):
+        points = np.random.RandomState(0).rand(64, 28, 28, 1)
+        data = Points(opts, points)
+        filename = os.path.join(self._work_dir, 'generator00')
+        with gan_class(opts, data, np.ones(64) / 64.) as gan:
+            gan.train(opts)
+            gan.export_generator(opts, filename)
+            noise = utils.generate_noise(
+                opts, 10, np.random.RandomState(1))
+            output = gan._G if gan_class is GAN.ImageGan else gan._generated
+            expected = gan._session.run(
+                output, {gan._noise_ph: noise, gan._is_training_ph: False})
+        pool = utils.GeneratorPool(opts)
+        sample = pool.sample(filename, 10, np.random.RandomState(1))
+        pool.close()
+        self.assertEqual(sample.shape, (10, 28, 28, 1))
+        # The trained moving averages of the batch norm are frozen too
+        self.assertAllClose(sample, expected, atol=1e-5)
+
+    def testImageGan(self):
+        self._export_and_sample(GAN.ImageGan, trainer_opts())
+
+    def testImageGanGraphInput(self):
+        self._export_and_sample(
+            GAN.ImageGan,
+            trainer_opts(device_noise=True, graph_input=True))
+
+    def testImageVaeGraphInput(self):
+        # The noise of the VAE's encoder depends on the real points
+        os.makedirs(os.path.join(self._work_dir, 'checkpoints'))
+        opts = trainer_opts(
+            device_noise=True, graph_input=True, vae_sigma=0.01,
+            g_arch='dcgan', g_num_layers=2, e_arch='dcgan', e_num_filters=8,
+            e_num_layers=2, batch_norm=True, dropout=False, recon_loss='l2sq',
+            decay_schedule='manual', work_dir=self._work_dir,
+            ckpt_dir='checkpoints', save_every_epoch=1000)
+        self._export_and_sample(VAE.ImageVae, opts)
+
+    def testUnsupportedPrior(self):
+        with self.assertRaisesRegexp(AssertionError, 'latent space'):
+            utils.GeneratorPool(trainer_opts(latent_space_distr='mnist'))
+
+
+class FusedStepsTest(tf.test.TestCase):
+
+    def _compare(self, gan_class, opts, points, feed):
+        """Checks that a fused call makes the same updates as single steps.
+
+        """
+        data = Points(opts, points)
+        random = np.random.RandomState(2)
+        minibatches = [(points[random.choice(len(points), 16)],
+                        utils.generate_noise(opts, 16, random))
+                       for _ in xrange(opts['fused_steps'])]
+        with gan_class(opts, data, np.ones(len(points))) as gan:
+            session = gan._session
+            variables = session.graph.get_collection(
+                tf.GraphKeys.GLOBAL_VARIABLES)
+            initial = session.run(variables)
+            for images, noise in minibatches:
+                feed_dict = dict(feed(gan))
+                feed_dict[gan._noise_ph] = noise
+                feed_dict[gan._real_points_ph] = images
+                for _ in xrange(opts['d_steps']):
+                    session.run(gan._d_optim, feed_dict)
+                del feed_dict[gan._real_points_ph]
+                for _ in xrange(opts['g_steps']):
+                    session.run(gan._g_optim, feed_dict)
+            expected = session.run(variables)
+            for var, value in zip(variables, initial):
+                var.load(value, session)
+            gan._run_fused_steps(minibatches, feed(gan))
+            for var, value in zip(variables, session.run(variables)):
+                # The discriminator updates its batch norm averages on the
+                # real and fake points in no particular order
+                if 'moving_' in var.name:
+                    continue
+                self.assertAllClose(value, expected[variables.index(var)],
+                                    rtol=1e-4, atol=1e-5, msg=var.name)
+            # The variables did change and by more than one step
+            self.assertNotAllClose(expected[0], initial[0])
+
+    def testToyGan(self):
+        opts = trainer_opts(dataset='gmm', fused_steps=3, d_steps=2,
+                            g_steps=1, d_num_filters=16, g_num_filters=16)
+        self._compare(GAN.ToyGan, opts,
+                      np.random.RandomState(0).randn(64, 2, 1, 1),
+                      lambda gan: {})
+
+    def testImageGan(self):
+        opts = trainer_opts(fused_steps=3, g_steps=2)
+        self._compare(GAN.ImageGan, opts,
+                      np.random.RandomState(0).rand(64, 28, 28, 1),
+                      lambda gan: {gan._is_training_ph: True})
+
+    def testImageGanEarlyStop(self):
+        # The minibatches counted before stopping are all trained on, i.e.
+        # Adam makes as many steps as without fused steps
+        points = np.random.RandomState(0).rand(160, 28, 28, 1)
+        beta1_power = {}
+        for fused_steps in [1, 3]:
+            opts = trainer_opts(gan_epoch_num=1, early_stop=3,
+                                fused_steps=fused_steps)
+            with GAN.ImageGan(opts, Points(opts, points),
+                              np.ones(160)) as gan:
+                gan.train(opts)
+                beta1_power[fused_steps] = sorted(gan._session.run(
+                    [var for var in tf.global_variables()
+                     if 'beta1_power' in var.name]))
+        self.assertAllClose(beta1_power[1], beta1_power[3])
+
+    def testUnrolledGan(self):
+        opts = trainer_opts(fused_steps=3, unrolling_steps=2)
+        with self.assertRaisesRegexp(AssertionError, 'fused steps'):
+            GAN.ImageUnrolledGan(
+                opts, Points(opts, np.zeros((16, 28, 28, 1))), np.ones(16))
+
+
+class InvertPointsTest(tf.test.TestCase):
+
+    def _invert(self, opts):
+        points = np.random.RandomState(0).rand(64, 28, 28, 1)
+        images = points[:4]
+        with GAN.ImageGan(opts, Points(opts, points), np.ones(64)) as gan:
+            gan._trained = True
+            reconstructions, z, err, norms = gan.invert_points(opts, images)
+        self.assertEqual(z.shape, (4, opts['latent_space_dim']))
+        # Every point gets the results of the same restart
+        self.assertAllClose(
+            err, np.mean(np.square(reconstructions - images), axis=(1, 2, 3)))
+        self.assertAllClose(norms, np.sum(np.square(z), axis=1))
+
+    def testSequential(self):
+        self._invert(trainer_opts(
+            inverse_metric=True, inverse_num=4, inverse_restarts=2))
+
+    def testBatched(self):
+        self._invert(trainer_opts(
+            inverse_metric=True, inverse_num=4, inverse_restarts=2,
+            inverse_batched=True))
+
+
+if __name__ == '__main__':
+    tf.test.main()
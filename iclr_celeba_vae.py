@@ -40,8 +40,12 @@ def main():
     opts = {}
     # Utility
     opts['random_seed'] = 66
+    opts['pipeline_seed'] = None # Seed of the data pipeline, None = not reproducible
     opts['dataset'] = 'celebA' # gmm, circle_gmm,  mnist, mnist3 ...
     opts['celebA_crop'] = 'closecrop' # closecrop or resizecrop
+    opts['data_cache_bytes'] = None # Memory limit for decoded pictures of the train and of the test set each, None = unlimited
+    opts['data_cache_dtype'] = 'float64' # float64, float32 or uint8
+    opts['data_decode_workers'] = 0 # Processes decoding JPEGs, 0 = decode in the training thread
     opts['data_dir'] = 'celebA/datasets/celeba/img_align_celeba'
     opts['trained_model_path'] = None #'models'
     opts['mnist_trained_model_file'] = None #'mnist_trainSteps_19999_yhat' # 'mnist_trainSteps_20000'
@@ -75,12 +79,19 @@ def main():
     opts['digit_classification_threshold'] = 0.999
     opts['inverse_metric'] = False # Use metric from the Unrolled GAN paper?
     opts['inverse_num'] = 100 # Number of real points to inverse.
+    opts['inverse_restarts'] = 5 # Random restarts of the inversion
+    opts['inverse_batched'] = False # Optimize the restarts at once? Slower on CPU
     opts['objective'] = None
 
     # Generative model parameters
     opts["init_std"] = FLAGS.init_std
     opts["init_bias"] = 0.0
     opts['latent_space_distr'] = 'normal' # uniform, normal
+    opts['reuse_graph'] = False # Build the graph once and re-initialize it for every AdaGAN step
+    opts['keep_generators'] = False # Sample the mixture from the exported component generators instead of stored samples
+    opts['generators_max_open'] = 2
+    opts['device_noise'] = False # Sample the training noise in the graph instead of feeding it
+    opts['prefetch_batches'] = 0 # Minibatches prepared ahead in a background thread, 0 = in the training thread
     opts['latent_space_dim'] = FLAGS.zdim
     opts["gan_epoch_num"] = 300
     opts['convolutions'] = True # If False then encoder is MLP of 3 layers
@@ -200,6 +211,7 @@ def main():
             res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
+    adagan.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
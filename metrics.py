@@ -194,25 +194,12 @@ class Metrics(object):
                 prob_max = tf.reduce_max(tf.nn.softmax(logits),
                                          reduction_indices=[1])
 
-                batch_size = opts['tf_run_batch_size']
-                batches_num = int(np.ceil((num_fake + 0.) / batch_size))
-                result = []
-                result_probs = []
-                result_is_confident = []
                 thresh = opts['digit_classification_threshold']
-                for idx in xrange(batches_num):
-                    end_idx = min(num_fake, (idx + 1) * batch_size)
-                    batch_fake = fake_points[idx * batch_size:end_idx]
-                    _res, prob = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: batch_fake,
-                                   dropout_keep_prob_ph: 1.})
-                    result.append(_res)
-                    result_probs.append(prob)
-                    result_is_confident.append(prob > thresh)
-                result = np.hstack(result)
-                result_probs = np.hstack(result_probs)
-                result_is_confident = np.hstack(result_is_confident)
+                result, result_probs = utils.run_batched(
+                    sess, opts, [trained_net, prob_max],
+                    {input_ph: fake_points},
+                    const_feed={dropout_keep_prob_ph: 1.})
+                result_is_confident = result_probs > thresh
                 assert len(result) == num_fake
                 assert len(result_probs) == num_fake
 
@@ -316,39 +303,23 @@ class Metrics(object):
                 prob_max = tf.reduce_max(tf.nn.softmax(logits),
                                          reduction_indices=[1])
 
-                batch_size = opts['tf_run_batch_size']
-                batches_num = int(np.ceil((num_fake + 0.) / batch_size))
-                result = []
-                result_probs = []
-                result_is_confident = []
                 thresh = opts['digit_classification_threshold']
-                for idx in xrange(batches_num):
-                    end_idx = min(num_fake, (idx + 1) * batch_size)
-                    batch_fake = fake_points[idx * batch_size:end_idx]
-                    if opts['mnist3_to_channels']:
-                        input1, input2, input3 = np.split(batch_fake, 3, axis=3)
-                    else:
-                        input1, input2, input3 = np.split(batch_fake, 3, axis=2)
-                    _res1, prob1 = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: input1,
-                                   dropout_keep_prob_ph: 1.})
-                    _res2, prob2 = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: input2,
-                                   dropout_keep_prob_ph: 1.})
-                    _res3, prob3 = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: input3,
-                                   dropout_keep_prob_ph: 1.})
-                    result.append(100 * _res1 + 10 * _res2 + _res3)
-                    result_probs.append(
-                        np.column_stack((prob1, prob2, prob3)))
-                    result_is_confident.append(
-                        (prob1 > thresh) * (prob2 > thresh) * (prob3 > thresh))
-                result = np.hstack(result)
-                result_probs = np.vstack(result_probs)
-                result_is_confident = np.hstack(result_is_confident)
+                # Views of the three digits of every picture
+                if opts['mnist3_to_channels']:
+                    inputs = np.split(fake_points, 3, axis=3)
+                else:
+                    inputs = np.split(fake_points, 3, axis=2)
+                digits = []
+                for input_ in inputs:
+                    digits.append(utils.run_batched(
+                        sess, opts, [trained_net, prob_max],
+                        {input_ph: input_},
+                        const_feed={dropout_keep_prob_ph: 1.}))
+                (_res1, prob1), (_res2, prob2), (_res3, prob3) = digits
+                result = 100 * _res1 + 10 * _res2 + _res3
+                result_probs = np.column_stack((prob1, prob2, prob3))
+                result_is_confident = \
+                    (prob1 > thresh) * (prob2 > thresh) * (prob3 > thresh)
                 assert len(result) == num_fake
                 assert len(result_probs) == num_fake
 
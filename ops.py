@@ -175,3 +175,97 @@ def log_sum_exp(logits):
                         logits,
                         tf.tile(l_max, tf.stack([1, logits.get_shape()[1]])))),
                     axis=1))
+
+def noise_placeholder(opts, name, std=1., batch_size=None):
+    """Placeholder for the latent noise, sampled in the graph if not fed.
+
+    With opts['device_noise'] the placeholder defaults to noise drawn by the
+    graph itself for batch_size points (opts['batch_size'] by default), so
+    that training steps do not have to feed it. Feeding the placeholder
+    still overrides the noise, e.g. for sampling, plots and inversion.
+    """
+    shape = [None, opts['latent_space_dim']]
+    if not opts.get('device_noise', False):
+        return tf.placeholder(tf.float32, shape, name=name)
+    if batch_size is None:
+        batch_size = opts['batch_size']
+    noise_shape = tf.stack([batch_size, opts['latent_space_dim']])
+    if opts['latent_space_distr'] == 'uniform':
+        noise = tf.random_uniform(noise_shape, -1., 1.)
+    elif opts['latent_space_distr'] == 'normal':
+        noise = tf.random_normal(noise_shape)
+    else:
+        assert False, 'Device noise supports only uniform and normal priors'
+    if std != 1.:
+        noise = std * noise
+    return tf.placeholder_with_default(noise, shape, name=name)
+
+def data_placeholder(opts, data, weights, name, batch_size=None):
+    """Placeholder for the real points, sampled in the graph if not fed.
+
+    With opts['graph_input'] the training points of data (an in-memory
+    datahandler.Data) are kept in a variable on the device and the
+    placeholder defaults to batch_size points (opts['batch_size'] by
+    default) sampled without replacement according to weights. So training
+    steps do not have to feed the real points. Feeding the placeholder still
+    overrides the minibatch, e.g. for evaluation.
+
+    The points are drawn with the Gumbel-top-k trick: perturbing the log
+    weights with Gumbel noise and taking the k largest gives the same
+    distribution as sequential sampling without replacement, i.e. as
+    utils.WeightedSampler.
+
+    Returns:
+        The placeholder, the list of ops initializing the variables with the
+        points and weights, and the feed dict for these ops. The points are
+        fed to the initializer rather than stored as a graph constant, which
+        would be limited to 2GB. The variables are not in the global
+        collection, so neither global_variables_initializer nor savers
+        touch them.
+    """
+    shape = [None] + list(data.shape[1:])
+    if not opts.get('graph_input', False):
+        return tf.placeholder(tf.float32, shape, name=name), [], {}
+    assert isinstance(data.X, np.ndarray), \
+        'Graph input supports only datasets loaded to memory'
+    if batch_size is None:
+        batch_size = opts['batch_size']
+    with tf.variable_scope('graph_input'):
+        points_init_ph = tf.placeholder(
+            tf.as_dtype(data.X.dtype), data.X.shape, name='points_init_ph')
+        weights_init_ph = tf.placeholder(
+            tf.float32, [len(weights)], name='weights_init_ph')
+        points = tf.Variable(points_init_ph, trainable=False,
+                             collections=[], name='points')
+        log_weights = tf.Variable(tf.log(weights_init_ph), trainable=False,
+                                  collections=[], name='log_weights')
+        uniform = tf.random_uniform(
+            tf.shape(log_weights), np.finfo(np.float32).tiny, 1.)
+        _, ids = tf.nn.top_k(log_weights - tf.log(-tf.log(uniform)),
+                             k=batch_size, sorted=True)
+        batch = tf.gather(points, ids)
+        if data.storage_dtype == 'uint8':
+            batch = tf.cast(batch, tf.float32) / 255.
+            if data.sym_normalized:
+                batch = (batch - 0.5) * 2.
+        else:
+            batch = tf.cast(batch, tf.float32)
+    # So that new weights can be loaded without a rebuild, see load_data_weights
+    tf.add_to_collection('data_weights_init', log_weights.initializer)
+    tf.add_to_collection('data_weights_ph', weights_init_ph)
+    init_ops = [points.initializer, log_weights.initializer]
+    init_feed_dict = {points_init_ph: data.X,
+                      weights_init_ph: np.asarray(weights, dtype=np.float32)}
+    return tf.placeholder_with_default(batch, shape, name=name), \
+        init_ops, init_feed_dict
+
+def load_data_weights(session, weights):
+    """Loads new weights of the points sampled by data_placeholder, if any.
+
+    """
+    init_ops = session.graph.get_collection('data_weights_init')
+    if not init_ops:
+        return
+    weights_ph = session.graph.get_collection('data_weights_ph')[0]
+    session.run(init_ops[0],
+                {weights_ph: np.asarray(weights, dtype=np.float32)})
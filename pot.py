@@ -110,15 +110,20 @@ class Pot(object):
         self._data = data
         self._data_weights = np.copy(weights)
         # Latent noise sampled ones to apply decoder while training
-        self._noise_for_plots = opts['pot_pz_std'] * utils.generate_noise(opts, 1000)
+        self._noise_for_plots = opts['pot_pz_std'] * utils.generate_noise(
+            opts, 1000, utils.random_state(opts, 'plots'))
         # Placeholders
         self._real_points_ph = None
         self._noise_ph = None
         # Init ops
         self._additional_init_ops = []
         self._init_feed_dict = {}
+        # Ops loading the dataset into the graph, see ops.data_placeholder
+        self._data_init_ops = []
+        self._data_init_feed_dict = {}
 
         # Main operations
+        self._export_generated = None # See export_generator
 
         # Optimizers
 
@@ -128,9 +133,10 @@ class Pot(object):
 
         # Make sure AdamOptimizer, if used in the Graph, is defined before
         # calling global_variables_initializer().
-        init = tf.global_variables_initializer()
-        self._session.run(init)
+        self._init = tf.global_variables_initializer()
+        self._session.run(self._init)
         self._session.run(self._additional_init_ops, self._init_feed_dict)
+        self._session.run(self._data_init_ops, self._data_init_feed_dict)
 
     def __enter__(self):
         return self
@@ -143,10 +149,32 @@ class Pot(object):
         # Finishing the session
         self._session.close()
 
+    def reset(self, opts):
+        """Re-initialize the POT for training a new component.
+
+        All the variables get their initial values, as if the POT was
+        constructed anew, but the graph (and the dataset loaded into it)
+        is reused, which saves rebuilding it for every AdaGAN step.
+        """
+        self._trained = False
+        self._session.run(self._init)
+        self._session.run(self._additional_init_ops, self._init_feed_dict)
+
+    def set_data_weights(self, weights):
+        """Set the weights of the training points used to sample minibatches.
+
+        """
+        self._data_weights = np.copy(weights)
+        ops.load_data_weights(self._session, self._data_weights)
+
     def train(self, opts):
         """Train a POT model.
 
         """
+        # Weights of the training points are fixed during the whole
+        # training, so we can precompute the minibatch sampler.
+        self._sampler = utils.WeightedSampler(
+            self._data_weights, utils.random_state(opts, 'sampler'))
         with self._session.as_default(), self._session.graph.as_default():
             self._train_internal(opts)
             self._trained = True
@@ -159,6 +187,34 @@ class Pot(object):
         with self._session.as_default(), self._session.graph.as_default():
             return self._sample_internal(opts, num)
 
+    def export_generator(self, opts, filename):
+        """Save the trained generator as a frozen graph.
+
+        The generator can be then sampled from after this POT is gone,
+        see utils.GeneratorPool.
+        """
+        assert self._trained, 'Can not export the un-trained POT'
+        if self._export_generated is None:
+            with self._session.graph.as_default():
+                self._add_export_ops(opts)
+        utils.freeze_generator(
+            self._session, filename, self._export_generated,
+            self._export_noise_ph, noise_std=opts['pot_pz_std'])
+
+    def _add_export_ops(self, opts):
+        # The decoder in the inference mode, fed only with the noise. Unlike
+        # self._generated it neither updates the batch norm moving averages
+        # nor depends on the real points through the device noise.
+        noise_ph = tf.placeholder(
+            tf.float32, [None, opts['latent_space_dim']],
+            name='export_noise_ph')
+        noise = noise_ph
+        if opts['pz_transform']:
+            noise = self.pz_sampler(opts, noise_ph, reuse=True)
+        self._export_noise_ph = noise_ph
+        self._export_generated = self.generator(
+            opts, noise, is_training=False, reuse=True, keep_prob=1e5)
+
     def train_mixture_discriminator(self, opts, fake_images):
         """Train classifier separating true data from points in fake_images.
 
@@ -177,53 +233,22 @@ class Pot(object):
 
     def _run_batch(self, opts, operation, placeholder, feed,
                    placeholder2=None, feed2=None):
-        """Wrapper around session.run to process huge data.
-
-        It is asumed that (a) first dimension of placeholder enumerates
-        separate points, and (b) that operation is independently applied
-        to every point, i.e. we can split it point-wisely and then merge
-        the results. The second placeholder is meant either for is_train
-        flag for batch-norm or probabilities of dropout.
+        """Wrapper around utils.run_batched to process huge data.
 
-        TODO: write util function which will be called both from this method
-        and MNIST classification evaluation as well.
+        feed is either a numpy array or a (lazy) datahandler.Data. The
+        second placeholder is meant either for is_train flag for batch-norm
+        or probabilities of dropout. Vector results of shape (n,) are
+        returned as (n, 1) arrays.
 
         """
-        assert len(feed.shape) > 0, 'Empry feed.'
-        num_points = feed.shape[0]
-        batch_size = opts['tf_run_batch_size']
-        batches_num = int(np.ceil((num_points + 0.) / batch_size))
-        result = []
-        for idx in xrange(batches_num):
-            if idx == batches_num - 1:
-                if feed2 is None:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:]})
-                else:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:],
-                                   placeholder2: feed2})
-            else:
-                if feed2 is None:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:
-                                                     (idx + 1) * batch_size]})
-                else:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:
-                                                     (idx + 1) * batch_size],
-                                   placeholder2: feed2})
-
-            if len(res.shape) == 1:
-                # convert (n,) vector to (n,1) array
-                res = np.reshape(res, [-1, 1])
-            result.append(res)
-        result = np.vstack(result)
-        assert len(result) == num_points
+        const_feed = None
+        if feed2 is not None:
+            const_feed = {placeholder2: feed2}
+        result = utils.run_batched(
+            self._session, opts, operation, {placeholder: feed}, const_feed)
+        if len(result.shape) == 1:
+            # convert (n,) vector to (n,1) array
+            result = np.reshape(result, [-1, 1])
         return result
 
     def _build_model_internal(self, opts):
@@ -1396,12 +1421,17 @@ class ImagePot(Pot):
         additional_losses = collections.OrderedDict()
 
         # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
-        enc_noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='enc_noise_ph')
+        real_points_ph, init_ops, init_feed_dict = ops.data_placeholder(
+            opts, self._data.data, self._data_weights, 'real_points_ph')
+        self._data_init_ops += init_ops
+        self._data_init_feed_dict.update(init_feed_dict)
+        # Pz noise and noise of the random encoder, one per real point. So
+        # the encoder pretraining compares as many points of Pz as of Qz.
+        noise_ph = ops.noise_placeholder(
+            opts, 'noise_ph', std=opts['pot_pz_std'],
+            batch_size=tf.shape(real_points_ph)[0])
+        enc_noise_ph = ops.noise_placeholder(
+            opts, 'enc_noise_ph', batch_size=tf.shape(real_points_ph)[0])
         lr_decay_ph = tf.placeholder(tf.float32)
         is_training_ph = tf.placeholder(tf.bool, name='is_training_ph')
         keep_prob_ph = tf.placeholder(tf.float32, name='keep_prob_ph')
@@ -1558,10 +1588,10 @@ class ImagePot(Pot):
             mean_loss = tf.reduce_mean(tf.square(mean_pz - mean_qz))
             cov_pz = tf.matmul(noise - mean_pz,
                                noise - mean_pz, transpose_a=True)
-            cov_pz /= opts['e_pretrain_bsize'] - 1.
+            cov_pz /= tf.cast(tf.shape(noise)[0], tf.float32) - 1.
             cov_qz = tf.matmul(encoded_training - mean_qz,
                                encoded_training - mean_qz, transpose_a=True)
-            cov_qz /= opts['e_pretrain_bsize'] - 1.
+            cov_qz /= tf.cast(tf.shape(encoded_training)[0], tf.float32) - 1.
             cov_loss = tf.reduce_mean(tf.square(cov_pz - cov_qz))
             loss_pretrain = mean_loss + cov_loss
 
@@ -1644,25 +1674,31 @@ class ImagePot(Pot):
     def pretrain(self, opts):
         steps_max = 200
         batch_size = opts['e_pretrain_bsize']
+        random_state = utils.random_state(opts, 'pretrain')
         for step in xrange(steps_max):
             train_size = self._data.num_points
-            data_ids = np.random.choice(train_size, min(train_size, batch_size),
-                                        replace=False)
-            batch_images = self._data.data[data_ids].astype(np.float)
-            batch_noise = opts['pot_pz_std'] *\
-                utils.generate_noise(opts, batch_size)
-            # Noise for the random encoder (if present)
-            batch_enc_noise = utils.generate_noise(opts, batch_size)
+            data_ids = random_state.choice(
+                train_size, min(train_size, batch_size), replace=False)
+            batch_images = self._data.data[data_ids]
+            batch_noise = None
+            batch_enc_noise = None
+            if not opts.get('device_noise', False):
+                batch_noise = opts['pot_pz_std'] *\
+                    utils.generate_noise(opts, len(data_ids), random_state)
+                # Noise for the random encoder (if present)
+                batch_enc_noise = utils.generate_noise(
+                    opts, len(data_ids), random_state)
 
             # Update encoder
             [_, loss_pretrain] = self._session.run(
                 [self._pretrain_optim,
                  self._loss_pretrain],
-                feed_dict={self._real_points_ph: batch_images,
-                           self._noise_ph: batch_noise,
-                           self._enc_noise_ph: batch_enc_noise,
-                           self._is_training_ph: True,
-                           self._keep_prob_ph: opts['dropout_keep_prob']})
+                feed_dict=utils.prune_feed(
+                    {self._real_points_ph: batch_images,
+                     self._noise_ph: batch_noise,
+                     self._enc_noise_ph: batch_enc_noise,
+                     self._is_training_ph: True,
+                     self._keep_prob_ph: opts['dropout_keep_prob']}))
 
             if opts['verbose'] == 2:
                 logging.error('Step %d/%d, loss=%f' % (step, steps_max, loss_pretrain))
@@ -1698,125 +1734,215 @@ class ImagePot(Pot):
             self.pretrain(opts)
             logging.error('Pretraining the encoder done')
 
-        for _epoch in xrange(opts["gan_epoch_num"]):
-
-            if opts['decay_schedule'] == "manual":
-                if _epoch == 30:
-                    decay = decay / 2.
-                if _epoch == 50:
-                    decay = decay / 5.
-                if _epoch == 100:
-                    decay = decay / 10.
-            elif opts['decay_schedule'] != "plateau":
-                assert type(1.0 * opts['decay_schedule']) == float
-                decay = 1.0 * 10**(-_epoch / float(opts['decay_schedule']))
-
-            if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
-                os.path.join(opts['work_dir'], opts['ckpt_dir'])
-                self._saver.save(self._session,
-                                 os.path.join(opts['work_dir'],
-                                              opts['ckpt_dir'],
-                                              'trained-pot'),
-                                 global_step=counter)
-
-            for _idx in xrange(batches_num):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                # Noise for the Pz=Qz GAN
-                batch_noise = opts['pot_pz_std'] *\
-                    utils.generate_noise(opts, opts['batch_size'])
-                # Noise for the random encoder (if present)
-                batch_enc_noise = utils.generate_noise(opts, opts['batch_size'])
-
-                # Update generator (decoder) and encoder
-                [_, loss, loss_rec, loss_match] = self._session.run(
-                    [self._optim,
-                     self._loss,
-                     self._loss_reconstruct,
-                     self._loss_match],
-                    feed_dict={self._real_points_ph: batch_images,
-                               self._noise_ph: batch_noise,
-                               self._enc_noise_ph: batch_enc_noise,
-                               self._lr_decay_ph: decay,
-                               self._is_training_ph: True,
-                               self._keep_prob_ph: opts['dropout_keep_prob']})
-
-                if opts['decay_schedule'] == "plateau":
-                    # First 30 epochs do nothing
-                    if _epoch >= 30:
-                        # If no significant progress was made in last 10 epochs
-                        # then decrease the learning rate.
-                        if loss < min(losses[-20 * batches_num:]):
-                            wait = 0
-                        else:
-                            wait += 1
-                        if wait > 10 * batches_num:
-                            decay = max(decay  / 1.4, 1e-6)
-                            logging.error('Reduction in learning rate: %f' % decay)
-                            wait = 0
-                losses.append(loss)
-                losses_rec.append(loss_rec)
-                losses_match.append(loss_match)
-                if opts['verbose'] >= 2:
-                    # logging.error('loss after %d steps : %f' % (counter, losses[-1]))
-                    logging.error('loss match  after %d steps : %f' % (counter, losses_match[-1]))
-
-                # Update discriminator in Z space (if any).
-                if self._d_optim is not None:
-                    for _st in range(opts['d_steps']):
-                        if opts['d_new_minibatch']:
-                            d_data_ids = np.random.choice(
-                                train_size, opts['batch_size'],
-                                replace=False, p=self._data_weights)
-                            d_batch_images = self._data.data[data_ids].astype(np.float)
-                            d_batch_enc_noise = utils.generate_noise(opts, opts['batch_size'])
-                        else:
-                            d_batch_images = batch_images
-                            d_batch_enc_noise = batch_enc_noise
-                        _ = self._session.run(
-                            [self._d_optim, self._d_loss],
-                            feed_dict={self._real_points_ph: d_batch_images,
-                                       self._noise_ph: batch_noise,
-                                       self._enc_noise_ph: d_batch_enc_noise,
-                                       self._lr_decay_ph: decay,
-                                       self._is_training_ph: True,
-                                       self._keep_prob_ph: opts['dropout_keep_prob']})
-                counter += 1
-                now = time.time()
-
-                rec_test = None
-                if opts['verbose'] and counter % 500 == 0:
-                    # Printing (training and test) loss values
-                    test = self._data.test_data[:200]
-                    [loss_rec_test, rec_test, g_mom_stats, loss_z_corr, additional_losses] = self._session.run(
-                        [self._loss_reconstruct, self._reconstruct_x, self._g_mom_stats, self._loss_z_corr,
-                         self._additional_losses],
-                        feed_dict={self._real_points_ph: test,
-                                   self._enc_noise_ph: utils.generate_noise(opts, len(test)),
-                                   self._is_training_ph: False,
-                                   self._noise_ph: batch_noise,
-                                   self._keep_prob_ph: 1e5})
-                    debug_str = 'Epoch: %d/%d, batch:%d/%d, batch/sec:%.2f' % (
-                        _epoch+1, opts['gan_epoch_num'], _idx+1,
-                        batches_num, float(counter) / (now - start_time))
-                    debug_str += '  [L=%.5f, Recon=%.5f, GanL=%.5f, Recon_test=%.5f' % (
-                        loss, loss_rec, loss_match, loss_rec_test)
-                    debug_str += ',' + ', '.join(
-                        ['%s=%.2g' % (k, v) for (k, v) in additional_losses.items()])
-                    logging.error(debug_str)
+        # Encoder noise outside of the training minibatches
+        enc_noise_random = utils.random_state(opts, 'enc_noise')
+        # With opts['graph_input'] the graph samples the real points itself
+        batches = utils.BatchPrefetcher(
+            opts, None if opts.get('graph_input', False) else self._data.data,
+            self._data_weights,
+            noise_std=opts['pot_pz_std'], enc_noise=True)
+        try:
+            for _epoch in xrange(opts["gan_epoch_num"]):
+
+                if opts['decay_schedule'] == "manual":
+                    if _epoch == 30:
+                        decay = decay / 2.
+                    if _epoch == 50:
+                        decay = decay / 5.
+                    if _epoch == 100:
+                        decay = decay / 10.
+                elif opts['decay_schedule'] != "plateau":
+                    assert type(1.0 * opts['decay_schedule']) == float
+                    decay = 1.0 * 10**(-_epoch / float(opts['decay_schedule']))
+
+                if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
+                    os.path.join(opts['work_dir'], opts['ckpt_dir'])
+                    self._saver.save(self._session,
+                                     os.path.join(opts['work_dir'],
+                                                  opts['ckpt_dir'],
+                                                  'trained-pot'),
+                                     global_step=counter)
+
+                for _idx in xrange(batches_num):
+                    # Noise for the Pz=Qz GAN is scaled by pot_pz_std, the other
+                    # one is noise for the random encoder (if present)
+                    batch_images, batch_noise, batch_enc_noise = batches.next()
+
+                    # Update generator (decoder) and encoder
+                    [_, loss, loss_rec, loss_match] = self._session.run(
+                        [self._optim,
+                         self._loss,
+                         self._loss_reconstruct,
+                         self._loss_match],
+                        feed_dict=utils.prune_feed(
+                            {self._real_points_ph: batch_images,
+                             self._noise_ph: batch_noise,
+                             self._enc_noise_ph: batch_enc_noise,
+                             self._lr_decay_ph: decay,
+                             self._is_training_ph: True,
+                             self._keep_prob_ph: opts['dropout_keep_prob']}))
+
+                    if opts['decay_schedule'] == "plateau":
+                        # First 30 epochs do nothing
+                        if _epoch >= 30:
+                            # If no significant progress was made in last 10
+                            # epochs then decrease the learning rate.
+                            if loss < min(losses[-20 * batches_num:]):
+                                wait = 0
+                            else:
+                                wait += 1
+                            if wait > 10 * batches_num:
+                                decay = max(decay  / 1.4, 1e-6)
+                                logging.error('Reduction in learning rate: %f' % decay)
+                                wait = 0
+                    losses.append(loss)
+                    losses_rec.append(loss_rec)
+                    losses_match.append(loss_match)
                     if opts['verbose'] >= 2:
-                        logging.error(g_mom_stats)
-                        logging.error(loss_z_corr)
-                    if counter % opts['plot_every'] == 0:
-                        # plotting the test images.
+                        # logging.error('loss after %d steps : %f' % (counter, losses[-1]))
+                        logging.error('loss match  after %d steps : %f' % (counter, losses_match[-1]))
+
+                    # Update discriminator in Z space (if any).
+                    if self._d_optim is not None:
+                        for _st in range(opts['d_steps']):
+                            if opts['d_new_minibatch']:
+                                d_batch_images = None
+                                if not opts.get('graph_input', False):
+                                    d_data_ids = self._sampler.sample(
+                                        opts['batch_size'])
+                                    d_batch_images = self._data.data[d_data_ids]
+                                d_batch_enc_noise = None
+                                if not opts.get('device_noise', False):
+                                    d_batch_enc_noise = utils.generate_noise(
+                                        opts, opts['batch_size'],
+                                        enc_noise_random)
+                            else:
+                                # None with opts['graph_input'], in which case
+                                # the graph draws a new minibatch anyway
+                                d_batch_images = batch_images
+                                d_batch_enc_noise = batch_enc_noise
+                            _ = self._session.run(
+                                [self._d_optim, self._d_loss],
+                                feed_dict=utils.prune_feed(
+                                    {self._real_points_ph: d_batch_images,
+                                     self._noise_ph: batch_noise,
+                                     self._enc_noise_ph: d_batch_enc_noise,
+                                     self._lr_decay_ph: decay,
+                                     self._is_training_ph: True,
+                                     self._keep_prob_ph:
+                                         opts['dropout_keep_prob']}))
+                    counter += 1
+                    now = time.time()
+
+                    rec_test = None
+                    if opts['verbose'] and counter % 500 == 0:
+                        # Printing (training and test) loss values
+                        test = self._data.test_data[:200]
+                        [loss_rec_test, rec_test, g_mom_stats, loss_z_corr, additional_losses] = self._session.run(
+                            [self._loss_reconstruct, self._reconstruct_x, self._g_mom_stats, self._loss_z_corr,
+                             self._additional_losses],
+                            feed_dict=utils.prune_feed(
+                                {self._real_points_ph: test,
+                                 self._enc_noise_ph: utils.generate_noise(
+                                     opts, len(test), enc_noise_random),
+                                 self._is_training_ph: False,
+                                 self._noise_ph: batch_noise,
+                                 self._keep_prob_ph: 1e5}))
+                        debug_str = 'Epoch: %d/%d, batch:%d/%d, ' \
+                            'batch/sec:%.2f' % (
+                            _epoch+1, opts['gan_epoch_num'], _idx+1,
+                            batches_num, float(counter) / (now - start_time))
+                        debug_str += '  [L=%.5f, Recon=%.5f, GanL=%.5f, Recon_test=%.5f' % (
+                            loss, loss_rec, loss_match, loss_rec_test)
+                        debug_str += ',' + ', '.join(
+                            ['%s=%.2g' % (k, v) for (k, v) in additional_losses.items()])
+                        logging.error(debug_str)
+                        if opts['verbose'] >= 2:
+                            logging.error(g_mom_stats)
+                            logging.error(loss_z_corr)
+                        if counter % opts['plot_every'] == 0:
+                            # plotting the test images.
+                            metrics = Metrics()
+                            merged = np.vstack(
+                                [rec_test[:8 * 10], test[:8 * 10]])
+                            r_ptr = 0
+                            w_ptr = 0
+                            for _ in range(8 * 10):
+                                merged[w_ptr] = test[r_ptr]
+                                merged[w_ptr + 1] = rec_test[r_ptr]
+                                r_ptr += 1
+                                w_ptr += 2
+                            metrics.make_plots(
+                                opts,
+                                counter,
+                                None,
+                                merged,
+                                prefix='test_reconstr_e%04d_mb%05d_' % (_epoch, _idx))
+
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        # Plotting intermediate results
                         metrics = Metrics()
-                        merged = np.vstack([rec_test[:8 * 10], test[:8 * 10]])
+                        # --Random samples from the model
+                        points_to_plot, sample_pz = self._session.run(
+                            [self._generated, self._noise],
+                            feed_dict={
+                                self._noise_ph:
+                                    self._noise_for_plots[0:num_plot],
+                                self._is_training_ph: False,
+                                self._keep_prob_ph: 1e5})
+                        Qz_num = 320
+                        sample_Qz = self._session.run(
+                            self._Qz,
+                            feed_dict={
+                                self._real_points_ph: self._data.data[:Qz_num],
+                                self._enc_noise_ph: utils.generate_noise(
+                                    opts, Qz_num, enc_noise_random),
+                                self._is_training_ph: False,
+                                self._keep_prob_ph: 1e5})
+                        # Searching least Gaussian 2d projection
+                        proj_mat, check = self.least_gaussian_2d(
+                            opts, sample_Qz)
+                        # Projecting samples from Qz and Pz on this 2d plain
+                        metrics.Qz = np.dot(sample_Qz, proj_mat)
+                        # metrics.Pz = np.dot(self._noise_for_plots, proj_mat)
+                        metrics.Pz = np.dot(sample_pz, proj_mat)
+                        if self._data.labels != None:
+                            metrics.Qz_labels = self._data.labels[:Qz_num]
+                        else:
+                            metrics.Qz_labels = None
+                        metrics.l2s = losses[:]
+                        metrics.losses_match = [opts['pot_lambda'] * el for el in losses_match]
+                        metrics.losses_rec = [opts['reconstr_w'] * el for el in losses_rec]
+                        to_plot = [points_to_plot, 0 * batch_images[:16], batch_images]
+                        if rec_test is not None:
+                            to_plot += [0 * batch_images[:16], rec_test[:64]]
+                        metrics.make_plots(
+                            opts,
+                            counter,
+                            None,
+                            np.vstack(to_plot),
+                            prefix='sample_e%04d_mb%05d_' % (_epoch, _idx) if rec_test is None \
+                                    else 'sample_with_test_e%04d_mb%05d_' % (_epoch, _idx))
+
+
+                        # --Reconstructions for the train and test points
+                        num_real_p = 8 * 10
+                        reconstructed, real_p = self._session.run(
+                            [self._reconstruct_x, self._real_points],
+                            feed_dict={
+                                self._real_points_ph:
+                                    self._data.data[:num_real_p],
+                                self._enc_noise_ph: utils.generate_noise(
+                                    opts, num_real_p, enc_noise_random),
+                                self._is_training_ph: True,
+                                self._keep_prob_ph: 1e5})
+                        points = real_p
+                        merged = np.vstack([reconstructed, points])
                         r_ptr = 0
                         w_ptr = 0
                         for _ in range(8 * 10):
-                            merged[w_ptr] = test[r_ptr]
-                            merged[w_ptr + 1] = rec_test[r_ptr]
+                            merged[w_ptr] = points[r_ptr]
+                            merged[w_ptr + 1] = reconstructed[r_ptr]
                             r_ptr += 1
                             w_ptr += 2
                         metrics.make_plots(
@@ -1824,76 +1950,10 @@ class ImagePot(Pot):
                             counter,
                             None,
                             merged,
-                            prefix='test_reconstr_e%04d_mb%05d_' % (_epoch, _idx))
-
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    # Plotting intermediate results
-                    metrics = Metrics()
-                    # --Random samples from the model
-                    points_to_plot, sample_pz = self._session.run(
-                        [self._generated, self._noise],
-                        feed_dict={
-                            self._noise_ph: self._noise_for_plots[0:num_plot],
-                            self._is_training_ph: False,
-                            self._keep_prob_ph: 1e5})
-                    Qz_num = 320
-                    sample_Qz = self._session.run(
-                        self._Qz,
-                        feed_dict={
-                            self._real_points_ph: self._data.data[:Qz_num],
-                            self._enc_noise_ph: utils.generate_noise(opts, Qz_num),
-                            self._is_training_ph: False,
-                            self._keep_prob_ph: 1e5})
-                    # Searching least Gaussian 2d projection
-                    proj_mat, check = self.least_gaussian_2d(opts, sample_Qz)
-                    # Projecting samples from Qz and Pz on this 2d plain
-                    metrics.Qz = np.dot(sample_Qz, proj_mat)
-                    # metrics.Pz = np.dot(self._noise_for_plots, proj_mat)
-                    metrics.Pz = np.dot(sample_pz, proj_mat)
-                    if self._data.labels != None:
-                        metrics.Qz_labels = self._data.labels[:Qz_num]
-                    else:
-                        metrics.Qz_labels = None
-                    metrics.l2s = losses[:]
-                    metrics.losses_match = [opts['pot_lambda'] * el for el in losses_match]
-                    metrics.losses_rec = [opts['reconstr_w'] * el for el in losses_rec]
-                    to_plot = [points_to_plot, 0 * batch_images[:16], batch_images]
-                    if rec_test is not None:
-                        to_plot += [0 * batch_images[:16], rec_test[:64]]
-                    metrics.make_plots(
-                        opts,
-                        counter,
-                        None,
-                        np.vstack(to_plot),
-                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx) if rec_test is None \
-                                else 'sample_with_test_e%04d_mb%05d_' % (_epoch, _idx))
-
-
-                    # --Reconstructions for the train and test points
-                    num_real_p = 8 * 10
-                    reconstructed, real_p = self._session.run(
-                        [self._reconstruct_x, self._real_points],
-                        feed_dict={
-                            self._real_points_ph: self._data.data[:num_real_p],
-                            self._enc_noise_ph: utils.generate_noise(opts, num_real_p),
-                            self._is_training_ph: True,
-                            self._keep_prob_ph: 1e5})
-                    points = real_p
-                    merged = np.vstack([reconstructed, points])
-                    r_ptr = 0
-                    w_ptr = 0
-                    for _ in range(8 * 10):
-                        merged[w_ptr] = points[r_ptr]
-                        merged[w_ptr + 1] = reconstructed[r_ptr]
-                        r_ptr += 1
-                        w_ptr += 2
-                    metrics.make_plots(
-                        opts,
-                        counter,
-                        None,
-                        merged,
-                        prefix='reconstr_e%04d_mb%05d_' % (_epoch, _idx))
-                    sample_prev = points_to_plot[:]
+                            prefix='reconstr_e%04d_mb%05d_' % (_epoch, _idx))
+                        sample_prev = points_to_plot[:]
+        finally:
+            batches.close()
         if _epoch > 0:
             os.path.join(opts['work_dir'], opts['ckpt_dir'])
             self._saver.save(self._session,
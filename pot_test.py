@@ -0,0 +1,78 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Tests of the POT trainer.
+
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+import pot as POT
+from testutils import Points, trainer_opts
+
+
+class PretrainTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self._work_dir, 'checkpoints'))
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _opts(self, **kwargs):
+        opts = trainer_opts(
+            batch_size=8, e_pretrain=True, e_pretrain_bsize=32,
+            pot_pz_std=2., pz_transform=False, z_test='gan',
+            z_test_corr_w=1., z_test_proj_dim=10, pot_lambda=1.,
+            reconstr_w=1., recon_loss='l2sq', adv_c_loss='none',
+            e_is_random=False, e_add_noise=False, convolutions=True,
+            e_arch='dcgan',
+            e_num_filters=8, e_num_layers=2, e_3x3_conv=0, g_arch='dcgan',
+            g_num_layers=2, g_3x3_conv=0, g_stride1_deconv=False,
+            d_num_layers=2, batch_norm=True, dropout=False,
+            dropout_keep_prob=1., data_augm=False, gan_p_trick=False,
+            d_new_minibatch=False, decay_schedule='manual',
+            work_dir=self._work_dir, ckpt_dir='checkpoints',
+            save_every_epoch=1000)
+        opts.update(kwargs)
+        return opts
+
+    def _check_pretrain(self, opts):
+        points = np.random.RandomState(0).rand(64, 28, 28, 1)
+        with POT.ImagePot(opts, Points(opts, points), np.ones(64)) as pot:
+            pot.pretrain(opts)
+            feed_dict = {pot._real_points_ph: points[:32],
+                         pot._is_training_ph: False,
+                         pot._keep_prob_ph: 1.}
+            if not opts.get('device_noise', False):
+                feed_dict[pot._noise_ph] = 2. * np.random.RandomState(
+                    1).randn(32, opts['latent_space_dim'])
+            noise, qz, loss = pot._session.run(
+                [pot._noise, pot._Qz, pot._loss_pretrain], feed_dict)
+        # As many points of Pz as of Qz, compared by the unbiased
+        # covariances
+        self.assertEqual(noise.shape, (32, opts['latent_space_dim']))
+        mean_loss = np.mean(np.square(
+            np.mean(noise, axis=0) - np.mean(qz, axis=0)))
+        cov_loss = np.mean(np.square(
+            np.cov(noise, rowvar=False) - np.cov(qz, rowvar=False)))
+        self.assertAllClose(loss, mean_loss + cov_loss, rtol=1e-4)
+        # Pz has covariance pot_pz_std ** 2 * I
+        self.assertAllClose(np.diag(np.cov(noise, rowvar=False)),
+                            4. * np.ones(opts['latent_space_dim']),
+                            rtol=0.7)
+
+    def testFedNoise(self):
+        self._check_pretrain(self._opts())
+
+    def testDeviceNoise(self):
+        self._check_pretrain(self._opts(device_noise=True))
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,37 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Crops and resizes all CelebA pictures once and stores them in one file.
+
+The resulting celeba_<crop>_64x64.npy file is written to the CelebA data
+directory and picked up by Data, which then reads the pictures memory-mapped
+instead of decoding JPEGs during training.
+"""
+
+import logging
+import tensorflow as tf
+import datahandler
+
+flags = tf.app.flags
+flags.DEFINE_string("data_dir", 'celebA/datasets/celeba/img_align_celeba',
+                    "Directory with the CelebA pictures")
+flags.DEFINE_string("crop", 'both', "closecrop, resizecrop or both")
+flags.DEFINE_integer("num_samples", datahandler.CELEBA_NUM_SAMPLES,
+                     "Number of pictures in the dataset")
+FLAGS = flags.FLAGS
+
+def main():
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(message)s')
+    if FLAGS.crop == 'both':
+        crop_styles = ['closecrop', 'resizecrop']
+    else:
+        crop_styles = [FLAGS.crop]
+    for crop_style in crop_styles:
+        logging.debug('Preprocessing CelebA with %s' % crop_style)
+        filename = datahandler.preprocess_celeba(
+            FLAGS.data_dir, crop_style, FLAGS.num_samples)
+        logging.debug('Saved %s' % filename)
+
+if __name__ == '__main__':
+    main()
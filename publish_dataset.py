@@ -0,0 +1,48 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Publishes a dataset in shared memory for runs with opts['dataset_shared'].
+
+Run it once before starting a sweep of experiments on one host, with the
+same dataset, normalization and dtype as the experiments use. Every
+DataHandler created with opts['dataset_shared'] = True then memory-maps the
+published read-only arrays instead of loading its own copy. Run it with
+--remove after the sweep to free the memory.
+"""
+
+import logging
+import shutil
+import os
+import tensorflow as tf
+import datahandler
+
+flags = tf.app.flags
+flags.DEFINE_string("dataset", 'mnist', "mnist, zalando, cifar10, dsprites or guitars")
+flags.DEFINE_string("data_dir", 'mnist', "Directory with the dataset files")
+flags.DEFINE_bool("input_normalize_sym", False, "Normalize data to [-1, 1]")
+flags.DEFINE_string("data_dtype", 'float32', "float64, float32 or uint8")
+flags.DEFINE_bool("remove", False, "Remove the published dataset")
+FLAGS = flags.FLAGS
+
+def main():
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(message)s')
+    opts = {}
+    opts['dataset'] = FLAGS.dataset
+    opts['data_dir'] = FLAGS.data_dir
+    opts['input_normalize_sym'] = FLAGS.input_normalize_sym
+    opts['data_dtype'] = FLAGS.data_dtype
+    opts['dataset_shared'] = True
+    shared_dir = datahandler.dataset_cache_dir(opts)
+    assert shared_dir is not None, \
+        '%s can not be shared' % opts['dataset']
+    if FLAGS.remove:
+        if os.path.isdir(shared_dir):
+            shutil.rmtree(shared_dir)
+        logging.debug('Removed %s' % shared_dir)
+    else:
+        datahandler.DataHandler(opts)
+        logging.debug('Published to %s' % shared_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Helpers shared by the tests and benchmarks.
+
+Small trainers on in-memory points and the loop versions of vectorized
+computations, which the tests check the vectorized ones against and the
+benchmarks time them with.
+"""
+
+import numpy as np
+import datahandler
+
+
+class Points(object):
+    """The few attributes of datahandler.DataHandler the trainers need.
+
+    """
+
+    def __init__(self, opts, points):
+        self.data = datahandler.Data(opts, points)
+        self.data_shape = points.shape[1:]
+        self.num_points = len(points)
+
+
+def trainer_opts(**kwargs):
+    """Options of a small GAN trainer, updated with kwargs.
+
+    """
+    opts = {'data_dir': '', 'input_normalize_sym': False,
+            'data_dtype': 'float32', 'dataset': 'mnist',
+            'latent_space_distr': 'normal', 'latent_space_dim': 5,
+            'batch_size': 16, 'd_steps': 1, 'g_steps': 1,
+            'optimizer': 'adam', 'opt_learning_rate': 1e-3,
+            'opt_d_learning_rate': 1e-3, 'opt_g_learning_rate': 1e-3,
+            'opt_beta1': 0.5, 'init_std': 0.02, 'init_bias': 0.,
+            'batch_norm_eps': 1e-5, 'batch_norm_decay': 0.9,
+            'conv_filters_dim': 4, 'd_num_filters': 8, 'g_num_filters': 8,
+            'inverse_metric': False, 'tf_run_batch_size': 100,
+            'gan_epoch_num': 2, 'verbose': False, 'plot_every': 10 ** 9,
+            'early_stop': -1}
+    opts.update(kwargs)
+    return opts
+
+
+def lambda_star_loop(beta, ratios):
+    """Lambda search of AdaGan._compute_data_weights_theory_star used before.
+
+    """
+    num = len(ratios)
+    ratios_sorted = np.sort(ratios)
+    cumsum_ratios = np.cumsum(ratios_sorted)
+    for i in xrange(num):
+        _lambda = beta * num * (1. + (1.-beta) / beta \
+                / num * cumsum_ratios[i]) / (i + 1.)
+        if i == num - 1:
+            if _lambda >= (1. - beta) * ratios_sorted[-1]:
+                return _lambda
+        else:
+            if _lambda <= (1 - beta) * ratios_sorted[i + 1] \
+                    and _lambda >= (1 - beta) * ratios_sorted[i]:
+                return _lambda
+    return None
+
+
+def lambda_dagger_loop(beta, ratios):
+    """Lambda search of AdaGan._compute_data_weights_theory_dagger used before.
+
+    """
+    num = len(ratios)
+    ratios_sorted = np.sort(ratios)
+    cumsum_ratios = np.cumsum(ratios_sorted)
+    for i in range(int(np.floor(num * beta - 1)), num):
+        if (i + 1.) / num < beta:
+            continue
+        _lambda = ((i + 1.) / num - beta) / (1. - beta) * num \
+            / (cumsum_ratios[i] + 1e-7)
+        if i == num - 1:
+            if _lambda < 1. / (1. - beta) / (ratios_sorted[i] + 1e-7):
+                return _lambda
+        else:
+            if _lambda < 1. / (1. - beta) / (ratios_sorted[i] + 1e-7) \
+                    and _lambda >= 1. / (1. - beta) / \
+                        (ratios_sorted[i + 1] + 1e-7):
+                return _lambda
+    return None
+
+
+def weights_from_lambda_star(beta, ratios, _lambda):
+    num = len(ratios)
+    if _lambda is None:
+        return np.ones(num) / (num + 0.)
+    weights = np.zeros(num)
+    mask = ratios <= (_lambda / (1.-beta))
+    weights[mask] = (_lambda - (1-beta)*ratios[mask]) / num / beta
+    return weights / np.sum(weights)
+
+
+def weights_from_lambda_dagger(beta, ratios, _lambda):
+    num = len(ratios)
+    if _lambda is None:
+        return np.ones(num) / (num + 0.)
+    weights = np.zeros(num)
+    mask = ratios <= (1. / (1.-beta) / _lambda)
+    weights[mask] = (1. - _lambda * (1-beta) * ratios[mask]) / num / beta
+    return weights / np.sum(weights)
+
+
+def sample_gmm_loop(means, variance, num, random_state=np.random):
+    """Per-point sampling of the GMM datasets used before.
+
+    Component ids are drawn first, as datahandler.sample_gmm does.
+    """
+    dim = means.shape[1]
+    comp_ids = random_state.randint(len(means), size=num)
+    X = np.zeros((num, dim, 1, 1))
+    for idx in xrange(num):
+        mean = means[comp_ids[idx]]
+        cov = variance * np.identity(dim)
+        X[idx, :, 0, 0] = random_state.multivariate_normal(mean, cov, 1)
+    return X
+
+
+def stack_mnist3_loop(X, y, ids, to_channels):
+    """Per-point construction of mnist3 used before.
+
+    """
+    num = len(ids)
+    if to_channels:
+        X3 = np.zeros((num, 28, 28, 3), dtype=X.dtype)
+        y3 = np.zeros(num)
+        for idx, _id in enumerate(ids):
+            X3[idx, :, :, 0] = np.squeeze(X[_id[0]], axis=2)
+            X3[idx, :, :, 1] = np.squeeze(X[_id[1]], axis=2)
+            X3[idx, :, :, 2] = np.squeeze(X[_id[2]], axis=2)
+            y3[idx] = y[_id[0]] * 100 + y[_id[1]] * 10 + y[_id[2]]
+    else:
+        X3 = np.zeros((num, 28, 3 * 28, 1), dtype=X.dtype)
+        y3 = np.zeros(num)
+        for idx, _id in enumerate(ids):
+            X3[idx, :, 0:28, 0] = np.squeeze(X[_id[0]], axis=2)
+            X3[idx, :, 28:56, 0] = np.squeeze(X[_id[1]], axis=2)
+            X3[idx, :, 56:84, 0] = np.squeeze(X[_id[2]], axis=2)
+            y3[idx] = y[_id[0]] * 100 + y[_id[1]] * 10 + y[_id[2]]
+    return X3, y3.astype(int)
+
+
+def transform_mnist_loop(X, ids, modes):
+    """Per-point construction of mnist_mod used before.
+
+    """
+    return np.array([datahandler.transform_mnist(X[idx], mode)
+                     for idx, mode in zip(ids, modes)])
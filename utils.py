@@ -10,8 +10,15 @@ import tensorflow as tf
 import os
 import sys
 import copy
+import collections
+import json
+import threading
+import time
+import zlib
 import numpy as np
 import logging
+import six
+from six.moves import queue
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
@@ -19,21 +26,392 @@ import metrics as metrics_lib
 # from metrics import Metrics
 from tqdm import tqdm
 
-def generate_noise(opts, num=100):
+# Number of random streams created so far, per stream name
+_random_streams = collections.defaultdict(int)
+
+def random_state(opts, name):
+    """Returns a new np.random.RandomState for the random stream name.
+
+    If opts['pipeline_seed'] is None, the state is seeded from the OS just
+    as np.random is. Otherwise every call returns an independent stream
+    determined by the seed, name and the number of streams with this name
+    created before. So runs with the same seed are reproducible, even when
+    the streams are consumed by different threads.
+    """
+    seed = opts.get('pipeline_seed', None)
+    if seed is None:
+        return np.random.RandomState()
+    count = _random_streams[name]
+    _random_streams[name] += 1
+    return np.random.RandomState(
+        [seed, zlib.crc32(name) & 0xffffffff, count])
+
+def generate_noise(opts, num=100, random_state=None, out=None):
     """Generate latent noise.
+
+    The normal prior is isotropic, so the noise is drawn with standard_normal
+    directly (which gives the same numbers as multivariate_normal with the
+    identity covariance, without its SVD). If out is a float32 array of shape
+    (num, latent_space_dim), the noise is written into it and out is returned.
     """
+    if random_state is None:
+        random_state = np.random
+    shape = (num, opts["latent_space_dim"])
     noise = None
     if opts['latent_space_distr'] == 'uniform':
-        noise = np.random.uniform(
-            -1, 1, [num, opts["latent_space_dim"]]).astype(np.float32)
+        noise = random_state.uniform(-1, 1, shape)
     elif opts['latent_space_distr'] == 'normal':
-        mean = np.zeros(opts["latent_space_dim"])
-        cov = np.identity(opts["latent_space_dim"])
-        noise = np.random.multivariate_normal(
-            mean, cov, num).astype(np.float32)
+        noise = random_state.standard_normal(shape)
     elif opts['latent_space_distr'] == 'mnist':
-        noise = np.random.rand(1, opts['latent_space_dim'])
-    return noise
+        return random_state.rand(1, opts['latent_space_dim'])
+    if out is None:
+        return noise.astype(np.float32)
+    out[...] = noise
+    return out
+
+class NoiseGenerator(object):
+    """Generates latent noise for bulk_steps minibatches at once.
+
+    next() returns the noise for one minibatch of num points, scaled by std.
+    The noise for the following bulk_steps minibatches is drawn with a
+    single call of generate_noise, which saves the per-call overhead of
+    numpy for small num and latent_space_dim. Every refill uses a new
+    buffer, so returned minibatches are never overwritten.
+    """
+
+    def __init__(self, opts, num, random_state=None, bulk_steps=1, std=1.):
+        self._opts = opts
+        self._num = num
+        self._random = random_state
+        self._bulk_steps = max(1, bulk_steps)
+        if opts['latent_space_distr'] == 'mnist':
+            # generate_noise returns a single point for this prior
+            self._bulk_steps = 1
+        self._std = std
+        self._noise = None
+        self._next = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._noise is None or self._next == self._bulk_steps:
+            self._noise = generate_noise(
+                self._opts, self._num * self._bulk_steps, self._random)
+            if self._std != 1.:
+                self._noise *= self._std
+            self._next = 0
+        start = self._next * self._num
+        self._next += 1
+        return self._noise[start:start + self._num]
+
+    __next__ = next
+
+def prune_feed(feed_dict):
+    """Drops the placeholders fed with None from feed_dict.
+
+    Used for the noise and real points placeholders, which sample the noise
+    and minibatches in the graph when opts['device_noise'] and
+    opts['graph_input'] are set, see ops.noise_placeholder and
+    ops.data_placeholder.
+    """
+    return dict((ph, value) for ph, value in feed_dict.items()
+                if value is not None)
+
+class WeightedSampler(object):
+    """Draws ids of training points from a fixed discrete distribution.
+
+    np.random.choice(num, size, p=weights) recomputes the cumulative
+    distribution of weights on every call, which costs O(num) per minibatch.
+    This class computes it once (i.e. once per AdaGAN step) and then draws
+    every minibatch with a binary search in O(size * log(num)).
+
+    Sampling without replacement draws points independently and drops the
+    repeated ones, keeping the order of the first occurrences. This gives
+    exactly the same distribution as np.random.choice(..., replace=False, p=)
+    which removes the chosen points one by one and renormalizes.
+    """
+
+    def __init__(self, weights, random_state=None):
+        if random_state is None:
+            random_state = np.random
+        self._random = random_state
+        weights = np.asarray(weights, dtype=np.float64)
+        assert weights.ndim == 1 and len(weights) > 0, 'Empty weights'
+        self._num = len(weights)
+        self._support = np.count_nonzero(weights)
+        self._uniform = np.all(weights == weights[0])
+        self._p = weights / np.sum(weights)
+        self._cdf = None if self._uniform else np.cumsum(self._p)
+
+    def __len__(self):
+        return self._num
+
+    def _draw(self, size):
+        if self._uniform:
+            return self._random.randint(self._num, size=size)
+        ids = np.searchsorted(self._cdf, self._random.uniform(size=size),
+                              side='right')
+        # Guard against the last cdf value being slightly below 1.
+        return np.minimum(ids, self._num - 1)
+
+    def sample(self, size, replace=False):
+        """Returns a (size,) array of point ids.
+
+        """
+        if replace:
+            return self._draw(size)
+        if size > self._support:
+            raise ValueError('Fewer non-zero weights than size')
+        if 2 * size > self._support:
+            # Rejection sampling gets slow when we need to draw most of the
+            # support, so fall back to numpy.
+            p = None if self._uniform else self._p
+            return self._random.choice(self._num, size, replace=False, p=p)
+        ids = np.zeros(0, dtype=np.int64)
+        while len(ids) < size:
+            draws = np.concatenate((ids, self._draw(size - len(ids))))
+            _, first = np.unique(draws, return_index=True)
+            ids = draws[np.sort(first)]
+        return ids
+
+class BatchPrefetcher(object):
+    """Prepares training minibatches in a background thread.
+
+    Every minibatch is a tuple (batch_images, batch_noise, batch_enc_noise)
+    with ids drawn according to the data weights,
+    noise scaled by noise_std and batch_enc_noise being None unless
+    enc_noise is True. With opts['prefetch_batches'] > 0 a background thread
+    keeps at most that many ready minibatches in a queue. By default (0)
+    minibatches are prepared synchronously in next(). The thread is stopped
+    by close(), which the training loops call in a finally clause.
+
+    All the randomness comes from the own 'batches' stream of random_state,
+    so that with opts['pipeline_seed'] the minibatches are reproducible.
+    The noise is generated opts['noise_bulk_steps'] (16 by default)
+    minibatches at a time, see NoiseGenerator. With opts['device_noise'] the
+    graph samples the noise itself and both noise arrays are None. Likewise
+    batch_images is None if data is None, i.e. when the graph samples the
+    real points itself (see ops.data_placeholder).
+
+    The time the training loop spends waiting in next() is recorded, so that
+    log_stats() can report how the loop splits between input and compute.
+    """
+
+    def __init__(self, opts, data, weights, noise_std=1., enc_noise=False):
+        self._opts = opts
+        self._data = data
+        self._random = random_state(opts, 'batches')
+        self._sampler = WeightedSampler(weights, self._random)
+        bulk_steps = opts.get('noise_bulk_steps', 16)
+        self._noise = None
+        self._enc_noise = None
+        if not opts.get('device_noise', False):
+            self._noise = NoiseGenerator(
+                opts, opts['batch_size'], self._random, bulk_steps, noise_std)
+        if enc_noise and not opts.get('device_noise', False):
+            self._enc_noise = NoiseGenerator(
+                opts, opts['batch_size'], self._random, bulk_steps)
+        self._capacity = opts.get('prefetch_batches', 0)
+        self.batches = 0
+        self.wait_time = 0.
+        self._start_time = None
+        self._thread = None
+        if self._capacity > 0:
+            self._queue = queue.Queue(self._capacity)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._produce)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _make_batch(self):
+        opts = self._opts
+        batch_images = None
+        if self._data is not None:
+            data_ids = self._sampler.sample(opts['batch_size'])
+            batch_images = self._data[data_ids]
+        batch_noise = None
+        if self._noise is not None:
+            batch_noise = self._noise.next()
+        batch_enc_noise = None
+        if self._enc_noise is not None:
+            batch_enc_noise = self._enc_noise.next()
+        return batch_images, batch_noise, batch_enc_noise
+
+    def _produce(self):
+        while not self._stop.is_set():
+            try:
+                item = (self._make_batch(), None)
+            except Exception:
+                item = (None, sys.exc_info())
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[1] is not None:
+                return
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        if self._start_time is None:
+            self._start_time = start
+        if self._thread is None:
+            batch = self._make_batch()
+        else:
+            batch, exc_info = self._queue.get()
+            if exc_info is not None:
+                six.reraise(*exc_info)
+        self.wait_time += time.time() - start
+        self.batches += 1
+        return batch
+
+    __next__ = next
+
+    def close(self):
+        """Stops the background thread and logs the timing stats.
+
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.log_stats()
+
+    def log_stats(self):
+        if self._start_time is None:
+            return
+        total = time.time() - self._start_time
+        compute = total - self.wait_time
+        logging.debug(
+            'Minibatches: %d, %.1f ms/step, waiting for input %.1f ms/step '
+            '(%.1f%%), compute %.1f ms/step' % (
+                self.batches, 1000. * total / max(self.batches, 1),
+                1000. * self.wait_time / max(self.batches, 1),
+                100. * self.wait_time / max(total, 1e-8),
+                1000. * compute / max(self.batches, 1)))
+
+def prefetched(iterable, capacity=1):
+    """Iterates over iterable, preparing the next items in a background thread.
+
+    At most capacity prepared items are kept in a queue. Exceptions raised
+    by iterable are re-raised in the consuming thread.
+    """
+    items = queue.Queue(capacity)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = items.get()
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def run_batched(session, opts, fetches, feeds, const_feed=None,
+                num_points=None, out=None):
+    """Runs point-wise fetches on many points, in chunks of tf_run_batch_size.
+
+    It is asumed that (a) first dimension of every placeholder in feeds
+    enumerates separate points, and (b) that fetches are independently
+    applied to every point, i.e. we can split them point-wisely and then
+    merge the results.
+
+    Results are written in place into arrays preallocated once the first
+    chunk is done, so the peak memory is that of the results plus a chunk.
+    The next chunk is sliced (or read from disk) and converted to the dtype
+    of its placeholder in a background thread while the current one runs.
+
+    Args:
+        fetches: a tensor or a list of tensors.
+        feeds: dict mapping placeholders to their points. The points are
+            either a numpy array, a (lazy) datahandler.Data, which is read
+            chunk by chunk with iter_batches, or an iterator yielding
+            consecutive chunks of tf_run_batch_size points, in which case
+            num_points has to be given.
+        const_feed: dict of placeholders fed with the same value for every
+            chunk, e.g. is_training flags or dropout probabilities.
+        out: array (list of arrays if fetches is a list) to write the
+            results into, e.g. an np.memmap. Allocated if None.
+
+    Returns:
+        Results for all the points, an array or a list of arrays.
+    """
+    batch_size = opts['tf_run_batch_size']
+    single = not isinstance(fetches, (list, tuple))
+    if single:
+        fetches = [fetches]
+        if out is not None:
+            out = [out]
+    placeholders = list(feeds.keys())
+    chunk_iters = []
+    for placeholder in placeholders:
+        points = feeds[placeholder]
+        if hasattr(points, 'iter_batches'):
+            chunks = points.iter_batches(batch_size)
+        elif isinstance(points, np.ndarray):
+            chunks = (points[start:start + batch_size]
+                      for start in xrange(0, len(points), batch_size))
+        else:
+            chunk_iters.append(iter(points))
+            continue
+        assert num_points in (None, len(points)), \
+            'Feeds with different numbers of points'
+        num_points = len(points)
+        chunk_iters.append(chunks)
+    assert num_points is not None, 'Number of points is not known'
+    assert num_points > 0, 'Empty feed.'
+
+    def feed_dicts():
+        for chunks in six.moves.zip(*chunk_iters):
+            feed_dict = dict(const_feed or {})
+            for placeholder, chunk in zip(placeholders, chunks):
+                feed_dict[placeholder] = np.asarray(
+                    chunk, dtype=placeholder.dtype.as_numpy_dtype)
+            yield feed_dict
+
+    start = 0
+    for feed_dict in prefetched(feed_dicts()):
+        results = session.run(fetches, feed_dict=feed_dict)
+        num = len(results[0])
+        if out is None:
+            out = [np.empty((num_points,) + res.shape[1:], dtype=res.dtype)
+                   for res in results]
+        for result, res in zip(out, results):
+            result[start:start + num] = res
+        start += num
+    assert start == num_points, 'Got results for %d of %d points' % (
+        start, num_points)
+    return out[0] if single else out
 
 class ArraySaver(object):
     """A simple class helping with saving/loading numpy arrays from files.
@@ -64,6 +442,129 @@ class ArraySaver(object):
         else:
             assert False, 'Unknown save / load mode'
 
+class SampleStore(object):
+    """Stores numpy arrays in .npy files and reads them memory-mapped.
+
+    Unlike ArraySaver('disk') the arrays are never read from disk as a
+    whole: load() returns a read-only np.memmap, so that indexing it only
+    touches the requested rows. The last max_open memory maps are kept open
+    and reused.
+
+    As memory-mapping requires a local file system, workdir can not point
+    to a remote (e.g. GCS) location.
+    """
+
+    def __init__(self, workdir, max_open=10):
+        assert '://' not in workdir, \
+            'Samples are memory-mapped and need a local work_dir, got %s' % \
+            workdir
+        self._workdir = workdir
+        self._max_open = max_open
+        self._open = collections.OrderedDict()
+
+    def _path(self, name):
+        return os.path.join(self._workdir, name)
+
+    def _forget(self, name):
+        if name in self._open:
+            del self._open[name]
+
+    def save(self, name, array):
+        create_dir(self._workdir)
+        self._forget(name)
+        np.save(self._path(name), np.ascontiguousarray(array))
+
+    def load(self, name):
+        if name in self._open:
+            array = self._open.pop(name)
+        else:
+            array = np.load(self._path(name), mmap_mode='r')
+            if len(self._open) >= self._max_open:
+                # Drop the least recently used memory map
+                self._open.popitem(last=False)
+        self._open[name] = array
+        return array
+
+def freeze_generator(session, filename, output, noise_ph, noise_std=1.):
+    """Saves the generator computing output from noise_ph as a frozen graph.
+
+    The variables are converted to constants and only the part of the graph
+    needed for output is kept, so the file is self-contained and small.
+    output has to be an inference copy of the generator, i.e. built with
+    is_training=False, and noise_ph the only placeholder it depends on. Names
+    of the tensors are stored in filename.json, see GeneratorPool.
+    """
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [output.op.name])
+    inputs = [node.name for node in graph_def.node
+              if node.op in ('Placeholder', 'PlaceholderWithDefault')]
+    assert inputs == [noise_ph.op.name], \
+        'The generator should depend only on the noise, not on %s' % inputs
+    with o_gfile(filename + '.pb', 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    info = {'output': output.name,
+            'noise': noise_ph.name,
+            'noise_std': float(noise_std)}
+    with o_gfile(filename + '.json', 'w') as f:
+        f.write(json.dumps(info))
+
+class GeneratorPool(object):
+    """Samples from generators saved with freeze_generator.
+
+    Every generator gets its own graph and session, loaded when it is first
+    sampled from. Sessions of at most max_open generators are kept, the
+    least recently used one is closed when another one has to be loaded.
+    """
+
+    def __init__(self, opts, max_open=2):
+        # The 'mnist' prior gives a single noise vector whatever num is
+        assert opts['latent_space_distr'] in ('uniform', 'normal'), \
+            'Unsupported latent space distribution for kept generators'
+        self._opts = opts
+        self._max_open = max_open
+        self._open = collections.OrderedDict()
+
+    def _load(self, filename):
+        if filename in self._open:
+            generator = self._open.pop(filename)
+        else:
+            with o_gfile(filename + '.json', 'r') as f:
+                info = json.loads(f.read())
+            graph_def = tf.GraphDef()
+            with o_gfile(filename + '.pb', 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            graph = tf.Graph()
+            with graph.as_default():
+                tf.import_graph_def(graph_def, name='')
+            generator = (tf.Session(graph=graph),
+                         graph.get_tensor_by_name(info['output']),
+                         graph.get_tensor_by_name(info['noise']),
+                         info['noise_std'])
+            if len(self._open) >= self._max_open:
+                # Close the least recently used session
+                _, old = self._open.popitem(last=False)
+                old[0].close()
+        self._open[filename] = generator
+        return generator
+
+    def sample(self, filename, num, random_state=None):
+        """Returns num new points sampled from the generator in filename.
+
+        """
+        session, output, noise_ph, noise_std = self._load(filename)
+        noise = generate_noise(self._opts, num, random_state)
+        if noise_std != 1.:
+            noise *= noise_std
+        return run_batched(session, self._opts, output, {noise_ph: noise})
+
+    def close(self):
+        """Closes the sessions of all loaded generators.
+
+        """
+        while self._open:
+            _, generator = self._open.popitem()
+            generator[0].close()
+
 class ProgressBar(object):
     """Super-simple progress bar.
 
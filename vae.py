@@ -28,10 +28,17 @@ class Vae(object):
         self._data = data
         self._data_weights = np.copy(weights)
         # Latent noise sampled ones to apply decoder while training
-        self._noise_for_plots = utils.generate_noise(opts, 500)
+        self._noise_for_plots = utils.generate_noise(
+            opts, 500, utils.random_state(opts, 'plots'))
         # Placeholders
         self._real_points_ph = None
         self._noise_ph = None
+        # Init ops
+        self._additional_init_ops = []
+        self._init_feed_dict = {}
+        # Ops loading the dataset into the graph, see ops.data_placeholder
+        self._data_init_ops = []
+        self._data_init_feed_dict = {}
 
         # Main operations
         # FIX
@@ -39,6 +46,7 @@ class Vae(object):
         self._loss_reconstruct = None
         self._loss_kl = None
         self._generated = None
+        self._export_generated = None # See export_generator
         self._reconstruct_x = None
 
         # Optimizers
@@ -50,8 +58,10 @@ class Vae(object):
 
         # Make sure AdamOptimizer, if used in the Graph, is defined before
         # calling global_variables_initializer().
-        init = tf.global_variables_initializer()
-        self._session.run(init)
+        self._init = tf.global_variables_initializer()
+        self._session.run(self._init)
+        self._session.run(self._additional_init_ops, self._init_feed_dict)
+        self._session.run(self._data_init_ops, self._data_init_feed_dict)
 
     def __enter__(self):
         return self
@@ -64,6 +74,24 @@ class Vae(object):
         # Finishing the session
         self._session.close()
 
+    def reset(self, opts):
+        """Re-initialize the VAE for training a new component.
+
+        All the variables get their initial values, as if the VAE was
+        constructed anew, but the graph (and the dataset loaded into it)
+        is reused, which saves rebuilding it for every AdaGAN step.
+        """
+        self._trained = False
+        self._session.run(self._init)
+        self._session.run(self._additional_init_ops, self._init_feed_dict)
+
+    def set_data_weights(self, weights):
+        """Set the weights of the training points used to sample minibatches.
+
+        """
+        self._data_weights = np.copy(weights)
+        ops.load_data_weights(self._session, self._data_weights)
+
     def train(self, opts):
         """Train a VAE model.
 
@@ -80,6 +108,31 @@ class Vae(object):
         with self._session.as_default(), self._session.graph.as_default():
             return self._sample_internal(opts, num)
 
+    def export_generator(self, opts, filename):
+        """Save the trained generator as a frozen graph.
+
+        The generator can be then sampled from after this VAE is gone,
+        see utils.GeneratorPool.
+        """
+        assert self._trained, 'Can not export the un-trained VAE'
+        if self._export_generated is None:
+            with self._session.graph.as_default():
+                self._add_export_ops(opts)
+        utils.freeze_generator(
+            self._session, filename, self._export_generated,
+            self._export_noise_ph)
+
+    def _add_export_ops(self, opts):
+        # The generator in the inference mode, fed only with the noise. Unlike
+        # self._generated it neither updates the batch norm moving averages
+        # nor depends on the real points through the device noise.
+        noise_ph = tf.placeholder(
+            tf.float32, [None, opts['latent_space_dim']],
+            name='export_noise_ph')
+        self._export_noise_ph = noise_ph
+        self._export_generated = self.generator(
+            opts, noise_ph, is_training=False, reuse=True)
+
     def train_mixture_discriminator(self, opts, fake_images):
         """Train classifier separating true data from points in fake_images.
 
@@ -98,53 +151,22 @@ class Vae(object):
 
     def _run_batch(self, opts, operation, placeholder, feed,
                    placeholder2=None, feed2=None):
-        """Wrapper around session.run to process huge data.
+        """Wrapper around utils.run_batched to process huge data.
 
-        It is asumed that (a) first dimension of placeholder enumerates
-        separate points, and (b) that operation is independently applied
-        to every point, i.e. we can split it point-wisely and then merge
-        the results. The second placeholder is meant either for is_train
-        flag for batch-norm or probabilities of dropout.
-
-        TODO: write util function which will be called both from this method
-        and MNIST classification evaluation as well.
+        feed is either a numpy array or a (lazy) datahandler.Data. The
+        second placeholder is meant either for is_train flag for batch-norm
+        or probabilities of dropout. Vector results of shape (n,) are
+        returned as (n, 1) arrays.
 
         """
-        assert len(feed.shape) > 0, 'Empry feed.'
-        num_points = feed.shape[0]
-        batch_size = opts['tf_run_batch_size']
-        batches_num = int(np.ceil((num_points + 0.) / batch_size))
-        result = []
-        for idx in xrange(batches_num):
-            if idx == batches_num - 1:
-                if feed2 is None:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:]})
-                else:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:],
-                                   placeholder2: feed2})
-            else:
-                if feed2 is None:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:
-                                                     (idx + 1) * batch_size]})
-                else:
-                    res = self._session.run(
-                        operation,
-                        feed_dict={placeholder: feed[idx * batch_size:
-                                                     (idx + 1) * batch_size],
-                                   placeholder2: feed2})
-
-            if len(res.shape) == 1:
-                # convert (n,) vector to (n,1) array
-                res = np.reshape(res, [-1, 1])
-            result.append(res)
-        result = np.vstack(result)
-        assert len(result) == num_points
+        const_feed = None
+        if feed2 is not None:
+            const_feed = {placeholder2: feed2}
+        result = utils.run_batched(
+            self._session, opts, operation, {placeholder: feed}, const_feed)
+        if len(result.shape) == 1:
+            # convert (n,) vector to (n,1) array
+            result = np.reshape(result, [-1, 1])
         return result
 
     def _build_model_internal(self, opts):
@@ -278,10 +300,13 @@ class ImageVae(Vae):
         data_shape = self._data.data_shape
 
         # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        real_points_ph, init_ops, init_feed_dict = ops.data_placeholder(
+            opts, self._data.data, self._data_weights, 'real_points_ph')
+        self._data_init_ops += init_ops
+        self._data_init_feed_dict.update(init_feed_dict)
+        # Noise of the reparametrization, one per real point
+        noise_ph = ops.noise_placeholder(
+            opts, 'noise_ph', batch_size=tf.shape(real_points_ph)[0])
         is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
         lr_decay_ph = tf.placeholder(tf.float32)
 
@@ -365,76 +390,82 @@ class ImageVae(Vae):
         sample_prev = np.zeros([num_plot] + list(self._data.data_shape))
         l2s = []
 
-        counter = 0
-        decay = 1.
-        logging.error('Training VAE')
-        for _epoch in xrange(opts["gan_epoch_num"]):
-
-            if opts['decay_schedule'] == "manual":
-                if _epoch == 30:
-                    decay = decay / 2.
-                if _epoch == 50:
-                    decay = decay / 5.
-                if _epoch == 100:
-                    decay = decay / 10.
-
-            if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
-                os.path.join(opts['work_dir'], opts['ckpt_dir'])
-                self._saver.save(self._session,
-                                 os.path.join(opts['work_dir'],
-                                              opts['ckpt_dir'],
-                                              'trained-pot'),
-                                 global_step=counter)
-
-            for _idx in xrange(batches_num):
-                # logging.error('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
-                batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                _, loss, loss_kl, loss_reconstruct = self._session.run(
-                    [self._optim, self._loss, self._loss_kl,
-                     self._loss_reconstruct],
-                    feed_dict={self._real_points_ph: batch_images,
-                               self._noise_ph: batch_noise,
-                               self._lr_decay_ph: decay,
-                               self._is_training_ph: True})
-                counter += 1
-
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    debug_str = 'Epoch: %d/%d, batch:%d/%d' % (
-                        _epoch+1, opts['gan_epoch_num'], _idx+1, batches_num)
-                    debug_str += '  [L=%.2g, Recon=%.2g, KLQ=%.2g]' % (
-                        loss, loss_reconstruct, loss_kl)
-                    logging.error(debug_str)
-
-                if opts['verbose'] and counter % opts['plot_every'] == 0:
-                    metrics = Metrics()
-                    points_to_plot = self._run_batch(
-                        opts, self._generated, self._noise_ph,
-                        self._noise_for_plots[0:num_plot],
-                        self._is_training_ph, False)
-                    l2s.append(np.sum((points_to_plot - sample_prev)**2))
-                    metrics.l2s = l2s[:]
-                    metrics.make_plots(
-                        opts,
-                        counter,
-                        None,
-                        points_to_plot,
-                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
-                    reconstructed = self._session.run(
-                        self._reconstruct_x,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._is_training_ph: False})
-                    metrics.l2s = None
-                    metrics.make_plots(
-                        opts,
-                        counter,
-                        None,
-                        reconstructed,
-                        prefix='reconstr_e%04d_mb%05d_' % (_epoch, _idx))
-                if opts['early_stop'] > 0 and counter > opts['early_stop']:
-                    break
+        # With opts['graph_input'] the graph samples the real points itself
+        batches = utils.BatchPrefetcher(
+            opts, None if opts.get('graph_input', False) else self._data.data,
+            self._data_weights)
+        try:
+            counter = 0
+            decay = 1.
+            logging.error('Training VAE')
+            for _epoch in xrange(opts["gan_epoch_num"]):
+
+                if opts['decay_schedule'] == "manual":
+                    if _epoch == 30:
+                        decay = decay / 2.
+                    if _epoch == 50:
+                        decay = decay / 5.
+                    if _epoch == 100:
+                        decay = decay / 10.
+
+                if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
+                    os.path.join(opts['work_dir'], opts['ckpt_dir'])
+                    self._saver.save(self._session,
+                                     os.path.join(opts['work_dir'],
+                                                  opts['ckpt_dir'],
+                                                  'trained-pot'),
+                                     global_step=counter)
+
+                for _idx in xrange(batches_num):
+                    # logging.error('Step %d of %d' % (_idx, batches_num ) )
+                    batch_images, batch_noise, _ = batches.next()
+                    _, loss, loss_kl, loss_reconstruct = self._session.run(
+                        [self._optim, self._loss, self._loss_kl,
+                         self._loss_reconstruct],
+                        feed_dict=utils.prune_feed(
+                            {self._real_points_ph: batch_images,
+                             self._noise_ph: batch_noise,
+                             self._lr_decay_ph: decay,
+                             self._is_training_ph: True}))
+                    counter += 1
+
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        debug_str = 'Epoch: %d/%d, batch:%d/%d' % (
+                            _epoch+1, opts['gan_epoch_num'],
+                            _idx+1, batches_num)
+                        debug_str += '  [L=%.2g, Recon=%.2g, KLQ=%.2g]' % (
+                            loss, loss_reconstruct, loss_kl)
+                        logging.error(debug_str)
+
+                    if opts['verbose'] and counter % opts['plot_every'] == 0:
+                        metrics = Metrics()
+                        points_to_plot = self._run_batch(
+                            opts, self._generated, self._noise_ph,
+                            self._noise_for_plots[0:num_plot],
+                            self._is_training_ph, False)
+                        l2s.append(np.sum((points_to_plot - sample_prev)**2))
+                        metrics.l2s = l2s[:]
+                        metrics.make_plots(
+                            opts,
+                            counter,
+                            None,
+                            points_to_plot,
+                            prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
+                        reconstructed = self._session.run(
+                            self._reconstruct_x,
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._is_training_ph: False})
+                        metrics.l2s = None
+                        metrics.make_plots(
+                            opts,
+                            counter,
+                            None,
+                            reconstructed,
+                            prefix='reconstr_e%04d_mb%05d_' % (_epoch, _idx))
+                    if opts['early_stop'] > 0 and counter > opts['early_stop']:
+                        break
+        finally:
+            batches.close()
         if _epoch > 0:
             os.path.join(opts['work_dir'], opts['ckpt_dir'])
             self._saver.save(self._session,
@@ -447,7 +478,8 @@ class ImageVae(Vae):
         """Sample from the trained GAN model.
 
         """
-        noise = utils.generate_noise(opts, num)
+        noise = utils.generate_noise(
+            opts, num, utils.random_state(opts, 'sample'))
         sample = self._run_batch(
             opts, self._generated, self._noise_ph, noise,
             self._is_training_ph, False)